@@ -1,9 +1,84 @@
+from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 from django.utils.translation import gettext as _
 
 from core import models
 
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that estimates the size of large changelists
+
+    Unfiltered lists use the planner's table statistics and filtered ones
+    are counted up to ADMIN_EXACT_COUNT_LIMIT rows, then estimated from
+    the query plan. Estimates need PostgreSQL; elsewhere rows are counted.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return super().count
+        limit = settings.ADMIN_EXACT_COUNT_LIMIT
+        if not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                    [queryset.model._meta.db_table],
+                )
+                estimate = cursor.fetchone()[0]
+            return estimate if estimate > limit else super().count
+        counted = queryset.order_by()[:limit + 1].count()
+        if counted <= limit:
+            return counted
+        sql, params = queryset.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        return max(int(plan[0]['Plan']['Plan Rows']), counted)
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Changelist settings for tables too big to count or list in full"""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_select_related = ('user', )
+    raw_id_fields = ('user', )
+    ordering = ('-id', )
+
+
+class RelatedNameAdmin(LargeTableAdmin):
+    """Tag and ingredient admin, searched by prefix on the indexed search_name"""
+    list_display = ('name', 'user', 'recipe_count')
+    search_fields = ('search_name', )
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        if search_term.isdigit():
+            return queryset.filter(id=int(search_term)), False
+        return queryset.filter(search_name__startswith=models.normalize_name(search_term)), False
+
+
+class RecipeAdmin(LargeTableAdmin):
+    """Recipe admin picking tags and ingredients through autocomplete"""
+    list_display = ('title', 'user', 'price', 'time_minutes')
+    search_fields = ('title', )
+    autocomplete_fields = ('tags', 'ingredients')
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        if search_term.isdigit():
+            return queryset.filter(id=int(search_term)), False
+        return queryset.filter(title__istartswith=search_term), False
+
 class UserAdmin(BaseUserAdmin):
     ordering = ['id']
     list_display = ['email', 'name']
@@ -29,5 +104,6 @@ class UserAdmin(BaseUserAdmin):
 
 
 admin.site.register(models.User, UserAdmin)
-admin.site.register(models.Tag)
-admin.site.register(models.Recipe)
+admin.site.register(models.Tag, RelatedNameAdmin)
+admin.site.register(models.Ingredient, RelatedNameAdmin)
+admin.site.register(models.Recipe, RecipeAdmin)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        """Connect the model signal handlers"""
+        from core import signals  # noqa: F401
@@ -0,0 +1,104 @@
+from django.db import connections, router, transaction
+from django.db.models import Q
+
+from core.cache import bump_user_version
+from core.counters import adjust_recipe_counts, rebuild_recipe_counts, recipe_relations
+from core.models import Recipe, RecipeDocument, RecipeNeighbour
+from core.similarity import schedule_refresh
+from core.sync import record_changes
+
+
+def _batches(ids, batch_size):
+    for start in range(0, len(ids), batch_size):
+        yield ids[start:start + batch_size]
+
+
+def delete_recipes(user_id, queryset, using=None, batch_size=1000):
+    """Delete the user's recipes in the queryset with set-based deletes
+
+    Django's collector would load and delete every recipe and relation row
+    one by one to send signals. Instead each batch runs one DELETE per
+    table and then does the signals' bookkeeping in bulk: counters are
+    recounted, tombstones logged and neighbours queued for refresh.
+    """
+    using = using or router.db_for_write(Recipe, user_id=user_id)
+    ids = list(queryset.filter(user_id=user_id).order_by().values_list('id', flat=True))
+    neighbour_recipes = set()
+    with transaction.atomic(using=using):
+        for batch in _batches(ids, batch_size):
+            for model, through, column in recipe_relations():
+                rows = through.objects.using(using).filter(recipe_id__in=batch)
+                related_ids = set(rows.values_list(column, flat=True))
+                # _raw_delete skips the collector, which the receivers above force
+                rows._raw_delete(using)
+                rebuild_recipe_counts(model, related_ids, using)
+                record_changes(user_id, model, related_ids, using=using)
+            neighbours = RecipeNeighbour.objects.using(using).filter(
+                Q(recipe_id__in=batch) | Q(neighbour_id__in=batch)
+            )
+            neighbour_recipes.update(neighbours.filter(
+                neighbour_id__in=batch
+            ).values_list('recipe_id', flat=True))
+            neighbours._raw_delete(using)
+            RecipeDocument.objects.using(using).filter(recipe_id__in=batch)._raw_delete(using)
+            Recipe.objects.using(using).filter(id__in=batch)._raw_delete(using)
+            record_changes(user_id, Recipe, batch, deleted=True, using=using)
+        neighbour_recipes.difference_update(ids)
+        if neighbour_recipes:
+            schedule_refresh(user_id, neighbour_recipes, using)
+    bump_user_version(user_id)
+    return len(ids)
+
+
+def update_recipes(user_id, queryset, values, using=None):
+    """Apply the same field values to the user's recipes with one UPDATE"""
+    using = using or router.db_for_write(Recipe, user_id=user_id)
+    ids = list(queryset.filter(user_id=user_id).order_by().values_list('id', flat=True))
+    if not ids or not values:
+        return 0
+    with transaction.atomic(using=using):
+        updated = Recipe.objects.using(using).filter(id__in=ids).update(**values)
+        record_changes(user_id, Recipe, ids, using=using)
+    bump_user_version(user_id)
+    return updated
+
+
+def clone_recipe(recipe, count=1, using=None):
+    """Copy a recipe and its tags and ingredients count times
+
+    The copies share the original's image file. Rows are created with one
+    INSERT per table where the backend returns ids from bulk inserts;
+    elsewhere (SQLite) the recipes themselves are saved one by one.
+    """
+    using = using or router.db_for_write(Recipe, instance=recipe)
+    fields = [field.attname for field in Recipe._meta.concrete_fields if not field.primary_key]
+    with transaction.atomic(using=using):
+        source = Recipe.objects.using(using).select_for_update().get(pk=recipe.pk)
+        copies = [
+            Recipe(**{name: getattr(source, name) for name in fields})
+            for _ in range(count)
+        ]
+        if connections[using].features.can_return_ids_from_bulk_insert:
+            Recipe.objects.using(using).bulk_create(copies)
+        else:
+            for copy in copies:
+                copy.save(using=using)
+        copy_ids = [copy.pk for copy in copies]
+
+        for model, through, column in recipe_relations():
+            related_ids = list(through.objects.using(using).filter(
+                recipe_id=source.pk
+            ).values_list(column, flat=True))
+            if not related_ids:
+                continue
+            through.objects.using(using).bulk_create([
+                through(recipe_id=copy_id, **{column: related_id})
+                for copy_id in copy_ids
+                for related_id in related_ids
+            ])
+            adjust_recipe_counts(model, related_ids, count, using)
+            record_changes(source.user_id, model, related_ids, using=using)
+        record_changes(source.user_id, Recipe, copy_ids, created=True, using=using)
+        schedule_refresh(source.user_id, copy_ids, using)
+    bump_user_version(source.user_id)
+    return copy_ids
@@ -0,0 +1,54 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import urlencode
+
+
+def _version_key(user_id):
+    return f'user-version:{user_id}'
+
+
+def _new_version():
+    # Versions start from the clock, so a version key that was evicted or
+    # expired never comes back as a version already cached against
+    return int(time.time() * 1000)
+
+
+def get_user_version(user_id):
+    """Return the current cache version for everything a user owns"""
+    return cache.get_or_set(_version_key(user_id), _new_version, settings.USER_VERSION_TIMEOUT)
+
+
+def bump_user_version(user_id):
+    """Invalidate every cached result derived from the user's data"""
+    key = _version_key(user_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_version(), settings.USER_VERSION_TIMEOUT)
+
+
+def user_cache_key(user_id, name, params=None):
+    """Build a cache key scoped to the user's current data version"""
+    digest = ''
+    if params:
+        if hasattr(params, 'lists'):
+            items = sorted((key, value) for key, values in params.lists() for value in values)
+        else:
+            items = sorted(params.items())
+        digest = hashlib.md5(urlencode(items).encode()).hexdigest()
+    return f'{name}:{user_id}:{get_user_version(user_id)}:{digest}'
+
+
+def cached_for_user(user_id, name, compute, params=None, timeout=None):
+    """Return the cached value for the user, computing it on a miss"""
+    if timeout is None:
+        timeout = settings.USER_CACHE_TIMEOUT
+    key = user_cache_key(user_id, name, params)
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, timeout)
+    return value
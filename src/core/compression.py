@@ -0,0 +1,112 @@
+import gzip
+import hashlib
+import io
+import zlib
+
+from django.conf import settings
+from django.core.cache import caches
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+IDENTITY = 'identity'
+
+
+def available_codings():
+    """Return the content codings we can produce, most preferred first"""
+    return ('br', 'gzip') if brotli is not None else ('gzip', )
+
+
+def negotiate(accept_encoding):
+    """Pick the best coding the client accepts from an Accept-Encoding header
+
+    Codings are ranked by the client's q-values, ties going to the order
+    of available_codings(); '*' stands for any coding not listed.
+    """
+    weights = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        weights[coding] = quality
+    best, best_quality = IDENTITY, 0.0
+    for coding in available_codings():
+        quality = weights.get(coding, weights.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress(coding, content):
+    """Compress a whole body"""
+    if coding == 'br':
+        return brotli.compress(content, quality=settings.COMPRESSION_BROTLI_QUALITY)
+    buffer = io.BytesIO()
+    with gzip.GzipFile(
+        mode='wb', fileobj=buffer, compresslevel=settings.COMPRESSION_GZIP_LEVEL, mtime=0
+    ) as stream:
+        stream.write(content)
+    return buffer.getvalue()
+
+
+def compress_cached(coding, content):
+    """Compress a body, reusing the result for identical hot bodies
+
+    Compressed bodies are kept for COMPRESSION_CACHE_SECONDS under a
+    digest of the uncompressed body, so each hit only costs a hash. They
+    go to the 'compression' cache, so as not to push the shared entries
+    out of the default one.
+    """
+    if not settings.COMPRESSION_CACHE_SECONDS:
+        return compress(coding, content)
+    cache = caches['compression']
+    key = f'compressed:{coding}:{hashlib.sha1(content).hexdigest()}:{len(content)}'
+    compressed = cache.get(key)
+    if compressed is None:
+        compressed = compress(coding, content)
+        cache.set(key, compressed, settings.COMPRESSION_CACHE_SECONDS)
+    return compressed
+
+
+def compress_stream(coding, chunks):
+    """Compress a streamed body chunk by chunk, flushing after each one
+
+    Flushing keeps streams such as server-sent events arriving in time.
+    """
+    if coding == 'br':
+        compressor = brotli.Compressor(quality=settings.COMPRESSION_BROTLI_QUALITY)
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+        return
+    buffer = io.BytesIO()
+    with gzip.GzipFile(
+        mode='wb', fileobj=buffer, compresslevel=settings.COMPRESSION_GZIP_LEVEL, mtime=0
+    ) as stream:
+        for chunk in chunks:
+            stream.write(chunk)
+            stream.flush(zlib.Z_SYNC_FLUSH)
+            data = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            if data:
+                yield data
+    yield buffer.getvalue()
+
+
+def is_compressible(content_type):
+    """Tell whether a response of this content type is worth compressing"""
+    media_type = content_type.split(';')[0].strip().lower()
+    return media_type.startswith('text/') or media_type in settings.COMPRESSION_MEDIA_TYPES
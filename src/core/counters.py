@@ -0,0 +1,64 @@
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from core.models import Tag, Ingredient, Recipe
+
+
+def recipe_relations():
+    """Return (model, through model, through column) for each counted relation"""
+    return (
+        (Tag, Recipe.tags.through, 'tag_id'),
+        (Ingredient, Recipe.ingredients.through, 'ingredient_id'),
+    )
+
+
+def relation_for_through(through):
+    """Return the counted relation that uses the given through model"""
+    for relation in recipe_relations():
+        if relation[1] is through:
+            return relation
+    return None
+
+
+def relation_for_model(model):
+    """Return the counted relation for Tag or Ingredient"""
+    for relation in recipe_relations():
+        if relation[0] is model:
+            return relation
+    raise ValueError(f'{model.__name__} has no recipe counter')
+
+
+def adjust_recipe_counts(model, ids, delta, using='default'):
+    """Atomically add delta to recipe_count of the given rows"""
+    if not ids or not delta:
+        return 0
+    return model.objects.using(using).filter(id__in=ids).update(
+        recipe_count=F('recipe_count') + delta
+    )
+
+
+def _actual_recipe_count(model):
+    _, through, column = relation_for_model(model)
+    usage = through.objects.filter(**{column: OuterRef('pk')}).order_by().values(
+        column
+    ).annotate(total=Count('id')).values('total')
+    return Coalesce(Subquery(usage, output_field=IntegerField()), 0)
+
+
+def drifted_recipe_counts(model, using='default'):
+    """Return the ids of the rows whose recipe_count is off, by user id"""
+    rows = model.objects.using(using).annotate(actual=_actual_recipe_count(model)).filter(
+        ~Q(recipe_count=F('actual'))
+    ).order_by('user_id', 'id').values_list('user_id', 'id')
+    drifted = {}
+    for user_id, row_id in rows:
+        drifted.setdefault(user_id, []).append(row_id)
+    return drifted
+
+
+def rebuild_recipe_counts(model, ids=None, using='default'):
+    """Recompute recipe_count from the recipe relation table in one UPDATE"""
+    queryset = model.objects.using(using).all()
+    if ids is not None:
+        queryset = queryset.filter(id__in=ids)
+    return queryset.update(recipe_count=_actual_recipe_count(model))
@@ -0,0 +1,250 @@
+import collections
+import os
+import threading
+import time
+
+from django.db.utils import OperationalError
+
+IdleConnection = collections.namedtuple('IdleConnection', 'connection created returned')
+
+
+class PoolTimeout(OperationalError):
+    """Raised when no pooled connection frees up within the acquire timeout"""
+
+
+class ConnectionPool:
+    """A thread-safe pool of DB-API connections to one database
+
+    Up to max_size connections are open at once, and at least min_size
+    once filled. acquire() hands out the most recently returned idle
+    connection that passes the health check, opens a new one while below
+    max_size, or else waits up to timeout seconds for one to be released.
+    Connections idle for over max_idle seconds are closed down to
+    min_size, and connections older than max_lifetime are not reused.
+    """
+
+    def __init__(self, check, min_size=0, max_size=10, timeout=5, max_idle=300,
+                 max_lifetime=None):
+        self.check = check
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self._condition = threading.Condition()
+        self._idle = collections.deque()
+        self._in_use = {}
+        self._size = 0
+        self._waiting = 0
+        self._counters = collections.Counter()
+        self._max_wait = 0.0
+
+    def _expired(self, created, now):
+        return self.max_lifetime is not None and now - created > self.max_lifetime
+
+    def _take_stale(self, now):
+        """Remove the idle connections due for recycling, to be closed"""
+        stale = []
+        for entry in list(self._idle):
+            too_idle = self.max_idle is not None and now - entry.returned > self.max_idle
+            if self._expired(entry.created, now) or (too_idle and self._size > self.min_size):
+                self._idle.remove(entry)
+                self._size -= 1
+                stale.append(entry.connection)
+        return stale
+
+    def _close(self, connections):
+        for connection in connections:
+            try:
+                connection.close()
+            except Exception:
+                pass
+        with self._condition:
+            self._counters['closed'] += len(connections)
+
+    def _open(self, connect):
+        """Open a connection in a slot already counted in the pool's size"""
+        try:
+            connection = connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._counters['opened'] += 1
+        return connection, time.monotonic()
+
+    def fill(self, connect):
+        """Open connections until the pool holds min_size of them"""
+        while True:
+            with self._condition:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            connection, created = self._open(connect)
+            with self._condition:
+                self._idle.appendleft(IdleConnection(connection, created, created))
+                self._condition.notify()
+
+    def acquire(self, connect):
+        """Check a connection out, opening it with connect() if need be"""
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            entry = None
+            with self._condition:
+                stale = self._take_stale(time.monotonic())
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        raise PoolTimeout(
+                            f'No database connection free after {self.timeout} seconds '
+                            f'({self._size} of {self.max_size} in use)'
+                        )
+                    self._waiting += 1
+                    self._condition.wait(remaining)
+                    self._waiting -= 1
+                if self._idle:
+                    entry = self._idle.pop()
+                else:
+                    self._size += 1
+            self._close(stale)
+
+            if entry is None:
+                connection, created = self._open(connect)
+            elif self.check(entry.connection):
+                connection, created = entry.connection, entry.created
+            else:
+                with self._condition:
+                    self._counters['failed_checks'] += 1
+                    self._size -= 1
+                    self._condition.notify()
+                self._close([entry.connection])
+                continue
+
+            waited = time.monotonic() - start
+            with self._condition:
+                self._in_use[id(connection)] = created
+                self._counters['checkouts'] += 1
+                self._counters['wait_seconds'] += waited
+                self._max_wait = max(self._max_wait, waited)
+            return connection
+
+    def release(self, connection, discard=False):
+        """Return a checked out connection, closing it when discard is set"""
+        now = time.monotonic()
+        with self._condition:
+            created = self._in_use.pop(id(connection), None)
+            if created is None:
+                discard = True
+            elif discard or self._expired(created, now):
+                discard = True
+                self._size -= 1
+            else:
+                self._idle.append(IdleConnection(connection, created, now))
+            self._condition.notify()
+        if discard:
+            self._close([connection])
+
+    def close(self):
+        """Close the idle connections, as on shutdown"""
+        with self._condition:
+            idle = [entry.connection for entry in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+        self._close(idle)
+
+    def stats(self):
+        """Return the pool's current state and its counters so far"""
+        with self._condition:
+            checkouts = self._counters['checkouts']
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'waiting': self._waiting,
+                'opened': self._counters['opened'],
+                'closed': self._counters['closed'],
+                'checkouts': checkouts,
+                'timeouts': self._counters['timeouts'],
+                'failed_checks': self._counters['failed_checks'],
+                'avg_wait_ms': round(self._counters['wait_seconds'] / checkouts * 1000, 3) if checkouts else 0,
+                'max_wait_ms': round(self._max_wait * 1000, 3),
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+
+def get_pool(key, factory):
+    """Return the pool registered under key, creating it with factory()
+
+    A forked process starts with no pools: the connections it inherited
+    belong to its parent.
+    """
+    global _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = factory()
+        return pool
+
+
+def pool_stats():
+    """Return the stats of every pool in this process, by database alias"""
+    with _pools_lock:
+        pools = list(_pools.items())
+    return {alias: pool.stats() for (alias, params), pool in pools}
+
+
+def close_pools():
+    """Close the idle connections of every pool in this process"""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
+
+
+class PooledDatabaseWrapper:
+    """Mixin making a Django database backend use a ConnectionPool
+
+    Closing the connection, as Django does at the end of each request,
+    rolls back anything left open and returns it to the pool. The pool is
+    configured by the database's POOL setting, whose keys are the upper
+    case ConnectionPool arguments.
+    """
+
+    def check_connection(self, connection):
+        """Tell whether a pooled DB-API connection still works"""
+        raise NotImplementedError
+
+    def get_pool(self, conn_params):
+        options = {name.lower(): value for name, value in self.settings_dict.get('POOL', {}).items()}
+        key = (self.alias, repr(sorted(conn_params.items())))
+        return get_pool(key, lambda: ConnectionPool(self.check_connection, **options))
+
+    def get_new_connection(self, conn_params):
+        connect = lambda: super(PooledDatabaseWrapper, self).get_new_connection(conn_params)
+        self.pool = self.get_pool(conn_params)
+        self.pool.fill(connect)
+        return self.pool.acquire(connect)
+
+    def _close(self):
+        if self.connection is None:
+            return
+        discard = self.in_atomic_block
+        if not discard:
+            try:
+                self.connection.rollback()
+            except Exception:
+                discard = True
+        self.pool.release(self.connection, discard=discard)
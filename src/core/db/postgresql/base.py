@@ -0,0 +1,26 @@
+from django.db.backends.postgresql import base
+
+from core.db.pool import PooledDatabaseWrapper
+
+
+class DatabaseWrapper(PooledDatabaseWrapper, base.DatabaseWrapper):
+    """PostgreSQL backend taking its connections from a pool"""
+
+    def check_connection(self, connection):
+        if connection.closed:
+            return False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+        except base.Database.Error:
+            return False
+        return True
+
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        # Only set by the parent when it opens a new connection
+        self.isolation_level = self.settings_dict['OPTIONS'].get(
+            'isolation_level', connection.isolation_level
+        )
+        return connection
@@ -0,0 +1,18 @@
+from django.db.backends.sqlite3 import base
+
+from core.db.pool import PooledDatabaseWrapper
+
+
+class DatabaseWrapper(PooledDatabaseWrapper, base.DatabaseWrapper):
+    """SQLite backend taking its connections from a pool
+
+    In-memory databases are never closed by Django, so their connections
+    are not returned to the pool.
+    """
+
+    def check_connection(self, connection):
+        try:
+            connection.execute('SELECT 1').fetchone()
+        except base.Database.Error:
+            return False
+        return True
@@ -0,0 +1,177 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from core.sharding import ShardMovingError, is_sharded, shard_for_user
+
+_state = threading.local()
+_health = {}
+
+
+def _pin_key(user_id):
+    return f'db-pin:{user_id}'
+
+
+def pin_to_primary(user_id):
+    """Send the user's reads to the primary until replicas caught up"""
+    cache.set(_pin_key(user_id), True, settings.REPLICA_PIN_SECONDS)
+
+
+@contextmanager
+def routing_context(request=None, user_id=None, replica_reads=False):
+    """Route the queries made inside by the request's or the given user
+
+    The replica pin and the shard placements looked up inside are kept
+    until the context ends, so each is looked up once per request or job.
+    """
+    previous = (getattr(_state, 'context', None), getattr(_state, 'pinned', None),
+                getattr(_state, 'placements', None))
+    _state.context = (request, user_id, replica_reads)
+    _state.pinned = None
+    _state.placements = {}
+    try:
+        yield
+    finally:
+        _state.context, _state.pinned, _state.placements = previous
+
+
+def replica_reads(request):
+    """Let reads made while handling request go to a replica"""
+    return routing_context(request, replica_reads=True)
+
+
+def for_user(user_id):
+    """Route the queries made inside, e.g. by a job, to the user's shard"""
+    return routing_context(user_id=user_id)
+
+
+def _context():
+    return getattr(_state, 'context', None) or (None, None, False)
+
+
+def current_user_id():
+    """Return the id of the user the current queries are made for"""
+    request, user_id, replica = _context()
+    if user_id is None:
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            user_id = user.id
+    return user_id
+
+
+def replica_is_healthy(alias):
+    """Check that a replica accepts connections, caching the answer briefly"""
+    now = time.monotonic()
+    healthy, checked_at = _health.get(alias, (True, None))
+    if checked_at is not None and now - checked_at < settings.REPLICA_HEALTH_CHECK_SECONDS:
+        return healthy
+    try:
+        connections[alias].ensure_connection()
+        healthy = True
+    except DatabaseError:
+        healthy = False
+    _health[alias] = (healthy, now)
+    return healthy
+
+
+class ReplicaRouter:
+    """Route the reads of safe requests on replica-enabled views to replicas
+
+    Views opt in with replica_reads = True. A user who wrote recently is
+    pinned to the primary for REPLICA_PIN_SECONDS so they read their own
+    writes, and unhealthy replicas are skipped in favour of the primary.
+    """
+    primary_only = ('authtoken', 'sessions', 'django_cache')
+
+    def _is_pinned(self, request):
+        if _state.pinned is None:
+            user = getattr(request, 'user', None)
+            if user is None or not user.is_authenticated:
+                return False
+            _state.pinned = bool(cache.get(_pin_key(user.id)))
+        return _state.pinned
+
+    def db_for_read(self, model, **hints):
+        request, user_id, replica = _context()
+        if not replica or model._meta.app_label in self.primary_only:
+            return None
+        if self._is_pinned(request):
+            return None
+        replicas = [alias for alias in settings.DATABASE_REPLICAS if replica_is_healthy(alias)]
+        if not replicas:
+            return None
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
+
+
+class ShardRouter:
+    """Send users' recipes, tags, ingredients and their derived rows to the user's shard
+
+    The user comes from a user_id or user instance hint, the instance's
+    owner, or the request or job being handled. Queries made for nobody
+    in particular fall through to 'default'. Global models live on
+    'default', with the user rows mirrored to the shards to anchor the
+    foreign keys; the shard map itself is kept on 'default' only.
+    Placements are looked up once per routing context, except that writes
+    look again, so none is made on a shard the user is being moved from.
+    """
+
+    def _placement(self, model, hints, write=False):
+        if not settings.DATABASE_SHARDS:
+            return None
+        if not is_sharded(model._meta.app_label, model._meta.model_name):
+            return None
+        user_id = hints.get('user_id')
+        instance = hints.get('instance')
+        if user_id is None and instance is not None:
+            if isinstance(instance, get_user_model()):
+                user_id = instance.pk
+            else:
+                user_id = getattr(instance, 'user_id', None)
+        if user_id is None:
+            user_id = current_user_id()
+        if user_id is None:
+            return None
+        placements = getattr(_state, 'placements', None)
+        if placements is None:
+            return shard_for_user(user_id)
+        if write or user_id not in placements:
+            placements[user_id] = shard_for_user(user_id)
+        return placements[user_id]
+
+    def db_for_read(self, model, **hints):
+        placement = self._placement(model, hints)
+        return placement.shard if placement else None
+
+    def db_for_write(self, model, **hints):
+        placement = self._placement(model, hints, write=True)
+        if placement is None:
+            return None
+        if placement.moving:
+            raise ShardMovingError('The user is being moved to another shard')
+        return placement.shard
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if not settings.DATABASE_SHARDS or db == DEFAULT_DB_ALIAS:
+            return None
+        if app_label == 'core' and model_name == 'usershard':
+            return False
+        if is_sharded(app_label, model_name) and db not in settings.DATABASE_SHARDS:
+            return False
+        return None
@@ -0,0 +1,38 @@
+import threading
+from collections import defaultdict
+
+
+class EventBus:
+    """In-process notifications telling a user's event streams to wake up
+
+    Only a wake-up is published; the events themselves are read from the
+    change log, so streams also catch up on writes made by other
+    processes the next time they poll.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = defaultdict(set)
+
+    def subscribe(self, user_id):
+        waiter = threading.Event()
+        with self._lock:
+            self._waiters[user_id].add(waiter)
+        return waiter
+
+    def unsubscribe(self, user_id, waiter):
+        with self._lock:
+            waiters = self._waiters.get(user_id)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[user_id]
+
+    def publish(self, user_id):
+        with self._lock:
+            waiters = list(self._waiters.get(user_id, ()))
+        for waiter in waiters:
+            waiter.set()
+
+
+bus = EventBus()
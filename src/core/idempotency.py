@@ -0,0 +1,105 @@
+import hashlib
+import json
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.uploadedfile import UploadedFile
+from rest_framework import status
+from rest_framework.response import Response
+
+from core.renderers import OrjsonRenderer
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+MAX_KEY_LENGTH = 255
+REPLAYED_HEADER = 'Idempotent-Replayed'
+STORED_HEADERS = ('Location', )
+
+
+def _value(value):
+    if isinstance(value, UploadedFile):
+        return f'{value.name}:{value.size}'
+    return str(value)
+
+
+def request_fingerprint(request):
+    """Digest the method, path and body of a request"""
+    data = request.data
+    if hasattr(data, 'lists'):
+        data = {key: [_value(value) for value in values] for key, values in data.lists()}
+    payload = json.dumps([request.method, request.path, data], sort_keys=True, default=_value)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _cache_key(request, key):
+    return f'idempotency:{request.user.pk}:{hashlib.sha256(key.encode()).hexdigest()}'
+
+
+def _replay(stored, fingerprint):
+    if stored['fingerprint'] != fingerprint:
+        return Response(
+            {'detail': 'Idempotency-Key was used with a different request'},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        )
+    response = Response(stored['data'], status=stored['status'], headers=stored['headers'])
+    response[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def idempotent(handler):
+    """Run a view handler once per Idempotency-Key sent by the user
+
+    The first response is stored for IDEMPOTENCY_TTL and replayed to any
+    retry with the same key and request. A retry arriving while the first
+    request is still running waits for its response, polling every
+    IDEMPOTENCY_POLL_SECONDS, and gets a 409 with Retry-After if none comes
+    within IDEMPOTENCY_LOCK_SECONDS. Server errors are not stored, so
+    those can be retried, a waiting retry included.
+    Keys and responses live in the 'idempotency' cache, which all workers
+    share. Keys sent by anonymous clients, who have nothing to scope them
+    by, are ignored.
+    """
+    @wraps(handler)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.META.get(HEADER)
+        if not key or not request.user.is_authenticated:
+            return handler(self, request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return Response(
+                {'detail': f'Idempotency-Key must be at most {MAX_KEY_LENGTH} characters'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        cache = caches['idempotency']
+        cache_key = _cache_key(request, key)
+        fingerprint = request_fingerprint(request)
+        deadline = time.monotonic() + settings.IDEMPOTENCY_LOCK_SECONDS
+        while not cache.add(f'{cache_key}:lock', True, settings.IDEMPOTENCY_LOCK_SECONDS):
+            stored = cache.get(cache_key)
+            if stored is not None:
+                return _replay(stored, fingerprint)
+            if time.monotonic() >= deadline:
+                response = Response(
+                    {'detail': 'A request with this Idempotency-Key is in progress'},
+                    status=status.HTTP_409_CONFLICT,
+                )
+                response['Retry-After'] = str(settings.IDEMPOTENCY_RETRY_AFTER)
+                return response
+            time.sleep(settings.IDEMPOTENCY_POLL_SECONDS)
+
+        try:
+            stored = cache.get(cache_key)
+            if stored is not None:
+                return _replay(stored, fingerprint)
+            response = handler(self, request, *args, **kwargs)
+            if response.status_code < 500:
+                cache.set(cache_key, {
+                    'fingerprint': fingerprint,
+                    'status': response.status_code,
+                    'data': json.loads(OrjsonRenderer().render(response.data) or 'null'),
+                    'headers': {name: response[name] for name in STORED_HEADERS if name in response},
+                }, settings.IDEMPOTENCY_TTL)
+            return response
+        finally:
+            cache.delete(f'{cache_key}:lock')
+    return wrapper
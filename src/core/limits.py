@@ -0,0 +1,182 @@
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+# SQLite calls the progress handler every this many virtual machine steps
+SQLITE_PROGRESS_STEPS = 1000
+# A PostgreSQL statement_timeout is set again once the budget left has
+# dropped this fraction below it
+STATEMENT_TIMEOUT_SLACK = 0.1
+
+
+def request_queue_ms(request, now=None):
+    """Return how long a request waited in front of us, from X-Request-Start
+
+    The header is set by the proxy as t=<timestamp>, in seconds,
+    milliseconds or microseconds since the epoch. None when it is absent.
+    """
+    value = request.META.get('HTTP_X_REQUEST_START', '')
+    if value.startswith('t='):
+        value = value[2:]
+    try:
+        started = float(value)
+    except ValueError:
+        return None
+    while started > 1e11:
+        started /= 1000
+    now = time.time() if now is None else now
+    return max((now - started) * 1000, 0)
+
+
+def query_timeout(milliseconds):
+    """Give a view, or one action of a viewset, its own query time budget"""
+    def decorate(view):
+        view.query_timeout_ms = milliseconds
+        return view
+    return decorate
+
+
+class AdmissionController:
+    """Keep track of the requests and queries running in this process
+
+    New requests are refused while more than ADMISSION_MAX_IN_FLIGHT
+    requests are running, or while the queries running right now have been
+    at it for over ADMISSION_MAX_DB_SECONDS together. Priority requests are
+    always let in. Only a worker serving requests concurrently, as gevent
+    workers do, ever has others running when one comes in.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queries = {}
+        self.in_flight = 0
+
+    def db_seconds(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return sum(now - started for started in self._queries.values())
+
+    def overloaded(self):
+        """Return why new requests should be turned away, or None"""
+        limit = settings.ADMISSION_MAX_IN_FLIGHT
+        if limit is not None and self.in_flight > limit:
+            return 'Too many requests in progress'
+        limit = settings.ADMISSION_MAX_DB_SECONDS
+        if limit is not None and self.db_seconds() > limit:
+            return 'The database is busy'
+        return None
+
+    def admit(self, priority=False):
+        """Let a request in, returning None, or the reason it was refused"""
+        with self._lock:
+            self.in_flight += 1
+        reason = None if priority else self.overloaded()
+        if reason is not None:
+            self.release()
+        return reason
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def query_started(self):
+        token = object()
+        with self._lock:
+            self._queries[token] = time.monotonic()
+        return token
+
+    def query_finished(self, token):
+        with self._lock:
+            self._queries.pop(token, None)
+
+
+admission = AdmissionController()
+
+
+class QueryBudget:
+    """Execute wrapper holding a view's queries to a time budget
+
+    On PostgreSQL the budget left becomes the connection's statement_timeout,
+    set again whenever it has dropped noticeably since; on SQLite a progress
+    handler interrupts queries running past the deadline. Every query is
+    also reported to the admission controller.
+    """
+
+    def __init__(self, milliseconds):
+        self.milliseconds = milliseconds
+        self.deadline = None if milliseconds is None else time.monotonic() + milliseconds / 1000
+        self.expired = False
+        self._limited = {}
+
+    def remaining_ms(self):
+        return max(int((self.deadline - time.monotonic()) * 1000), 1)
+
+    def _limit(self, connection, cursor):
+        raw, timeout_ms = self._limited.get(connection.alias, (None, None))
+        if connection.vendor == 'postgresql':
+            remaining = self.remaining_ms()
+            if raw is connection.connection and remaining >= timeout_ms * (1 - STATEMENT_TIMEOUT_SLACK):
+                return
+            cursor.execute('SET statement_timeout = %s', [remaining])
+            timeout_ms = remaining
+        elif raw is connection.connection:
+            return
+        elif connection.vendor == 'sqlite':
+            deadline = self.deadline
+            connection.connection.set_progress_handler(
+                lambda: time.monotonic() > deadline, SQLITE_PROGRESS_STEPS
+            )
+        self._limited[connection.alias] = (connection.connection, timeout_ms)
+
+    def __call__(self, execute, sql, params, many, context):
+        connection = context['connection']
+        if self.deadline is not None:
+            if time.monotonic() > self.deadline:
+                self.expired = True
+                raise DatabaseError('The query time budget of this request is spent')
+            self._limit(connection, context['cursor'].cursor)
+        token = admission.query_started()
+        try:
+            return execute(sql, params, many, context)
+        except DatabaseError:
+            if self.deadline is not None and time.monotonic() > self.deadline:
+                self.expired = True
+            raise
+        finally:
+            admission.query_finished(token)
+
+    def reset(self):
+        """Take the limits off the connections once the view is done"""
+        for alias, (raw, timeout_ms) in self._limited.items():
+            connection = connections[alias]
+            if connection.connection is not raw:
+                continue
+            if connection.vendor == 'sqlite':
+                raw.set_progress_handler(None, 0)
+                continue
+            try:
+                with raw.cursor() as cursor:
+                    cursor.execute('SET statement_timeout TO DEFAULT')
+            except Exception:
+                # Rather than hand on a connection that may still be limited
+                connection.close()
+        self._limited = {}
+
+
+@contextmanager
+def query_budget(milliseconds):
+    """Hold the queries made inside on any database to a time budget
+
+    None sets no limit, though the queries are still tracked for admission.
+    """
+    budget = QueryBudget(milliseconds)
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(budget))
+            yield budget
+    finally:
+        budget.reset()
@@ -0,0 +1,72 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.slow_queries import percentile
+
+# Run in a fresh interpreter so that nothing is imported or cached yet
+CHILD = '''
+import io, json, sys, time
+from wsgiref.util import setup_testing_defaults
+
+start = time.perf_counter()
+from recipe.wsgi import application
+imported = (time.perf_counter() - start) * 1000
+if sys.argv[1] == 'warm':
+    from core.warmup import open_connections
+    open_connections()
+
+paths, count, token = json.loads(sys.argv[2]), int(sys.argv[3]), sys.argv[4]
+latencies = []
+for index in range(count):
+    environ = {'PATH_INFO': paths[index % len(paths)], 'wsgi.input': io.BytesIO()}
+    if token:
+        environ['HTTP_AUTHORIZATION'] = f'Token {token}'
+    setup_testing_defaults(environ)
+    start = time.perf_counter()
+    body = application(environ, lambda status, headers, exc_info=None: None)
+    for chunk in body:
+        pass
+    if hasattr(body, 'close'):
+        body.close()
+    latencies.append((time.perf_counter() - start) * 1000)
+print(json.dumps({'import': imported, 'latencies': latencies}))
+'''
+
+
+class Command(BaseCommand):
+    """Compare the first requests of a new worker with and without warm-up"""
+    help = 'Time importing the WSGI app and its first requests, cold and warmed up'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=20)
+        parser.add_argument('--path', action='append', dest='paths')
+        parser.add_argument('--token', default='', help='API token sent with the requests')
+
+    def run(self, mode, paths, count, token):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+        env.pop('WSGI_WARM_UP', None)
+        if mode == 'warm':
+            env['WSGI_WARM_UP'] = '1'
+        output = subprocess.run(
+            [sys.executable, '-c', CHILD, mode, json.dumps(paths), str(count), token],
+            cwd=settings.BASE_DIR, env=env, stdout=subprocess.PIPE, check=True,
+        ).stdout
+        return json.loads(output.decode().strip().splitlines()[-1])
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or ['/health/', '/api/recipe/tags/', '/api/recipe/recipes/']
+        count = options['requests']
+        self.stdout.write(f'{count} requests over {", ".join(paths)}')
+        for mode in ('cold', 'warm'):
+            result = self.run(mode, paths, count, options['token'])
+            latencies = result['latencies']
+            self.stdout.write(
+                f'{mode:>5}: import {result["import"]:8.1f} ms  first {latencies[0]:8.1f} ms  '
+                f'p50 {percentile(latencies, 0.5):6.1f} ms  max {max(latencies):8.1f} ms  '
+                f'total {sum(latencies):8.1f} ms'
+            )
@@ -0,0 +1,72 @@
+import io
+import time
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from core.parsers import MessagePackParser, OrjsonParser
+from core.renderers import MessagePackRenderer, OrjsonRenderer, msgpack, orjson
+
+
+def sample_recipes(count, related=5):
+    """Build a list shaped like RecipeDetailSerializer output"""
+    def related_rows(start, name):
+        return [
+            OrderedDict([('id', start + offset), ('name', f'{name} {start + offset}'),
+                         ('recipe_count', 12)])
+            for offset in range(related)
+        ]
+    return [
+        OrderedDict([
+            ('id', recipe_id),
+            ('title', f'Recipe number {recipe_id} with a reasonably long title'),
+            ('ingredients', related_rows(recipe_id % 300, 'Ingredient')),
+            ('tags', related_rows(recipe_id % 40, 'Tag')),
+            ('time_minutes', recipe_id % 120),
+            ('price', f'{recipe_id % 100}.{recipe_id % 100:02d}'),
+            ('link', f'https://example.com/recipes/{recipe_id}'),
+            ('image', None),
+        ])
+        for recipe_id in range(1, count + 1)
+    ]
+
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000, result
+
+
+class Command(BaseCommand):
+    """Compare the API renderers and parsers on a large recipe list"""
+    help = 'Time rendering and parsing a recipe list with each renderer/parser pair'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipes', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        data = sample_recipes(options['recipes'])
+        pairs = [('drf json', JSONRenderer(), JSONParser())]
+        if orjson is not None:
+            pairs.append(('orjson', OrjsonRenderer(), OrjsonParser()))
+        if msgpack is not None:
+            pairs.append(('msgpack', MessagePackRenderer(), MessagePackParser()))
+
+        self.stdout.write(f'{options["recipes"]} recipes, best of {options["repeat"]}')
+        for name, renderer, parser in pairs:
+            render_ms, body = best_of(
+                options['repeat'], lambda: renderer.render(data, renderer.media_type)
+            )
+            parse_ms, _ = best_of(
+                options['repeat'], lambda: parser.parse(io.BytesIO(body), parser.media_type)
+            )
+            self.stdout.write(
+                f'{name:>10}: render {render_ms:8.1f} ms  parse {parse_ms:8.1f} ms  '
+                f'{len(body) / 1024:8.0f} KiB'
+            )
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from core.models import Recipe
+from core.similarity import refresh_neighbours
+
+
+class Command(BaseCommand):
+    """Precompute the similar recipes of every user"""
+    help = 'Rebuild the recipe neighbours table, one user at a time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        using = options['database']
+        users = options['users'] or Recipe.objects.using(using).order_by(
+            'user_id'
+        ).values_list('user_id', flat=True).distinct()
+        for user_id in users:
+            total = refresh_neighbours(user_id, using=using)
+            self.stdout.write(f'user {user_id}: {total} recipes ranked')
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from core.models import Recipe
+from recipe_app.documents import check_documents
+
+
+class Command(BaseCommand):
+    """Find recipe documents that drifted from the recipes they render"""
+    help = 'Compare stored recipe documents with freshly rendered ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='Rebuild missing and stale documents')
+        parser.add_argument('--user', type=int, action='append', dest='users')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        queryset = Recipe.objects.using(options['database']).all()
+        if options['users']:
+            queryset = queryset.filter(user_id__in=options['users'])
+        result = check_documents(queryset, repair=options['repair'], batch_size=options['batch_size'])
+        action = 'repaired' if options['repair'] else 'found'
+        self.stdout.write(
+            f"{result['checked']} recipes checked: {result['missing']} missing and "
+            f"{result['stale']} stale documents {action}"
+        )
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from core.models import UserShard
+from core.sharding import reserve_id_range
+
+
+class Command(BaseCommand):
+    """Bring every shard's schema up to date"""
+    help = 'Migrate each database in DATABASE_SHARDS and reserve its id range'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--map-existing', action='store_true',
+            help="Map users without a shard to 'default', where their rows are",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_SHARDS:
+            raise CommandError('DATABASE_SHARDS is empty')
+        call_command('migrate', database=DEFAULT_DB_ALIAS, verbosity=options['verbosity'])
+        for alias in settings.DATABASE_SHARDS:
+            self.stdout.write(f'migrating {alias}')
+            call_command('migrate', database=alias, verbosity=options['verbosity'])
+            try:
+                reserve_id_range(alias)
+            except NotImplementedError as error:
+                raise CommandError(error)
+        if options['map_existing']:
+            unmapped = get_user_model().objects.using(DEFAULT_DB_ALIAS).filter(
+                shard__isnull=True
+            ).values_list('id', flat=True)
+            mapped = UserShard.objects.using(DEFAULT_DB_ALIAS).bulk_create([
+                UserShard(user_id=user_id, shard=DEFAULT_DB_ALIAS) for user_id in unmapped
+            ])
+            self.stdout.write(f"{len(mapped)} users mapped to 'default'")
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from core.sharding import move_user
+
+
+class Command(BaseCommand):
+    """Rebalance shards by moving users' rows while they stay online"""
+    help = "Move users' recipes, tags and ingredients to another shard"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users', required=True)
+        parser.add_argument('--to', dest='target', required=True)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--no-wait', action='store_false', dest='wait',
+            help='Skip waiting for cached placements to expire (single process only)',
+        )
+
+    def handle(self, *args, **options):
+        target = options['target']
+        if target not in settings.DATABASE_SHARDS and target != DEFAULT_DB_ALIAS:
+            raise CommandError(f'{target} is not a shard')
+        for user_id in options['users']:
+            moved = move_user(
+                user_id, target, wait=options['wait'],
+                batch_size=options['batch_size'], log=self.stdout.write,
+            )
+            if not moved:
+                self.stdout.write(f'user {user_id} is already on {target}')
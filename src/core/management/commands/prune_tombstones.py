@@ -0,0 +1,23 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+
+from core.sync import prune_tombstones
+
+
+class Command(BaseCommand):
+    """Remove old tombstones from the sync change log"""
+    help = 'Delete the tombstones logged more than SYNC_TOMBSTONE_DAYS days ago'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None)
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else settings.SYNC_TOMBSTONE_DAYS
+        before = timezone.now() - datetime.timedelta(days=days)
+        pruned = prune_tombstones(before, using=options['database'])
+        self.stdout.write(f'{pruned} tombstones older than {days} days pruned')
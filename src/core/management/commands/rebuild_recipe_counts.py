@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from core.cache import bump_user_version
+from core.counters import drifted_recipe_counts, rebuild_recipe_counts, recipe_relations
+from core.sync import record_changes
+
+
+class Command(BaseCommand):
+    """Rebuild the Tag and Ingredient recipe counters from the relation tables
+
+    Only the counters that drifted are rewritten. They are logged as
+    changes and their users' cached results are dropped, as for any other
+    change to the rows.
+    """
+    help = 'Recompute recipe_count for every tag and ingredient'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        using = options['database']
+        users = set()
+        with transaction.atomic(using=using):
+            for model, _, _ in recipe_relations():
+                updated = 0
+                for user_id, ids in drifted_recipe_counts(model, using=using).items():
+                    updated += rebuild_recipe_counts(model, ids, using=using)
+                    record_changes(user_id, model, ids, using=using)
+                    users.add(user_id)
+                self.stdout.write(f'{model.__name__}: {updated} rows recounted')
+        for user_id in sorted(users):
+            bump_user_version(user_id)
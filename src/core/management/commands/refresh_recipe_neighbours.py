@@ -0,0 +1,36 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, close_old_connections
+
+from core.similarity import process_refresh_queue
+
+
+class Command(BaseCommand):
+    """Refresh the neighbours of the recipes queued by relation changes"""
+    help = (
+        'Work through the queued neighbour refreshes of every database, or those given; '
+        'with --interval keep polling the queues every so many seconds'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append', dest='databases')
+        parser.add_argument('--interval', type=float, default=None)
+
+    def handle(self, *args, **options):
+        databases = options['databases'] or list(dict.fromkeys([DEFAULT_DB_ALIAS] + list(settings.DATABASE_SHARDS)))
+        while True:
+            done = 0
+            for alias in databases:
+                while True:
+                    refreshed = process_refresh_queue(using=alias)
+                    done += refreshed
+                    if not refreshed:
+                        break
+                    self.stdout.write(f'{alias}: {refreshed} queued recipes refreshed')
+            if options['interval'] is None:
+                return
+            close_old_connections()
+            if not done:
+                time.sleep(options['interval'])
@@ -0,0 +1,50 @@
+import json
+import os
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.slow_queries import percentile
+
+
+class Command(BaseCommand):
+    """Summarise the slow query log"""
+    help = 'Group logged slow queries by SQL fingerprint with counts and p95 times'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=settings.SLOW_QUERY_LOG_FILE)
+        parser.add_argument('--top', type=int, default=20)
+
+    def log_files(self, path):
+        rotated = [f'{path}.{index}' for index in range(settings.SLOW_QUERY_LOG_BACKUPS, 0, -1)]
+        return [name for name in rotated + [path] if os.path.exists(name)]
+
+    def handle(self, *args, **options):
+        files = self.log_files(options['file'])
+        if not files:
+            raise CommandError(f'No slow query log at {options["file"]}')
+        durations = defaultdict(list)
+        sites = defaultdict(Counter)
+        plans = Counter()
+        for name in files:
+            with open(name) as log:
+                for line in log:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    key = entry['fingerprint']
+                    durations[key].append(entry['duration_ms'])
+                    sites[key][f"{entry['view']}:{entry['action']}"] += 1
+                    plans[key] += 'plan' in entry
+
+        ranked = sorted(durations.items(), key=lambda item: sum(item[1]), reverse=True)
+        for key, timings in ranked[:options['top']]:
+            site, _ = sites[key].most_common(1)[0]
+            self.stdout.write(
+                f'{len(timings)} queries  p95 {percentile(timings, 0.95):.1f} ms  '
+                f'max {max(timings):.1f} ms  total {sum(timings):.1f} ms  '
+                f'plans {plans[key]}  from {site}'
+            )
+            self.stdout.write(f'    {key}')
@@ -0,0 +1,180 @@
+from django.conf import settings
+from django.db import DatabaseError
+from django.http import JsonResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+from core.compression import IDENTITY, compress_cached, compress_stream, is_compressible, negotiate
+from core.db.pool import PoolTimeout
+from core.db_routers import pin_to_primary, routing_context
+from core.limits import admission, query_budget, request_queue_ms
+from core.sharding import ShardMovingError
+from core.slow_queries import call_site, slow_query_log
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def unavailable(detail, retry_after):
+    response = JsonResponse({'detail': detail}, status=503)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+class DatabaseRoutingMiddleware(MiddlewareMixin):
+    """Route the queries of each view by its user and method
+
+    Only API views are routed by their user: the admin and other plain
+    views work on 'default' whoever is signed in. Safe requests to views
+    with replica_reads set may read from replicas. After an unsafe request
+    the user is pinned to the primary for a short while so that their next
+    reads see what they just wrote. Writes made while the user is being
+    moved between shards get a 503.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'cls', None)
+        if view_class is None:
+            return None
+        replica = request.method in SAFE_METHODS and getattr(view_class, 'replica_reads', False)
+        request._routing_context = routing_context(request, replica_reads=replica)
+        request._routing_context.__enter__()
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, ShardMovingError):
+            return unavailable(str(exception), 1)
+        return None
+
+    def process_response(self, request, response):
+        context = getattr(request, '_routing_context', None)
+        if context is not None:
+            context.__exit__(None, None, None)
+        user = getattr(request, 'user', None)
+        if request.method not in SAFE_METHODS and user is not None and user.is_authenticated:
+            pin_to_primary(user.id)
+        return response
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """Compress text, JSON and MessagePack responses with brotli or gzip
+
+    Bodies shorter than COMPRESSION_MIN_LENGTH are sent as they are and
+    streamed bodies are compressed chunk by chunk. Strong ETags get the
+    coding appended so each variant keeps its own validator. The chosen
+    coding is kept on request.content_coding; the request's headers are
+    left as the client sent them.
+    """
+
+    def process_request(self, request):
+        request.content_coding = negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+
+    def process_response(self, request, response):
+        if response.has_header('Content-Encoding') or response.has_header('Content-Range'):
+            return response
+        if not is_compressible(response.get('Content-Type', '')):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding', ))
+        coding = getattr(request, 'content_coding', IDENTITY)
+        if coding == IDENTITY:
+            return response
+
+        if response.streaming:
+            response.streaming_content = compress_stream(coding, response.streaming_content)
+            del response['Content-Length']
+        else:
+            if len(response.content) < settings.COMPRESSION_MIN_LENGTH:
+                return response
+            compressed = compress_cached(coding, response.content)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = f'{etag[:-1]}-{coding}"'
+        response['Content-Encoding'] = coding
+        return response
+
+
+class SlowQueryMiddleware(MiddlewareMixin):
+    """Log the view's queries slower than SLOW_QUERY_THRESHOLD_MS
+
+    Turned off when the threshold is None.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if settings.SLOW_QUERY_THRESHOLD_MS is None:
+            return
+        request._slow_query_log = slow_query_log(call_site(request, view_func))
+        request._slow_query_log.__enter__()
+
+    def process_response(self, request, response):
+        context = getattr(request, '_slow_query_log', None)
+        if context is not None:
+            context.__exit__(None, None, None)
+        return response
+
+
+class AdmissionMiddleware(MiddlewareMixin):
+    """Shed load with a 503 before this process falls behind
+
+    Requests are refused when they waited over ADMISSION_MAX_QUEUE_MS in
+    front of us, as told by the proxy's X-Request-Start, or when the
+    admission controller finds this process too busy. Requests that time
+    out waiting for a pooled connection get a 503 too. Paths starting with
+    one of ADMISSION_PRIORITY_PATHS are always served.
+    """
+
+    def process_request(self, request):
+        priority = request.path.startswith(settings.ADMISSION_PRIORITY_PATHS)
+        if not priority and settings.ADMISSION_MAX_QUEUE_MS is not None:
+            queued = request_queue_ms(request)
+            if queued is not None and queued > settings.ADMISSION_MAX_QUEUE_MS:
+                return unavailable('Request waited too long to be served', settings.ADMISSION_RETRY_AFTER)
+        reason = admission.admit(priority)
+        if reason is not None:
+            return unavailable(reason, settings.ADMISSION_RETRY_AFTER)
+        request._admitted = True
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, PoolTimeout):
+            return unavailable(str(exception), settings.ADMISSION_RETRY_AFTER)
+        return None
+
+    def process_response(self, request, response):
+        if getattr(request, '_admitted', False):
+            request._admitted = False
+            admission.release()
+        return response
+
+
+class QueryTimeoutMiddleware(MiddlewareMixin):
+    """Hold each view's queries to its query_timeout_ms budget
+
+    Viewset actions may have their own, set with core.limits.query_timeout.
+    Views without one get QUERY_TIMEOUT_MS. A request whose budget runs
+    out gets a 503 instead of tying up its worker.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view = getattr(view_func, 'cls', None) or view_func
+        actions = getattr(view_func, 'actions', None) or {}
+        handler = getattr(view, actions.get(request.method.lower(), ''), None)
+        milliseconds = getattr(
+            handler, 'query_timeout_ms', getattr(view, 'query_timeout_ms', settings.QUERY_TIMEOUT_MS)
+        )
+        request._query_budget_context = query_budget(milliseconds)
+        request._query_budget = request._query_budget_context.__enter__()
+
+    def process_exception(self, request, exception):
+        budget = getattr(request, '_query_budget', None)
+        if isinstance(exception, DatabaseError) and budget is not None and budget.expired:
+            return unavailable('The request took too long', settings.ADMISSION_RETRY_AFTER)
+        return None
+
+    def process_response(self, request, response):
+        context = getattr(request, '_query_budget_context', None)
+        if context is not None:
+            request._query_budget_context = None
+            context.__exit__(None, None, None)
+        return response
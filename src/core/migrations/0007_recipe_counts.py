@@ -0,0 +1,49 @@
+# Generated by Django 2.1.11 on 2026-10-19 08:08
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_recipe_counts(apps, schema_editor):
+    """Count the recipes already using each tag and ingredient"""
+    Recipe = apps.get_model('core', 'Recipe')
+    using = schema_editor.connection.alias
+    for model_name, field in (('Tag', 'tags'), ('Ingredient', 'ingredients')):
+        model = apps.get_model('core', model_name)
+        through = getattr(Recipe, field).through
+        column = f'{model_name.lower()}_id'
+        usage = through.objects.filter(**{column: OuterRef('pk')}).order_by().values(
+            column
+        ).annotate(total=Count('id')).values('total')
+        model.objects.using(using).update(
+            recipe_count=Coalesce(Subquery(usage, output_field=IntegerField()), 0)
+        )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_recipe_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingredient',
+            name='recipe_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='recipe_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='ingredient',
+            index=models.Index(fields=['user', 'recipe_count'], name='core_ingred_user_id_de1121_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['user', 'recipe_count'], name='core_tag_user_id_699afc_idx'),
+        ),
+        migrations.RunPython(backfill_recipe_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.1.11 on 2026-10-19 08:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_recipe_counts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['user', 'price'], name='core_recipe_user_id_72b3b3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['user', 'time_minutes'], name='core_recipe_user_id_ca9f7e_idx'),
+        ),
+    ]
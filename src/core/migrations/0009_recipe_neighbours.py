@@ -0,0 +1,31 @@
+# Generated by Django 2.1.11 on 2026-10-19 08:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_recipe_range_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipeNeighbour',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('neighbour', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Recipe')),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='neighbours', to='core.Recipe')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='recipeneighbour',
+            index=models.Index(fields=['recipe', '-score'], name='core_recipe_recipe__69948a_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='recipeneighbour',
+            unique_together={('recipe', 'neighbour')},
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 2.1.11 on 2026-10-19 08:14
+
+import unicodedata
+
+from django.db import migrations, models
+from django.db.models import Case, Value, When
+
+BATCH_SIZE = 1000
+
+
+def normalize_name(name):
+    """Copy of core.models.normalize_name as it was for this migration"""
+    decomposed = unicodedata.normalize('NFKD', name)
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return stripped.casefold()
+
+
+def backfill_search_names(apps, schema_editor):
+    """Store the normalized name of the existing tags and ingredients
+
+    Rows are updated a batch at a time, with one UPDATE ... CASE per batch.
+    """
+    using = schema_editor.connection.alias
+    for model_name in ('Tag', 'Ingredient'):
+        model = apps.get_model('core', model_name)
+        rows = model.objects.using(using).order_by('id').values_list('id', 'name')
+        last = 0
+        while True:
+            batch = list(rows.filter(id__gt=last)[:BATCH_SIZE])
+            if not batch:
+                break
+            last = batch[-1][0]
+            model.objects.using(using).filter(id__in=[row_id for row_id, name in batch]).update(
+                search_name=Case(
+                    *[When(id=row_id, then=Value(normalize_name(name))) for row_id, name in batch],
+                    output_field=models.CharField(),
+                )
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_recipe_neighbours'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingredient',
+            name='search_name',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='search_name',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(backfill_search_names, migrations.RunPython.noop),
+    ]
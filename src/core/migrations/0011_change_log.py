@@ -0,0 +1,48 @@
+# Generated by Django 2.1.11 on 2026-10-19 08:15
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def seed_change_log(apps, schema_editor):
+    """Log every existing object so a first sync returns the full library"""
+    Change = apps.get_model('core', 'Change')
+    using = schema_editor.connection.alias
+    for model_name in ('Recipe', 'Tag', 'Ingredient'):
+        model = apps.get_model('core', model_name)
+        rows = model.objects.using(using).order_by('id').values_list('id', 'user_id')
+        Change.objects.using(using).bulk_create(
+            (Change(user_id=user_id, kind=model_name.lower(), object_id=object_id)
+             for object_id, user_id in rows.iterator()),
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_search_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('recipe', 'Recipe'), ('tag', 'Tag'), ('ingredient', 'Ingredient')], max_length=16)),
+                ('object_id', models.IntegerField()),
+                ('deleted', models.BooleanField(default=False)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['user', 'id'], name='core_change_user_id_dfd788_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['kind', 'object_id'], name='core_change_kind_8e9fca_idx'),
+        ),
+        migrations.RunPython(seed_change_log, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.11 on 2026-10-19 08:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_change_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='change',
+            name='created',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.1.11 on 2026-10-19 08:25
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_change_created'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.CharField(max_length=64)),
+                ('epoch', models.PositiveIntegerField(default=0)),
+                ('moving', models.BooleanField(default=False)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='shard', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
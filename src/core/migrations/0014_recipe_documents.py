@@ -0,0 +1,22 @@
+# Generated by Django 2.1.11 on 2026-10-19 08:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_user_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipeDocument',
+            fields=[
+                ('recipe', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='document', serialize=False, to='core.Recipe')),
+                ('detail', models.TextField()),
+                ('summary', models.TextField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.1.11 on 2026-10-19 09:07
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_recipe_documents'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('pruned_through', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='logged_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
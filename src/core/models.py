@@ -1,6 +1,8 @@
 import uuid
 import os
+import unicodedata
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.conf import settings
 
@@ -12,6 +14,12 @@ def recipe_image_file_path(instance, filename):
     return os.path.join('uploads/recipe/', filename)
 
 
+def normalize_name(name):
+    """Fold case and strip accents so names can be matched by prefix"""
+    decomposed = unicodedata.normalize('NFKD', name)
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return stripped.casefold()
+
 
 class UserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
@@ -47,6 +55,15 @@ class Tag(models.Model):
     """Tag to ge used for a recipe"""
     name = models.CharField(max_length=255)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    recipe_count = models.PositiveIntegerField(default=0, editable=False)
+    search_name = models.CharField(max_length=255, db_index=True, editable=False, default='')
+
+    class Meta:
+        indexes = [models.Index(fields=['user', 'recipe_count'])]
+
+    def save(self, *args, **kwargs):
+        self.search_name = normalize_name(self.name)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.name
@@ -56,6 +73,15 @@ class Ingredient(models.Model):
     """Ingredients to be used in a recipe"""
     name = models.CharField(max_length=255)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    recipe_count = models.PositiveIntegerField(default=0, editable=False)
+    search_name = models.CharField(max_length=255, db_index=True, editable=False, default='')
+
+    class Meta:
+        indexes = [models.Index(fields=['user', 'recipe_count'])]
+
+    def save(self, *args, **kwargs):
+        self.search_name = normalize_name(self.name)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         """String representation"""
@@ -72,8 +98,125 @@ class Recipe(models.Model):
     tags = models.ManyToManyField('Tag')
     image = models.ImageField(null=True, upload_to=recipe_image_file_path)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'price']),
+            models.Index(fields=['user', 'time_minutes']),
+        ]
 
     def __str__(self):
         return self.title
 
 
+class RecipeNeighbour(models.Model):
+    """Precomputed similarity between two recipes of the same user"""
+    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name='neighbours')
+    neighbour = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = ('recipe', 'neighbour')
+        indexes = [models.Index(fields=['recipe', '-score'])]
+
+    def __str__(self):
+        return f'{self.recipe_id} -> {self.neighbour_id} ({self.score:.3f})'
+
+
+class NeighbourRefresh(models.Model):
+    """A recipe whose neighbours are due to be refreshed
+
+    Queued when the recipe's tags or ingredients change, in the same
+    transaction, and taken off by the refresh_recipe_neighbours job. The
+    recipe may be gone by then, so recipe_id is not a foreign key.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+')
+    recipe_id = models.IntegerField()
+
+    def __str__(self):
+        return f'refresh neighbours of {self.recipe_id}'
+
+
+class RecipeDocument(models.Model):
+    """Rendered JSON of a recipe, kept up to date when RECIPE_DOCUMENTS is on
+
+    detail is the recipe's detail representation and summary its list one.
+    """
+    recipe = models.OneToOneField(
+        Recipe, on_delete=models.CASCADE, primary_key=True, related_name='document'
+    )
+    detail = models.TextField()
+    summary = models.TextField()
+
+    def __str__(self):
+        return f'document of recipe {self.recipe_id}'
+
+
+class Change(models.Model):
+    """Latest change to one of a user's recipes, tags or ingredients
+
+    The auto-incrementing id is the sync sequence. Each object keeps only
+    its newest row, and a deleted object keeps a tombstone row until
+    prune_tombstones removes it. created stays set through the updates
+    that replace a creation's row, so clients that missed the creation
+    still see it; clients should upsert on both.
+    """
+    RECIPE = 'recipe'
+    TAG = 'tag'
+    INGREDIENT = 'ingredient'
+    KIND_CHOICES = ((RECIPE, 'Recipe'), (TAG, 'Tag'), (INGREDIENT, 'Ingredient'))
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    object_id = models.IntegerField()
+    created = models.BooleanField(default=False)
+    deleted = models.BooleanField(default=False)
+    logged_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'id']),
+            models.Index(fields=['kind', 'object_id']),
+        ]
+
+    @property
+    def action(self):
+        if self.deleted:
+            return 'deleted'
+        return 'created' if self.created else 'updated'
+
+    def __str__(self):
+        return f'{self.kind} {self.object_id} {self.action}'
+
+
+class SyncState(models.Model):
+    """Change log bookkeeping of one user, next to their Change rows
+
+    Every write to the user's change log locks this row first, so those
+    writes commit in the order of the ids they log and a client synced up
+    to an id never misses a change logged below it afterwards.
+    pruned_through is the newest tombstone prune_tombstones removed.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='+'
+    )
+    pruned_through = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'change log of user {self.user_id}'
+
+
+class UserShard(models.Model):
+    """Database alias holding a user's recipes, tags and ingredients
+
+    Lives on 'default' only. epoch counts the moves between shards, and
+    moving is set while a move is being finished.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='shard'
+    )
+    shard = models.CharField(max_length=64)
+    epoch = models.PositiveIntegerField(default=0)
+    moving = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f'{self.user_id} -> {self.shard}'
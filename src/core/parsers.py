@@ -0,0 +1,28 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser
+
+from core.renderers import MessagePackRenderer, orjson, msgpack
+
+
+class OrjsonParser(JSONParser):
+    """JSON parser decoding with orjson, falling back to DRF's when missing"""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if orjson is None:
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
+
+
+class MessagePackParser(BaseParser):
+    """Parse MessagePack request bodies sent by internal services"""
+    media_type = 'application/msgpack'
+    renderer_class = MessagePackRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except ValueError as exc:
+            raise ParseError(f'MessagePack parse error - {exc}')
@@ -0,0 +1,121 @@
+import datetime
+import decimal
+import json
+import uuid
+
+from django.db.models.query import QuerySet
+from django.utils.encoding import force_text
+from django.utils.functional import Promise
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+class RawJSON:
+    """JSON text that is written into a response as it is"""
+    __slots__ = ('text', )
+
+    def __init__(self, text):
+        self.text = text
+
+
+# Whether OrjsonRenderer splices RawJSON in without decoding it
+RAW_JSON_SUPPORTED = hasattr(orjson, 'Fragment')
+
+
+def encode_default(obj):
+    """Convert the values orjson and msgpack lack a type for, like DRF's encoder"""
+    if isinstance(obj, RawJSON):
+        return json.loads(obj.text)
+    if isinstance(obj, Promise):
+        return force_text(obj)
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, datetime.datetime):
+        representation = obj.isoformat()
+        if representation.endswith('+00:00'):
+            representation = representation[:-6] + 'Z'
+        return representation
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, datetime.timedelta):
+        return str(obj.total_seconds())
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8')
+    if isinstance(obj, (QuerySet, set, frozenset)):
+        return list(obj)
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    if hasattr(obj, 'items'):
+        return dict(obj)
+    if hasattr(obj, '__iter__'):
+        return list(obj)
+    raise TypeError(f'{type(obj).__name__} is not serializable')
+
+
+def _orjson_default(obj):
+    if isinstance(obj, RawJSON):
+        return orjson.Fragment(obj.text)
+    return encode_default(obj)
+
+
+class OrjsonRenderer(JSONRenderer):
+    """JSON renderer encoding with orjson, falling back to DRF's when missing
+
+    Decimals, UUIDs and dates come out as with DRF's encoder. Indented
+    output, as asked for by the browsable API, is always two spaces.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        if data is None:
+            return b''
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+        if self.get_indent(accepted_media_type or '', renderer_context or {}):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, default=_orjson_default, option=option)
+
+
+class MessagePackRenderer(BaseRenderer):
+    """Render responses as MessagePack for internal services"""
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=encode_default, use_bin_type=True)
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Lets views accept text/event-stream requests and stream the events themselves"""
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+
+class ZipRenderer(BaseRenderer):
+    """Lets views accept application/zip requests and stream the archive themselves"""
+    media_type = 'application/zip'
+    format = 'zip'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
@@ -0,0 +1,247 @@
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+
+from core.counters import recipe_relations
+from core.models import (
+    Tag, Ingredient, Recipe, RecipeDocument, RecipeNeighbour, NeighbourRefresh, Change, SyncState,
+    UserShard,
+)
+from core.similarity import refresh_neighbours
+from core.sync import record_changes
+
+Placement = namedtuple('Placement', 'shard epoch moving')
+
+SHARDED_MODELS = (
+    'tag', 'ingredient', 'recipe', 'recipe_tags', 'recipe_ingredients',
+    'recipedocument', 'recipeneighbour', 'neighbourrefresh', 'change', 'syncstate',
+)
+
+
+class ShardMovingError(Exception):
+    """Raised on writes for a user whose rows are being moved between shards"""
+
+
+def is_sharded(app_label, model_name):
+    """Tell whether a model's rows live on their owner's shard"""
+    return app_label == 'core' and model_name in SHARDED_MODELS
+
+
+def sharded_models():
+    """Return the sharded models in the order their rows can be inserted"""
+    return (
+        (Tag, Ingredient, Recipe)
+        + tuple(through for model, through, column in recipe_relations())
+        + (RecipeDocument, RecipeNeighbour, NeighbourRefresh, SyncState, Change)
+    )
+
+
+def _placement_key(user_id):
+    return f'user-shard:{user_id}'
+
+
+def mirror_user(user_id, alias):
+    """Copy the user row to a shard, where it anchors the foreign keys
+
+    The copy is not kept up to date: only its primary key matters.
+    """
+    User = get_user_model()
+    if alias == DEFAULT_DB_ALIAS or User.objects.using(alias).filter(pk=user_id).exists():
+        return
+    user = User.objects.using(DEFAULT_DB_ALIAS).get(pk=user_id)
+    User.objects.using(alias).bulk_create([user])
+
+
+def shard_for_user(user_id):
+    """Return the user's Placement, giving new users a shard on first use
+
+    Placements are cached for SHARD_MAP_CACHE_SECONDS, which is how long
+    move_user waits for every process to notice a placement change.
+    """
+    key = _placement_key(user_id)
+    placement = cache.get(key)
+    if placement is None:
+        shards = settings.DATABASE_SHARDS
+        row, created = UserShard.objects.using(DEFAULT_DB_ALIAS).get_or_create(
+            user_id=user_id, defaults={'shard': shards[user_id % len(shards)]}
+        )
+        if created:
+            mirror_user(user_id, row.shard)
+        placement = Placement(row.shard, row.epoch, row.moving)
+        cache.set(key, placement, settings.SHARD_MAP_CACHE_SECONDS)
+    return Placement(*placement)
+
+
+def user_epoch(user_id):
+    """Return how many times the user was moved, 0 when sharding is off"""
+    if not settings.DATABASE_SHARDS:
+        return 0
+    return shard_for_user(user_id).epoch
+
+
+def id_floor(alias):
+    """Return where the ids of rows created on a shard start
+
+    Each shard hands out ids from its own SHARD_ID_BLOCK sized range so
+    rows keep their ids, and clients their references, when moved.
+    """
+    shards = [DEFAULT_DB_ALIAS]
+    shards += [shard for shard in settings.DATABASE_SHARDS if shard != DEFAULT_DB_ALIAS]
+    return shards.index(alias) * settings.SHARD_ID_BLOCK
+
+
+def reserve_id_range(alias):
+    """Start the id sequences of the sharded tables at the shard's floor"""
+    floor = id_floor(alias)
+    if not floor:
+        return
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        for model in sharded_models():
+            if not isinstance(model._meta.pk, models.AutoField):
+                continue
+            table = model._meta.db_table
+            cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {connection.ops.quote_name(table)}')
+            start = max(floor, cursor.fetchone()[0])
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), %s)", [table, start])
+            elif connection.vendor == 'sqlite':
+                cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [start, table])
+                if not cursor.rowcount:
+                    cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, start])
+            else:
+                raise NotImplementedError(f'Cannot set id sequences on {connection.vendor}')
+
+
+def _user_rows(model, user_id, using):
+    queryset = model.objects.using(using)
+    if model in (Tag, Ingredient, Recipe, NeighbourRefresh, SyncState, Change):
+        return queryset.filter(user_id=user_id)
+    return queryset.filter(recipe__user_id=user_id)
+
+
+def _copy_rows(queryset, target, batch_size):
+    """Insert the queryset's rows on the target keeping their primary keys"""
+    last = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last).order_by('pk')[:batch_size])
+        if not batch:
+            return
+        queryset.model.objects.using(target).bulk_create(batch)
+        last = batch[-1].pk
+
+
+def _upsert_rows(model, ids, source, target):
+    """Make the target's copies of the given rows match the source"""
+    fields = [field.attname for field in model._meta.concrete_fields if not field.primary_key]
+    rows = list(model.objects.using(source).filter(pk__in=ids))
+    existing = set(model.objects.using(target).filter(pk__in=ids).values_list('pk', flat=True))
+    for row in rows:
+        if row.pk in existing:
+            model.objects.using(target).filter(pk=row.pk).update(
+                **{name: getattr(row, name) for name in fields}
+            )
+    model.objects.using(target).bulk_create([row for row in rows if row.pk not in existing])
+
+
+def _catch_up(user_id, since, source, target, batch_size):
+    """Apply the source changes logged after since to the target's copy"""
+    changes = Change.objects.using(source).filter(user_id=user_id, id__gt=since)
+    updated = {kind: set() for kind, name in Change.KIND_CHOICES}
+    deleted = {kind: set() for kind, name in Change.KIND_CHOICES}
+    for change in changes:
+        (deleted if change.deleted else updated)[change.kind].add(change.object_id)
+
+    _upsert_rows(Tag, updated[Change.TAG], source, target)
+    _upsert_rows(Ingredient, updated[Change.INGREDIENT], source, target)
+    _upsert_rows(Recipe, updated[Change.RECIPE], source, target)
+    stale_recipes = updated[Change.RECIPE] | deleted[Change.RECIPE]
+    for model, through, column in recipe_relations():
+        through.objects.using(target).filter(recipe_id__in=stale_recipes)._raw_delete(target)
+        kind = Change.TAG if model is Tag else Change.INGREDIENT
+        through.objects.using(target).filter(**{f'{column}__in': deleted[kind]})._raw_delete(target)
+        _copy_rows(through.objects.using(source).filter(
+            recipe_id__in=updated[Change.RECIPE]
+        ), target, batch_size)
+    RecipeDocument.objects.using(target).filter(
+        recipe_id__in=deleted[Change.RECIPE]
+    )._raw_delete(target)
+    for model, kind in ((Recipe, Change.RECIPE), (Tag, Change.TAG), (Ingredient, Change.INGREDIENT)):
+        model.objects.using(target).filter(pk__in=deleted[kind])._raw_delete(target)
+
+
+def _set_placement(user_id, **fields):
+    UserShard.objects.using(DEFAULT_DB_ALIAS).filter(user_id=user_id).update(**fields)
+    cache.delete(_placement_key(user_id))
+
+
+def delete_user_rows(user_id, using):
+    """Delete every sharded row of the user from a database"""
+    with transaction.atomic(using=using):
+        for model in reversed(sharded_models()):
+            _user_rows(model, user_id, using)._raw_delete(using)
+
+
+def purge_user(user_id):
+    """Remove a deleted user's rows and user row copies from every shard"""
+    User = get_user_model()
+    for alias in settings.DATABASE_SHARDS:
+        if alias == DEFAULT_DB_ALIAS:
+            continue
+        delete_user_rows(user_id, alias)
+        User.objects.using(alias).filter(pk=user_id)._raw_delete(alias)
+    cache.delete(_placement_key(user_id))
+
+
+def move_user(user_id, target, wait=True, batch_size=1000, log=None):
+    """Move the user's rows to another shard while they keep using the API
+
+    Rows are first copied while the user works on the source as usual.
+    Writes are then refused for a short freeze in which the changes
+    logged since the copy started are applied to the target, after which
+    the user is switched over and the source rows removed. The change log
+    is rebuilt on the target and the user's epoch bumped, so clients
+    holding older sync tokens do one full sync.
+    """
+    log = log or (lambda message: None)
+    pause = settings.SHARD_MAP_CACHE_SECONDS if wait else 0
+    source = shard_for_user(user_id).shard
+    if source == target:
+        return False
+    mirror_user(user_id, target)
+    delete_user_rows(user_id, target)
+
+    since = Change.objects.using(source).filter(user_id=user_id).order_by('-id').values_list(
+        'id', flat=True
+    ).first() or 0
+    log(f'copying user {user_id} from {source} to {target}')
+    with transaction.atomic(using=target):
+        for model in (Tag, Ingredient, Recipe) + tuple(
+            through for model, through, column in recipe_relations()
+        ):
+            _copy_rows(_user_rows(model, user_id, source), target, batch_size)
+
+    log('freezing writes')
+    _set_placement(user_id, moving=True)
+    time.sleep(pause)
+    try:
+        with transaction.atomic(using=target):
+            _catch_up(user_id, since, source, target, batch_size)
+            refresh_neighbours(user_id, using=target, batch_size=batch_size)
+            for model in (Tag, Ingredient, Recipe):
+                ids = _user_rows(model, user_id, target).values_list('id', flat=True)
+                record_changes(user_id, model, ids, using=target)
+    except Exception:
+        _set_placement(user_id, moving=False)
+        raise
+    epoch = UserShard.objects.using(DEFAULT_DB_ALIAS).get(user_id=user_id).epoch
+    _set_placement(user_id, shard=target, epoch=epoch + 1, moving=False)
+
+    log(f'switched to {target}, removing rows from {source}')
+    time.sleep(pause)
+    delete_user_rows(user_id, source)
+    return True
@@ -0,0 +1,127 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from core.cache import bump_user_version
+from core.counters import (
+    adjust_recipe_counts, recipe_relations, relation_for_model, relation_for_through
+)
+from core.models import Tag, Ingredient, Recipe, RecipeNeighbour, User
+from core.sharding import purge_user
+from core.similarity import schedule_refresh
+from core.sync import record_changes
+
+
+def _linked_ids(through, column, instance, reverse, pk_set, using):
+    """Return the ids on the other side that are really linked to instance"""
+    if reverse:
+        queryset = through.objects.using(using).filter(**{column: instance.pk})
+        if pk_set is not None:
+            queryset = queryset.filter(recipe_id__in=pk_set)
+        return set(queryset.values_list('recipe_id', flat=True))
+    queryset = through.objects.using(using).filter(recipe_id=instance.pk)
+    if pk_set is not None:
+        queryset = queryset.filter(**{f'{column}__in': pk_set})
+    return set(queryset.values_list(column, flat=True))
+
+
+@receiver(m2m_changed)
+def recipe_relations_changed(sender, instance, action, reverse, pk_set, using, **kwargs):
+    """Propagate a change to recipe tags or ingredients to the derived data
+
+    Keeps the recipe counters, the sync change log and the user's cache
+    version in step with the relation tables, and queues the recipes'
+    neighbours for a refresh.
+    """
+    relation = relation_for_through(sender)
+    if relation is None:
+        return
+    model, through, column = relation
+    pending = instance.__dict__.setdefault('_relations_pending', {})
+
+    if action in ('pre_remove', 'pre_clear'):
+        ids = pk_set if action == 'pre_remove' else None
+        pending[sender] = _linked_ids(through, column, instance, reverse, ids, using)
+        return
+    if action == 'post_add':
+        changed = set(pk_set or ())
+        delta = 1
+    elif action in ('post_remove', 'post_clear'):
+        changed = pending.pop(sender, set())
+        delta = -1
+    else:
+        return
+    if not changed:
+        return
+
+    if reverse:
+        recipe_ids, related_ids = changed, {instance.pk}
+        adjust_recipe_counts(model, related_ids, delta * len(changed), using)
+    else:
+        recipe_ids, related_ids = {instance.pk}, changed
+        adjust_recipe_counts(model, related_ids, delta, using)
+    record_changes(instance.user_id, Recipe, recipe_ids, using=using)
+    record_changes(instance.user_id, model, related_ids, using=using)
+    schedule_refresh(instance.user_id, recipe_ids, using)
+    bump_user_version(instance.user_id)
+
+
+@receiver(pre_delete, sender=Recipe)
+def release_recipe(sender, instance, using, **kwargs):
+    """Decrement the counters of everything a deleted recipe used"""
+    for model, through, column in recipe_relations():
+        ids = list(through.objects.using(using).filter(
+            recipe_id=instance.pk
+        ).values_list(column, flat=True))
+        adjust_recipe_counts(model, ids, -1, using)
+        record_changes(instance.user_id, model, ids, using=using)
+    instance._affected_recipes = list(RecipeNeighbour.objects.using(using).filter(
+        neighbour_id=instance.pk
+    ).values_list('recipe_id', flat=True))
+
+
+@receiver(pre_delete, sender=Tag)
+@receiver(pre_delete, sender=Ingredient)
+def release_related(sender, instance, using, **kwargs):
+    """Remember which recipes lose this tag or ingredient"""
+    _, through, column = relation_for_model(sender)
+    instance._affected_recipes = list(through.objects.using(using).filter(
+        **{column: instance.pk}
+    ).values_list('recipe_id', flat=True))
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Ingredient)
+def object_saved(sender, instance, created, using, **kwargs):
+    """Log the change and drop cached results derived from it"""
+    record_changes(instance.user_id, sender, [instance.pk], created=created, using=using)
+    bump_user_version(instance.user_id)
+
+
+@receiver(post_delete, sender=Recipe)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Ingredient)
+def object_deleted(sender, instance, using, **kwargs):
+    """Leave a tombstone and update the recipes that referenced instance"""
+    record_changes(instance.user_id, sender, [instance.pk], deleted=True, using=using)
+    recipe_ids = instance.__dict__.pop('_affected_recipes', None)
+    if recipe_ids:
+        if sender is not Recipe:
+            record_changes(instance.user_id, Recipe, recipe_ids, using=using)
+        schedule_refresh(instance.user_id, recipe_ids, using)
+    bump_user_version(instance.user_id)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, using, **kwargs):
+    """Purge the shards of a deleted user once the deletion is committed
+
+    Deleting the account on 'default' cannot cascade to the other
+    databases, which would keep the user's rows and the copy of their
+    user row, password hash included.
+    """
+    if using == DEFAULT_DB_ALIAS and settings.DATABASE_SHARDS:
+        user_id = instance.pk
+        transaction.on_commit(lambda: purge_user(user_id), using=using)
@@ -0,0 +1,225 @@
+from collections import namedtuple
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from scipy import sparse
+
+from core.counters import recipe_relations
+from core.models import NeighbourRefresh, Recipe, RecipeNeighbour
+
+Incidence = namedtuple('Incidence', 'ids matrix')
+Incidence.__doc__ = """A user's sparse recipe incidence matrix
+
+Row i of matrix holds the tags and ingredients of recipe ids[i], one
+column per tag or ingredient; ids are sorted.
+"""
+
+# Scores closer than this are taken to be the same
+SCORE_TOLERANCE = 1e-9
+
+
+def load_incidence(user_id, using='default'):
+    """Return the Incidence of every recipe the user owns"""
+    ids = np.array(sorted(Recipe.objects.using(using).filter(
+        user_id=user_id
+    ).values_list('id', flat=True)), dtype=np.int64)
+    rows, columns, features = [], [], {}
+    for model, through, column in recipe_relations():
+        kind = model.__name__.lower()
+        for recipe_id, related_id in through.objects.using(using).filter(
+            recipe__user_id=user_id
+        ).values_list('recipe_id', column):
+            rows.append(recipe_id)
+            columns.append(features.setdefault((kind, related_id), len(features)))
+    rows = np.array(rows, dtype=np.int64)
+    positions = np.searchsorted(ids, rows)
+    # Relations of recipes created after the ids were read are left out
+    known = positions < len(ids)
+    known[known] = ids[positions[known]] == rows[known]
+    matrix = sparse.csr_matrix(
+        (np.ones(known.sum()), (positions[known], np.array(columns, dtype=np.int64)[known])),
+        shape=(len(ids), len(features)),
+    )
+    return Incidence(ids, matrix)
+
+
+def similarities(incidence, positions, metric=None):
+    """Score the recipes at positions against every recipe of the incidence
+
+    Returns a sparse matrix with a row per position, holding the score of
+    every other recipe sharing a feature with it. The overlaps are one
+    sparse product of the rows with the whole matrix.
+    """
+    metric = metric or settings.RECIPE_SIMILARITY_METRIC
+    matrix = incidence.matrix
+    positions = np.asarray(positions, dtype=np.int64)
+    overlaps = (matrix[positions] @ matrix.T).tocoo()
+    sizes = np.asarray(matrix.sum(axis=1)).ravel()
+    rows, columns, overlap = overlaps.row, overlaps.col, overlaps.data
+    size_a, size_b = sizes[positions[rows]], sizes[columns]
+    if metric == 'cosine':
+        scores = overlap / np.sqrt(size_a * size_b)
+    else:
+        scores = overlap / (size_a + size_b - overlap)
+    others = columns != positions[rows]
+    return sparse.csr_matrix(
+        (scores[others], (rows[others], columns[others])), shape=(len(positions), len(incidence.ids))
+    )
+
+
+def _ranked(incidence, scores, row, k):
+    start, stop = scores.indptr[row], scores.indptr[row + 1]
+    others, values = incidence.ids[scores.indices[start:stop]], scores.data[start:stop]
+    order = np.lexsort((others, -values))[:k]
+    return [(int(others[index]), float(values[index])) for index in order]
+
+
+def top_neighbours(incidence, positions, k=None, metric=None):
+    """Rank the k most similar recipes of the recipes at positions"""
+    k = k or settings.RECIPE_SIMILAR_K
+    scores = similarities(incidence, positions, metric)
+    return {
+        int(incidence.ids[position]): _ranked(incidence, scores, row, k)
+        for row, position in enumerate(positions)
+    }
+
+
+def _stored(recipe_ids, using, batch_size=500):
+    """Return the stored (row id, neighbour id, score) of each recipe, best first"""
+    stored = {}
+    recipe_ids = sorted(recipe_ids)
+    for start in range(0, len(recipe_ids), batch_size):
+        for row_id, recipe_id, neighbour_id, score in RecipeNeighbour.objects.using(using).filter(
+            recipe_id__in=recipe_ids[start:start + batch_size]
+        ).order_by('recipe_id', '-score', 'neighbour_id').values_list(
+            'id', 'recipe_id', 'neighbour_id', 'score'
+        ):
+            stored.setdefault(recipe_id, []).append((row_id, neighbour_id, score))
+    return stored
+
+
+def _same(stored, ranked):
+    return len(stored) == len(ranked) and all(
+        neighbour_id == other and abs(score - new_score) <= SCORE_TOLERANCE
+        for (row_id, neighbour_id, score), (other, new_score) in zip(stored, ranked)
+    )
+
+
+def _save(ranked, using, batch_size):
+    """Store the ranked lists, only deleting and inserting the rows that differ"""
+    recipe_ids = sorted(ranked)
+    for start in range(0, len(recipe_ids), batch_size):
+        batch = recipe_ids[start:start + batch_size]
+        stored = _stored(batch, using, batch_size)
+        stale, fresh = [], []
+        for recipe_id in batch:
+            kept = {}
+            for row_id, neighbour_id, score in stored.get(recipe_id, []):
+                kept[neighbour_id] = (row_id, score)
+            new = dict(ranked[recipe_id])
+            for neighbour_id, (row_id, score) in kept.items():
+                if abs(new.get(neighbour_id, -1) - score) > SCORE_TOLERANCE:
+                    stale.append(row_id)
+            fresh += [
+                RecipeNeighbour(recipe_id=recipe_id, neighbour_id=other, score=score)
+                for other, score in ranked[recipe_id]
+                if abs(kept.get(other, (None, -1))[1] - score) > SCORE_TOLERANCE
+            ]
+        with transaction.atomic(using=using):
+            RecipeNeighbour.objects.using(using).filter(id__in=stale)._raw_delete(using)
+            RecipeNeighbour.objects.using(using).bulk_create(fresh, batch_size=batch_size)
+
+
+def refresh_neighbours(user_id, recipe_ids=None, using='default', batch_size=500):
+    """Recompute stored neighbours for the user's recipes
+
+    With recipe_ids, the recipes whose tags or ingredients changed, only
+    those are ranked again in full. Every other recipe only has its scores
+    against them worked out again and merged into its stored list; it is
+    ranked in full only when a recipe dropped out of its full list, as the
+    next best one is not stored. Only the rows that differ from the stored
+    ones are written. Returns how many lists were ranked again.
+    """
+    k = settings.RECIPE_SIMILAR_K
+    incidence = load_incidence(user_id, using)
+    if recipe_ids is None:
+        positions = np.arange(len(incidence.ids))
+        changed, rescored = set(), {}
+    else:
+        changed = set(recipe_ids)
+        positions = np.flatnonzero(np.isin(incidence.ids, sorted(changed)))
+        rescored = {
+            recipe_id: {} for recipe_id in RecipeNeighbour.objects.using(using).filter(
+                neighbour_id__in=changed
+            ).values_list('recipe_id', flat=True)
+        }
+
+    ranked = {}
+    for start in range(0, len(positions), batch_size):
+        batch = positions[start:start + batch_size]
+        scores = similarities(incidence, batch)
+        for row, position in enumerate(batch):
+            recipe_id = int(incidence.ids[position])
+            ranked[recipe_id] = _ranked(incidence, scores, row, k)
+            if recipe_ids is None:
+                continue
+            begin, end = scores.indptr[row], scores.indptr[row + 1]
+            for other, score in zip(incidence.ids[scores.indices[begin:end]], scores.data[begin:end]):
+                rescored.setdefault(int(other), {})[recipe_id] = float(score)
+
+    full = []
+    existing = set(incidence.ids.tolist())
+    others = [recipe_id for recipe_id in rescored if recipe_id not in ranked and recipe_id in existing]
+    stored = _stored(others, using, batch_size)
+    for recipe_id in others:
+        current = stored.get(recipe_id, [])
+        scores = rescored[recipe_id]
+        dropped = any(
+            other in changed and scores.get(other, 0) < score - SCORE_TOLERANCE
+            for row_id, other, score in current
+        )
+        if dropped and len(current) >= k:
+            full.append(recipe_id)
+            continue
+        merged = [(other, score) for row_id, other, score in current if other not in changed]
+        merged = sorted(merged + list(scores.items()), key=lambda item: (-item[1], item[0]))[:k]
+        if not _same(current, merged):
+            ranked[recipe_id] = merged
+    positions = np.searchsorted(incidence.ids, sorted(full))
+    for start in range(0, len(positions), batch_size):
+        ranked.update(top_neighbours(incidence, positions[start:start + batch_size], k))
+
+    _save(ranked, using, batch_size)
+    return len(ranked)
+
+
+def schedule_refresh(user_id, recipe_ids, using='default'):
+    """Queue the recipes for refresh_recipe_neighbours to refresh their neighbours
+
+    The queue rows are written in the caller's transaction, so they are
+    committed, or rolled back, with the change that made them.
+    """
+    NeighbourRefresh.objects.using(using).bulk_create([
+        NeighbourRefresh(user_id=user_id, recipe_id=recipe_id) for recipe_id in sorted(set(recipe_ids))
+    ])
+
+
+def process_refresh_queue(using='default', limit=10000):
+    """Refresh the neighbours of up to limit queued recipes, user by user
+
+    Each user's recipes are refreshed together and only then taken off the
+    queue, so a failed refresh is tried again. Returns how many queue rows
+    were done with.
+    """
+    queued = {}
+    for row_id, user_id, recipe_id in NeighbourRefresh.objects.using(using).order_by(
+        'id'
+    ).values_list('id', 'user_id', 'recipe_id')[:limit]:
+        row_ids, recipe_ids = queued.setdefault(user_id, ([], set()))
+        row_ids.append(row_id)
+        recipe_ids.add(recipe_id)
+    for user_id, (row_ids, recipe_ids) in queued.items():
+        refresh_neighbours(user_id, recipe_ids, using)
+        NeighbourRefresh.objects.using(using).filter(id__in=row_ids).delete()
+    return sum(len(row_ids) for row_ids, recipe_ids in queued.values())
@@ -0,0 +1,112 @@
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+
+logger = logging.getLogger('recipe.slow_queries')
+_state = threading.local()
+
+_PLACEHOLDERS = re.compile(r'%s|\?')
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SPACES = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """Normalise SQL so queries that differ only in values group together"""
+    sql = _PLACEHOLDERS.sub('?', sql)
+    sql = _LITERALS.sub('?', sql)
+    sql = _LISTS.sub('(...)', sql)
+    return _SPACES.sub(' ', sql).strip()
+
+
+def call_site(request, view_func):
+    """Describe the view and action a request is served by"""
+    view_class = getattr(view_func, 'cls', None)
+    view = view_class or view_func
+    actions = getattr(view_func, 'actions', None) or {}
+    method = request.method.lower()
+    return {
+        'view': f'{view.__module__}.{view.__name__}',
+        'action': actions.get(method, method),
+        'path': request.path,
+    }
+
+
+def explain(connection, sql, params):
+    """Return the plan of a SELECT, or None where it cannot be had"""
+    if sql.lstrip()[:6].upper() != 'SELECT':
+        return None
+    if connection.vendor == 'postgresql':
+        prefix = 'EXPLAIN (FORMAT JSON) '
+    elif connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        return None
+    _state.explaining = True
+    try:
+        # A failed EXPLAIN must not break the transaction the query ran in
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute(prefix + sql, params)
+                rows = cursor.fetchall()
+    except DatabaseError:
+        return None
+    finally:
+        _state.explaining = False
+    if connection.vendor == 'postgresql':
+        return rows[0][0]
+    return [row[-1] for row in rows]
+
+
+class SlowQueryRecorder:
+    """Execute wrapper logging the queries slower than SLOW_QUERY_THRESHOLD_MS"""
+
+    def __init__(self, site):
+        self.site = site
+
+    def __call__(self, execute, sql, params, many, context):
+        if getattr(_state, 'explaining', False):
+            return execute(sql, params, many, context)
+        start = time.monotonic()
+        result = execute(sql, params, many, context)
+        duration = (time.monotonic() - start) * 1000
+        if duration >= settings.SLOW_QUERY_THRESHOLD_MS:
+            self.record(context['connection'], sql, params, many, duration)
+        return result
+
+    def record(self, connection, sql, params, many, duration):
+        entry = dict(
+            self.site,
+            time=time.time(),
+            database=connection.alias,
+            duration_ms=round(duration, 3),
+            fingerprint=fingerprint(sql),
+            sql=sql,
+        )
+        if not many and random.random() < settings.SLOW_QUERY_EXPLAIN_RATE:
+            entry['plan'] = explain(connection, sql, params)
+        logger.info(json.dumps(entry, default=str))
+
+
+@contextmanager
+def slow_query_log(site):
+    """Log slow queries made inside on any database, tagged with the call site"""
+    recorder = SlowQueryRecorder(site)
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        yield recorder
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)), 1) - 1]
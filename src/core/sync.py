@@ -0,0 +1,120 @@
+from django.db import transaction
+from django.db.models import Max
+from django.dispatch import Signal
+
+from core.events import bus
+from core.models import Tag, Ingredient, Recipe, Change, SyncState
+
+KINDS = {Recipe: Change.RECIPE, Tag: Change.TAG, Ingredient: Change.INGREDIENT}
+
+# Sent with the model as sender whenever record_changes logs changes, in
+# the same transaction, so data derived from the objects can follow them
+changes_recorded = Signal(providing_args=['user_id', 'ids', 'deleted', 'using'])
+
+
+def record_changes(user_id, model, ids, deleted=False, created=False, using='default'):
+    """Move the given objects to the head of the user's change log
+
+    The user's SyncState row stays locked until the transaction ends, so
+    the ids logged by concurrent transactions become visible in order. An
+    object logged as created stays so through later updates, such as the
+    relation changes saved right after it. The user's event streams are
+    woken up once the change is committed.
+    """
+    ids = set(ids)
+    if not ids:
+        return
+    kind = KINDS[model]
+    with transaction.atomic(using=using):
+        SyncState.objects.using(using).select_for_update().get_or_create(user_id=user_id)
+        previous = Change.objects.using(using).filter(kind=kind, object_id__in=ids)
+        created_ids = ids if created else set(
+            previous.filter(created=True).values_list('object_id', flat=True)
+        )
+        previous.delete()
+        Change.objects.using(using).bulk_create([
+            Change(
+                user_id=user_id, kind=kind, object_id=object_id,
+                created=object_id in created_ids, deleted=deleted,
+            )
+            for object_id in sorted(ids)
+        ])
+        changes_recorded.send(model, user_id=user_id, ids=ids, deleted=deleted, using=using)
+    transaction.on_commit(lambda: bus.publish(user_id), using=using)
+
+
+def changes_since(user, since, limit):
+    """Return the user's changes after the since token, oldest first
+
+    Returns (changes, token, more) where token is the sequence to ask
+    for next time and more tells whether changes were left out.
+    """
+    changes = list(Change.objects.db_manager(hints={'user_id': user.id}).filter(
+        user=user, id__gt=since
+    ).order_by('id')[:limit + 1])
+    more = len(changes) > limit
+    changes = changes[:limit]
+    token = changes[-1].id if changes else since
+    return changes, token, more
+
+
+def latest_change(user):
+    """Return the newest sequence in the user's change log"""
+    changes = Change.objects.db_manager(hints={'user_id': user.id}).filter(user=user)
+    return changes.aggregate(latest=Max('id'))['latest'] or 0
+
+
+def pruned_through(user):
+    """Return the newest tombstone pruned from the user's change log"""
+    states = SyncState.objects.db_manager(hints={'user_id': user.id}).filter(user=user)
+    return states.values_list('pruned_through', flat=True).first() or 0
+
+
+def prune_tombstones(before, using='default', batch_size=1000):
+    """Remove the tombstones logged before a datetime, returning how many
+
+    Clients holding a token older than a removed tombstone could no longer
+    learn of that deletion, so decode_token resets them to a full sync.
+    """
+    users = Change.objects.using(using).filter(deleted=True, logged_at__lt=before).order_by(
+        'user_id'
+    ).values_list('user_id', flat=True).distinct()
+    pruned = 0
+    for user_id in users:
+        with transaction.atomic(using=using):
+            state, created = SyncState.objects.using(using).select_for_update().get_or_create(
+                user_id=user_id
+            )
+            tombstones = Change.objects.using(using).filter(
+                user_id=user_id, deleted=True, logged_at__lt=before
+            )
+            while True:
+                ids = list(tombstones.order_by('id').values_list('id', flat=True)[:batch_size])
+                if not ids:
+                    break
+                Change.objects.using(using).filter(id__in=ids).delete()
+                state.pruned_through = max(state.pruned_through, ids[-1])
+                pruned += len(ids)
+            state.save(using=using)
+    return pruned
+
+
+def encode_token(sequence, epoch=0):
+    """Return the sync token for a sequence, tagged with the user's epoch"""
+    return f'{epoch}.{sequence}' if epoch else str(sequence)
+
+
+def decode_token(token, epoch=0, pruned=0):
+    """Return (sequence, reset) for a sync token
+
+    A token from before the user's last shard move cannot be compared
+    with the new shard's sequence, and one from before the last pruned
+    tombstone (pruned) would miss that deletion, so either decodes to 0
+    with reset set. Raises ValueError for malformed tokens.
+    """
+    token_epoch, _, sequence = str(token).rpartition('.')
+    token_epoch = int(token_epoch) if token_epoch else 0
+    sequence = int(sequence)
+    if token_epoch != epoch or 0 < sequence < pruned:
+        return 0, True
+    return sequence, False
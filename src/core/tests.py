@@ -1,8 +1,36 @@
-from django.test import TestCase, Client
+import datetime
+import decimal
+import gzip
+import importlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from io import BytesIO, StringIO
+from random import Random
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connections, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from core import compression, db_routers, limits, sharding, similarity, slow_queries, warmup, zipstream
+from core.admin import EstimatedCountPaginator
+from core.cache import get_user_version
+from core.db.pool import ConnectionPool, PoolTimeout, pool_stats
+from core.middleware import CompressionMiddleware
+from core.renderers import OrjsonRenderer, msgpack
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from core import models
-from unittest.mock import patch
+from rest_framework.authtoken.models import Token
+from unittest.mock import MagicMock, patch
 
 
 def sample_user(email='test1@davis.com', password='pass1234'):
@@ -63,6 +91,50 @@ class AdminSiteTest(TestCase):
         res = self.client.get(url)
         self.assertEqual(res.status_code, 200)
 
+    def test_tag_changelist_searches_by_prefix(self):
+        """Test tags are searched by prefix of their folded names"""
+        models.Tag.objects.create(user=self.user, name='Crème brûlée')
+        models.Tag.objects.create(user=self.user, name='Brunch')
+        url = reverse('admin:core_tag_changelist')
+        res = self.client.get(url, {'q': 'CREME'})
+        self.assertContains(res, 'Crème brûlée')
+        self.assertNotContains(res, 'Brunch')
+
+    def test_ingredient_changelist(self):
+        """Test ingredients are registered and listed with their owner"""
+        models.Ingredient.objects.create(user=self.user, name='Salt')
+        res = self.client.get(reverse('admin:core_ingredient_changelist'))
+        self.assertContains(res, 'Salt')
+        self.assertContains(res, self.user.email)
+
+    def test_recipe_change_page_uses_autocomplete(self):
+        """Test the recipe form does not render every tag and ingredient"""
+        models.Tag.objects.create(user=self.user, name='Vegan')
+        recipe = models.Recipe.objects.create(
+            user=self.user, title='Soup', time_minutes=5, price=5.00
+        )
+        res = self.client.get(reverse('admin:core_recipe_change', args=[recipe.id]))
+        self.assertContains(res, 'admin-autocomplete')
+        self.assertNotContains(res, 'Vegan')
+
+    def test_paginator_estimates_large_tables(self):
+        """Test large changelists are counted from PostgreSQL estimates"""
+        connection = MagicMock(vendor='postgresql')
+        cursor = connection.cursor.return_value.__enter__.return_value
+        with patch('core.admin.connections', {'default': connection}):
+            cursor.fetchone.return_value = (5000000, )
+            paginator = EstimatedCountPaginator(models.Tag.objects.order_by('-id'), 100)
+            self.assertEqual(paginator.count, 5000000)
+
+            for index in range(4):
+                models.Tag.objects.create(user=self.user, name=f'Tag {index}')
+            cursor.fetchone.return_value = ([{'Plan': {'Plan Rows': 40}}], )
+            tags = models.Tag.objects.filter(user=self.user).order_by('-id')
+            with self.settings(ADMIN_EXACT_COUNT_LIMIT=10):
+                self.assertEqual(EstimatedCountPaginator(tags, 100).count, 4)
+            with self.settings(ADMIN_EXACT_COUNT_LIMIT=2):
+                self.assertEqual(EstimatedCountPaginator(tags, 100).count, 40)
+
     def test_tag_str_repesentation(self):
         """Test the tag string representation"""
         tag = models.Tag.objects.create(
@@ -97,3 +169,893 @@ class AdminSiteTest(TestCase):
 
         exp_path = f'uploads/recipe/{uuid}.jpg'
         self.assertEqual(file_path, exp_path)
+
+
+class RebuildRecipeCountsTest(TestCase):
+    def test_rebuild_recipe_counts(self):
+        """Test the repair command recounts drifted counters"""
+        user = sample_user()
+        tag = models.Tag.objects.create(user=user, name='vegan')
+        unused = models.Tag.objects.create(user=user, name='unused')
+        recipe = models.Recipe.objects.create(user=user, title='Salad', time_minutes=5, price=5.00)
+        recipe.tags.add(tag)
+        models.Tag.objects.update(recipe_count=7)
+
+        changes = models.Change.objects.filter(kind=models.Change.TAG)
+        latest = changes.order_by('-id').values_list('id', flat=True).first()
+        version = get_user_version(user.id)
+
+        out = StringIO()
+        call_command('rebuild_recipe_counts', stdout=out)
+        tag.refresh_from_db()
+        unused.refresh_from_db()
+        self.assertEqual(tag.recipe_count, 1)
+        self.assertEqual(unused.recipe_count, 0)
+        self.assertIn('Tag: 2 rows recounted', out.getvalue())
+        self.assertEqual(
+            set(changes.filter(id__gt=latest).values_list('object_id', flat=True)), {tag.id, unused.id}
+        )
+        self.assertNotEqual(get_user_version(user.id), version)
+
+        call_command('rebuild_recipe_counts', stdout=out)
+        self.assertIn('Tag: 0 rows recounted', out.getvalue())
+
+
+class BuildRecipeNeighboursTest(TestCase):
+    def test_build_recipe_neighbours(self):
+        """Test the command rebuilds neighbours from scratch"""
+        user = sample_user()
+        tag = models.Tag.objects.create(user=user, name='vegan')
+        recipe = models.Recipe.objects.create(user=user, title='Salad', time_minutes=5, price=5.00)
+        other = models.Recipe.objects.create(user=user, title='Soup', time_minutes=5, price=5.00)
+        recipe.tags.add(tag)
+        other.tags.add(tag)
+        models.RecipeNeighbour.objects.all().delete()
+
+        call_command('build_recipe_neighbours', stdout=StringIO())
+        neighbours = models.RecipeNeighbour.objects.filter(recipe=recipe)
+        self.assertEqual([n.neighbour_id for n in neighbours], [other.id])
+        self.assertEqual(neighbours[0].score, 1.0)
+
+
+@override_settings(RECIPE_SIMILAR_K=3)
+class RefreshNeighboursTest(TestCase):
+    """Test incremental neighbour refreshes against ranking from scratch"""
+
+    def stored(self):
+        return [
+            (recipe_id, neighbour_id, round(score, 9))
+            for recipe_id, neighbour_id, score in models.RecipeNeighbour.objects.order_by(
+                'recipe_id', '-score', 'neighbour_id'
+            ).values_list('recipe_id', 'neighbour_id', 'score')
+        ]
+
+    def test_incremental_refresh_matches_full_ranking(self):
+        """Test queued refreshes leave the same neighbours as a full rebuild"""
+        random = Random(7)
+        user = sample_user()
+        tags = [models.Tag.objects.create(user=user, name=f'tag {index}') for index in range(6)]
+        recipes = [
+            models.Recipe.objects.create(user=user, title=f'recipe {index}', time_minutes=5, price=5)
+            for index in range(30)
+        ]
+        models.Recipe.tags.through.objects.bulk_create([
+            models.Recipe.tags.through(recipe_id=recipe.id, tag_id=tag.id)
+            for recipe in recipes for tag in random.sample(tags, random.randint(0, 3))
+        ])
+        similarity.refresh_neighbours(user.id)
+        models.NeighbourRefresh.objects.all().delete()
+
+        for recipe in random.sample(recipes[1:], 5):
+            recipe.tags.set(random.sample(tags, random.randint(0, 3)))
+        recipes[0].delete()
+        tags[0].delete()
+        self.assertTrue(models.NeighbourRefresh.objects.exists())
+        similarity.process_refresh_queue()
+        incremental = self.stored()
+
+        similarity.refresh_neighbours(user.id)
+        self.assertEqual(incremental, self.stored())
+        self.assertFalse(models.NeighbourRefresh.objects.exists())
+
+    def test_unrelated_lists_left_alone(self):
+        """Test a change only rewrites the lists its scores can reach"""
+        user = sample_user()
+        vegan, cake = (models.Tag.objects.create(user=user, name=name) for name in ('vegan', 'cake'))
+        recipes = [
+            models.Recipe.objects.create(user=user, title=f'recipe {index}', time_minutes=5, price=5)
+            for index in range(4)
+        ]
+        recipes[0].tags.add(vegan)
+        recipes[1].tags.add(vegan)
+        recipes[2].tags.add(cake)
+        recipes[3].tags.add(cake)
+        similarity.process_refresh_queue()
+
+        recipes[0].tags.add(cake)
+        rewritten = similarity.refresh_neighbours(user.id, [recipes[0].id])
+        self.assertEqual(rewritten, 4)
+        recipes[1].tags.add(models.Tag.objects.create(user=user, name='quick'))
+        self.assertEqual(similarity.refresh_neighbours(user.id, [recipes[1].id]), 2)
+
+
+class ReplicaRouterTest(TestCase):
+    """Test read routing with SQLite files standing in for replicas"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        connections.databases['replica_a'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(cls.tmpdir.name, 'replica_a.sqlite3'),
+        }
+        connections.databases['replica_down'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(cls.tmpdir.name, 'missing', 'replica.sqlite3'),
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        for alias in ('replica_a', 'replica_down'):
+            connections[alias].close()
+            del connections.databases[alias]
+        cls.tmpdir.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        db_routers._health.clear()
+        self.router = db_routers.ReplicaRouter()
+        self.request = RequestFactory().get('/api/recipe/recipes/')
+        self.request.user = sample_user()
+
+    @override_settings(DATABASE_REPLICAS=['replica_a'])
+    def test_reads_go_to_replica(self):
+        """Test reads inside a replica request use the replica"""
+        self.assertIsNone(self.router.db_for_read(models.Recipe))
+        with db_routers.replica_reads(self.request):
+            self.assertEqual(self.router.db_for_read(models.Recipe), 'replica_a')
+            self.assertIsNone(self.router.db_for_read(Token))
+        self.assertEqual(self.router.db_for_write(models.Recipe), 'default')
+
+    @override_settings(DATABASE_REPLICAS=['replica_a'])
+    def test_recent_writer_pinned_to_primary(self):
+        """Test a user who just wrote reads from the primary"""
+        db_routers.pin_to_primary(self.request.user.id)
+        with db_routers.replica_reads(self.request):
+            self.assertIsNone(self.router.db_for_read(models.Recipe))
+
+    @override_settings(DATABASE_REPLICAS=['replica_down', 'replica_a'])
+    def test_unhealthy_replica_skipped(self):
+        """Test replicas that cannot be reached are not used"""
+        with db_routers.replica_reads(self.request):
+            for _ in range(5):
+                self.assertEqual(self.router.db_for_read(models.Recipe), 'replica_a')
+
+    @override_settings(DATABASE_REPLICAS=['replica_down'])
+    def test_failover_to_primary(self):
+        """Test the primary is used when no replica is healthy"""
+        with db_routers.replica_reads(self.request):
+            self.assertIsNone(self.router.db_for_read(models.Recipe))
+
+    def test_cache_kept_off_the_primary(self):
+        """Test pins and versions go to memcached once CACHE_LOCATION is set"""
+        from recipe import settings as module
+        self.addCleanup(importlib.reload, module)
+        with patch.dict(os.environ, {'CACHE_LOCATION': 'cache-1:11211, cache-2:11211'}):
+            importlib.reload(module)
+        for alias in ('default', 'idempotency'):
+            self.assertEqual(
+                module.CACHES[alias]['BACKEND'], 'django.core.cache.backends.memcached.MemcachedCache'
+            )
+            self.assertEqual(module.CACHES[alias]['LOCATION'], ['cache-1:11211', 'cache-2:11211'])
+        self.assertNotEqual(module.CACHES['default']['KEY_PREFIX'], module.CACHES['idempotency']['KEY_PREFIX'])
+        self.assertIn('compression', module.CACHES)
+
+    def test_write_request_pins_user(self):
+        """Test an API write pins the user to the primary"""
+        client = APIClient()
+        client.force_authenticate(self.request.user)
+        client.post(reverse('recipe_app:tag-list'), {'name': 'Vegan'})
+        self.assertTrue(cache.get(db_routers._pin_key(self.request.user.id)))
+
+
+class RendererTest(TestCase):
+    """Test the orjson and MessagePack renderers and parsers"""
+
+    def setUp(self):
+        self.user = sample_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_orjson_matches_drf_json(self):
+        """Test the orjson renderer encodes values like DRF's renderer"""
+        data = {
+            'price': decimal.Decimal('5.10'),
+            'key': uuid.UUID('12345678123456781234567812345678'),
+            'at': datetime.datetime(2019, 6, 2, 11, 18, tzinfo=datetime.timezone.utc),
+            'counts': {1: 2},
+            'names': ('a', 'b'),
+        }
+        self.assertEqual(
+            json.loads(OrjsonRenderer().render(data)),
+            json.loads(JSONRenderer().render(data)),
+        )
+
+    def test_json_parse_error(self):
+        """Test malformed JSON bodies are rejected with a 400"""
+        res = self.client.post(
+            reverse('recipe_app:tag-list'), '{"name": ', content_type='application/json'
+        )
+        self.assertEqual(res.status_code, 400)
+
+    def test_msgpack_negotiated(self):
+        """Test internal services can send and receive MessagePack"""
+        res = self.client.post(
+            reverse('recipe_app:tag-list'), msgpack.packb({'name': 'Vegan'}),
+            content_type='application/msgpack', HTTP_ACCEPT='application/msgpack',
+        )
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(res['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(res.content)['name'], 'Vegan')
+
+        res = self.client.get(reverse('recipe_app:tag-list'), HTTP_ACCEPT='application/json')
+        self.assertEqual([tag['name'] for tag in res.json()], ['Vegan'])
+
+
+class WarmUpTest(TestCase):
+    """Test the worker warm-up and the cold start benchmark"""
+
+    def test_warm_up(self):
+        """Test warming up builds the serializers and resolves the routes"""
+        timings = warmup.warm_up()
+        self.assertEqual(list(timings), ['apps', 'serializers', 'routes', 'connections'])
+        self.assertNotIn('connections', warmup.warm_up(connect=False))
+        self.assertGreaterEqual(warmup.build_serializers(), 10)
+        self.assertGreater(warmup.resolve_routes(), 10)
+        self.assertIn('default', warmup.open_connections())
+
+    def test_bench_cold_start(self):
+        """Test the benchmark times a cold and a warmed up worker"""
+        out = StringIO()
+        call_command('bench_cold_start', '--requests', '2', '--path', '/health/', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], '2 requests over /health/')
+        self.assertTrue(lines[1].startswith(' cold: import'))
+        self.assertTrue(lines[2].startswith(' warm: import'))
+
+
+class ConnectionPoolTest(TestCase):
+    """Test the pooled database backends"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, 'pool.sqlite3')
+
+    def connect(self):
+        return sqlite3.connect(self.path, check_same_thread=False)
+
+    def check(self, connection):
+        try:
+            connection.execute('SELECT 1')
+        except sqlite3.Error:
+            return False
+        return True
+
+    def pool(self, **options):
+        return ConnectionPool(self.check, **options)
+
+    def use_pooled_database(self, **pool):
+        connections.databases['pooled'] = {
+            'ENGINE': 'core.db.sqlite3', 'NAME': self.path, 'POOL': pool,
+        }
+        self.addCleanup(connections.databases.pop, 'pooled')
+        # The wrapper is kept per thread; drop it so the next test's settings apply
+        self.addCleanup(connections.__delitem__, 'pooled')
+        self.addCleanup(connections['pooled'].close)
+
+    def test_acquire_waits_up_to_timeout(self):
+        """Test a full pool times out, then hands back released connections"""
+        pool = self.pool(max_size=1, timeout=0.05)
+        connection = pool.acquire(self.connect)
+        with self.assertRaises(PoolTimeout):
+            pool.acquire(self.connect)
+        pool.release(connection)
+        self.assertIs(pool.acquire(self.connect), connection)
+        stats = pool.stats()
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['in_use'], 1)
+
+    def test_broken_and_idle_connections_are_replaced(self):
+        """Test checkouts skip connections failing the check or idle too long"""
+        pool = self.pool(max_size=2, max_idle=0.01)
+        connection = pool.acquire(self.connect)
+        connection.close()
+        pool.release(connection)
+        healthy = pool.acquire(self.connect)
+        self.assertIsNot(healthy, connection)
+        pool.release(healthy)
+        time.sleep(0.02)
+        self.assertIsNot(pool.acquire(self.connect), healthy)
+        stats = pool.stats()
+        self.assertEqual(stats['failed_checks'], 1)
+        self.assertEqual(stats['opened'], 3)
+        self.assertEqual(stats['closed'], 2)
+        self.assertEqual(stats['size'], 1)
+
+    def test_fill_and_discard(self):
+        """Test the pool opens min_size connections and drops discarded ones"""
+        pool = self.pool(min_size=2, max_size=3)
+        pool.fill(self.connect)
+        self.assertEqual(pool.stats()['idle'], 2)
+        pool.release(pool.acquire(self.connect), discard=True)
+        self.assertEqual(pool.stats()['size'], 1)
+        pool.close()
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_backend_shares_connections_between_threads(self):
+        """Test Django connections in many threads share the pool"""
+        self.use_pooled_database(MAX_SIZE=2, TIMEOUT=5)
+        barrier = threading.Barrier(2)
+        errors = []
+
+        def work():
+            try:
+                barrier.wait(timeout=5)
+                for _ in range(5):
+                    with connections['pooled'].cursor() as cursor:
+                        cursor.execute('SELECT 1')
+                    connections['pooled'].close()
+            except Exception as error:  # pragma: no cover
+                errors.append(error)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        stats = pool_stats()['pooled']
+        self.assertLessEqual(stats['opened'], 2)
+        self.assertEqual(stats['checkouts'], 20)
+        self.assertEqual(stats['in_use'], 0)
+
+    def test_backend_rolls_back_returned_connections(self):
+        """Test work left uncommitted is rolled back before reuse"""
+        self.use_pooled_database()
+        connection = connections['pooled']
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE item (id integer)')
+        raw = connection.connection
+        connection.set_autocommit(False)
+        with connection.cursor() as cursor:
+            cursor.execute('INSERT INTO item VALUES (1)')
+        connection.close()
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM item')
+            self.assertEqual(cursor.fetchone()[0], 0)
+        self.assertIs(connection.connection, raw)
+
+    def test_warm_up_returns_connections_to_the_pool(self):
+        """Test warming up fills the pool without keeping a connection checked out"""
+        self.use_pooled_database()
+        self.assertIn('pooled', warmup.open_connections())
+        self.assertIsNone(connections['pooled'].connection)
+        stats = pool_stats()['pooled']
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['size'], 1)
+
+    def test_pool_sized_for_workers(self):
+        """Test each process pools as many connections as it can use"""
+        from recipe import settings as module
+        self.addCleanup(importlib.reload, module)
+        with patch.dict(os.environ, {'GUNICORN_WORKER_CLASS': 'sync'}):
+            importlib.reload(module)
+        self.assertEqual(module.DATABASES['default']['POOL']['MAX_SIZE'], 1)
+        self.assertEqual(module.DATABASES['default']['POOL']['MIN_SIZE'], 1)
+        environ = {'GUNICORN_WORKER_CLASS': 'gevent', 'DATABASE_POOL_SIZE': '25'}
+        with patch.dict(os.environ, environ):
+            importlib.reload(module)
+        self.assertEqual(module.DATABASES['default']['POOL']['MAX_SIZE'], 25)
+
+    @override_settings(ADMISSION_MAX_IN_FLIGHT=None)
+    def test_pool_timeout_is_503(self):
+        """Test requests timing out on the pool get a 503"""
+        client = APIClient()
+        client.force_authenticate(sample_user())
+        get_queryset = patch(
+            'recipe_app.views.TagViewSet.get_queryset', side_effect=PoolTimeout('No connection free')
+        )
+        with get_queryset:
+            res = client.get(reverse('recipe_app:tag-list'))
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res['Retry-After'], '1')
+
+
+class ZipStreamTest(TestCase):
+    """Test ZIP archives streamed by byte range"""
+
+    files = (
+        ('notes.txt', b'hello world\n' * 1000),
+        ('empty', b''),
+        ('images/pixels.bin', bytes(range(256)) * 300),
+    )
+
+    def archive(self):
+        return zipstream.ZipStream(
+            zipstream.Member(name, len(data), lambda offset, data=data: zipstream.skip_bytes(
+                [data[index:index + 1000] for index in range(0, len(data), 1000)], offset
+            ), None)
+            for name, data in self.files
+        )
+
+    def check(self):
+        body = b''.join(self.archive())
+        self.assertEqual(len(body), self.archive().size)
+        archive = zipfile.ZipFile(BytesIO(body))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual([archive.read(name) for name, data in self.files], [data for name, data in self.files])
+        for start in range(0, len(body), 97):
+            for stop in (start + 1, start + 40, len(body)):
+                self.assertEqual(b''.join(self.archive().iter_range(start, stop)), body[start:stop])
+        return body
+
+    def test_ranges_of_archive(self):
+        """Test any byte range matches the whole archive"""
+        self.assertEqual(self.check(), b''.join(self.archive()))
+
+    def test_zip64(self):
+        """Test members and offsets past the ZIP64 limit"""
+        with patch('core.zipstream.ZIP64_LIMIT', 1000):
+            body = self.check()
+        self.assertIn(b'PK\x06\x06', body)
+
+    def test_member_changed_while_streamed(self):
+        """Test a member not matching its size or CRC fails the archive"""
+        data = b'hello world\n' * 1000
+        crc = zlib.crc32(data)
+        for changed, known_crc in ((data + b'!', None), (data[:-1], None), (data.upper(), crc)):
+            archive = zipstream.ZipStream([zipstream.Member(
+                'notes.txt', len(data), lambda offset, changed=changed: zipstream.skip_bytes([changed], offset),
+                known_crc,
+            )])
+            with self.assertRaises(ValueError):
+                b''.join(archive)
+            if known_crc is None:
+                with self.assertRaises(ValueError):
+                    archive.crc(0)
+
+
+class SlowQueryLogTest(TestCase):
+    """Test logging and reporting slow queries"""
+
+    def setUp(self):
+        self.user = sample_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_fingerprint(self):
+        """Test queries differing in values share a fingerprint"""
+        self.assertEqual(
+            slow_queries.fingerprint(
+                "SELECT *  FROM t WHERE id IN (%s, %s, %s) AND name = 'it''s' LIMIT 21"
+            ),
+            'SELECT * FROM t WHERE id IN (...) AND name = ? LIMIT ?',
+        )
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_EXPLAIN_RATE=1)
+    def test_view_queries_logged_with_call_site(self):
+        """Test slow queries are logged with the view, action and a plan"""
+        with patch.object(slow_queries.logger, 'info') as log:
+            self.client.get(reverse('recipe_app:recipe-list'))
+        entries = [json.loads(call[0][0]) for call in log.call_args_list]
+        self.assertTrue(entries)
+        entry = entries[-1]
+        self.assertEqual(entry['view'], 'recipe_app.views.RecipeViewSet')
+        self.assertEqual(entry['action'], 'list')
+        self.assertIn('core_recipe', entry['fingerprint'])
+        self.assertTrue(entry['plan'])
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=None)
+    def test_disabled(self):
+        """Test nothing is logged without a threshold"""
+        with patch.object(slow_queries.logger, 'info') as log:
+            self.client.get(reverse('recipe_app:recipe-list'))
+        log.assert_not_called()
+
+    def test_report(self):
+        """Test the report groups by fingerprint with counts and p95"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'slow.log')
+            with open(path, 'w') as log:
+                for duration in range(1, 21):
+                    log.write(json.dumps({
+                        'fingerprint': 'SELECT ? FROM core_recipe', 'duration_ms': duration,
+                        'view': 'recipe_app.views.RecipeViewSet', 'action': 'list',
+                    }) + '\n')
+                log.write(json.dumps({
+                    'fingerprint': 'SELECT ? FROM core_tag', 'duration_ms': 500,
+                    'view': 'recipe_app.views.TagViewSet', 'action': 'list', 'plan': [],
+                }) + '\n')
+            out = StringIO()
+            call_command('slow_queries', file=path, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('1 queries  p95 500.0 ms'))
+        self.assertIn('plans 1', lines[0])
+        self.assertTrue(lines[2].startswith('20 queries  p95 19.0 ms  max 20.0 ms  total 210.0 ms'))
+        self.assertIn('RecipeViewSet:list', lines[2])
+
+
+class CompressionTest(TestCase):
+    """Test negotiated compression of API responses"""
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.middleware = CompressionMiddleware()
+
+    def respond(self, response, accept_encoding):
+        request = self.factory.get('/api/recipe/tags/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        self.middleware.process_request(request)
+        return self.middleware.process_response(request, response)
+
+    def test_negotiate(self):
+        """Test the coding follows the client's preferences"""
+        self.assertEqual(compression.negotiate('gzip, deflate, br'), 'br')
+        self.assertEqual(compression.negotiate('gzip;q=1.0, br;q=0.5'), 'gzip')
+        self.assertEqual(compression.negotiate('br;q=0, gzip;q=0'), 'identity')
+        self.assertEqual(compression.negotiate('*'), 'br')
+        self.assertEqual(compression.negotiate(''), 'identity')
+
+    def test_api_response_compressed(self):
+        """Test large API responses are gzipped with Vary and Content-Length set"""
+        user = sample_user()
+        for index in range(100):
+            models.Tag.objects.create(user=user, name=f'Tag number {index}')
+        client = APIClient()
+        client.force_authenticate(user)
+
+        res = client.get(reverse('recipe_app:tag-list'), HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(res['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res['Vary'])
+        self.assertEqual(int(res['Content-Length']), len(res.content))
+        self.assertEqual(len(json.loads(gzip.decompress(res.content))), 100)
+
+    def test_request_and_default_cache_left_alone(self):
+        """Test the coding is only kept on the request and bodies in their own cache"""
+        request = self.factory.get('/api/recipe/tags/')
+        self.middleware.process_request(request)
+        self.assertEqual(request.content_coding, 'identity')
+        self.assertNotIn('HTTP_ACCEPT_ENCODING', request.META)
+
+        request = self.factory.get('/api/recipe/tags/', HTTP_ACCEPT_ENCODING='gzip, br')
+        self.middleware.process_request(request)
+        self.assertEqual(request.META['HTTP_ACCEPT_ENCODING'], 'gzip, br')
+        with patch.object(cache, 'set') as cache_set:
+            self.middleware.process_response(request, HttpResponse(b'x' * 2000, content_type='text/plain'))
+        cache_set.assert_not_called()
+
+    def test_short_response_left_alone(self):
+        """Test short bodies are not compressed but still vary on the coding"""
+        res = self.respond(HttpResponse(b'{}', content_type='application/json'), 'gzip')
+        self.assertFalse(res.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', res['Vary'])
+
+    def test_strong_etag_per_coding(self):
+        """Test compressed variants get their own strong ETag"""
+        response = HttpResponse(b'x' * 2000, content_type='text/plain')
+        response['ETag'] = '"abc"'
+        res = self.respond(response, 'br')
+        self.assertEqual(res['ETag'], '"abc-br"')
+        self.assertEqual(compression.brotli.decompress(res.content), b'x' * 2000)
+
+    def test_streaming_compressed_per_chunk(self):
+        """Test streamed bodies are compressed with a flush after each chunk"""
+        for coding in ('gzip', 'br'):
+            response = StreamingHttpResponse(
+                (f'data: {index}\n\n' for index in range(50)), content_type='text/event-stream'
+            )
+            res = self.respond(response, coding)
+            chunks = iter(res.streaming_content)
+            self.assertEqual(res['Content-Encoding'], coding)
+            if coding == 'gzip':
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                decompress = decompressor.decompress
+            else:
+                decompress = compression.brotli.Decompressor().process
+            for index in range(50):
+                self.assertEqual(decompress(next(chunks)), f'data: {index}\n\n'.encode())
+
+
+class LoadSheddingTest(TestCase):
+    """Test query time budgets and admission control"""
+
+    SLOW_SQL = (
+        'WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 100000000) '
+        'SELECT COUNT(*) FROM n'
+    )
+
+    def setUp(self):
+        self.user = sample_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.tags_url = reverse('recipe_app:tag-list')
+
+    def test_health(self):
+        """Test the health check answers without authentication"""
+        res = Client().get(reverse('health'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['status'], 'ok')
+
+    def test_query_budget_interrupts_sqlite_queries(self):
+        """Test a query running past the budget is interrupted"""
+        with limits.query_budget(50) as budget:
+            with self.assertRaises(DatabaseError):
+                with connections['default'].cursor() as cursor:
+                    cursor.execute(self.SLOW_SQL)
+        self.assertTrue(budget.expired)
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+    @override_settings(QUERY_TIMEOUT_MS=-1)
+    def test_spent_budget_is_503(self):
+        """Test a view out of query time gets a 503"""
+        res = self.client.get(self.tags_url)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res['Retry-After'], '1')
+
+    @override_settings(ADMISSION_MAX_IN_FLIGHT=0)
+    def test_busy_process_sheds_all_but_priority_paths(self):
+        """Test requests are refused when too many are running"""
+        res = self.client.get(self.tags_url)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.json(), {'detail': 'Too many requests in progress'})
+        self.assertEqual(Client().get(reverse('health')).status_code, 200)
+        res = self.client.post(reverse('user:token'), {'email': 'test1@davis.com', 'password': 'pass1234'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(limits.admission.in_flight, 0)
+
+    @override_settings(ADMISSION_MAX_IN_FLIGHT=1)
+    def test_concurrent_requests_counted(self):
+        """Test a request is refused while others run in the same process"""
+        self.assertIsNone(limits.admission.admit())
+        try:
+            res = self.client.get(self.tags_url)
+        finally:
+            limits.admission.release()
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(self.client.get(self.tags_url).status_code, 200)
+
+    def test_admission_limits_sized_for_workers(self):
+        """Test the per process limits only apply to concurrent workers"""
+        from recipe import settings as module
+        self.addCleanup(importlib.reload, module)
+        with patch.dict(os.environ, {'GUNICORN_WORKER_CLASS': 'sync'}):
+            importlib.reload(module)
+        self.assertEqual(module.WORKER_CONCURRENCY, 1)
+        self.assertIsNone(module.ADMISSION_MAX_IN_FLIGHT)
+        self.assertIsNone(module.ADMISSION_MAX_DB_SECONDS)
+        with patch.dict(os.environ, {'GUNICORN_WORKER_CLASS': 'gevent', 'GUNICORN_WORKER_CONNECTIONS': '400'}):
+            importlib.reload(module)
+        self.assertEqual(module.WORKER_CONCURRENCY, 400)
+        self.assertEqual(module.ADMISSION_MAX_IN_FLIGHT, 100)
+        self.assertIsNotNone(module.ADMISSION_MAX_DB_SECONDS)
+
+    def test_statement_timeout_set_again_as_budget_drops(self):
+        """Test PostgreSQL connections get the budget left as it runs down"""
+        connection = MagicMock(vendor='postgresql', alias='default')
+        cursor = MagicMock()
+        context = {'connection': connection, 'cursor': MagicMock(cursor=cursor)}
+        execute = MagicMock()
+        with patch('core.limits.time.monotonic', return_value=100):
+            budget = limits.QueryBudget(1000)
+        for now in (100, 100.05, 100.5):
+            with patch('core.limits.time.monotonic', return_value=now):
+                budget(execute, 'SELECT 1', [], False, context)
+
+        timeouts = [call[0][1] for call in cursor.execute.call_args_list]
+        self.assertEqual(timeouts, [[1000], [500]])
+        self.assertEqual(execute.call_count, 3)
+
+    def test_busy_database_sheds_requests(self):
+        """Test requests are refused while running queries add up too long"""
+        token = limits.admission.query_started()
+        try:
+            with override_settings(ADMISSION_MAX_DB_SECONDS=0):
+                res = self.client.get(self.tags_url)
+        finally:
+            limits.admission.query_finished(token)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.json(), {'detail': 'The database is busy'})
+        self.assertEqual(self.client.get(self.tags_url).status_code, 200)
+
+    def test_long_queued_requests_are_shed(self):
+        """Test requests which waited too long at the proxy are refused"""
+        queued = time.time() - 10
+        res = self.client.get(self.tags_url, HTTP_X_REQUEST_START=f't={int(queued * 1e6)}')
+        self.assertEqual(res.status_code, 503)
+        res = self.client.get(self.tags_url, HTTP_X_REQUEST_START=f't={time.time():.3f}')
+        self.assertEqual(res.status_code, 200)
+
+
+@override_settings(DATABASE_SHARDS=['shard_a', 'shard_b'], SHARD_MAP_CACHE_SECONDS=0)
+class ShardingTest(TransactionTestCase):
+    """Test user sharding with SQLite files standing in for shards"""
+    multi_db = True
+    shards = ('shard_a', 'shard_b')
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        for alias in cls.shards:
+            connections.databases[alias] = {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(cls.tmpdir.name, f'{alias}.sqlite3'),
+            }
+        super().setUpClass()
+        for alias in cls.shards:
+            call_command('migrate', database=alias, verbosity=0)
+            sharding.reserve_id_range(alias)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        for alias in cls.shards:
+            connections[alias].close()
+            del connections.databases[alias]
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        cache.clear()
+        self.user = sample_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_recipe(self, **params):
+        payload = {'title': 'Soup', 'time_minutes': 10, 'price': '5.00'}
+        payload.update(params)
+        return self.client.post(reverse('recipe_app:recipe-list'), payload).data
+
+    def test_user_rows_placed_on_shard(self):
+        """Test a user's rows are written to and read from their shard"""
+        tag = self.client.post(reverse('recipe_app:tag-list'), {'name': 'Vegan'}).data
+        recipe = self.create_recipe(tags=[tag['id']])
+        shard = sharding.shard_for_user(self.user.id).shard
+
+        self.assertIn(shard, self.shards)
+        self.assertTrue(models.Recipe.objects.using(shard).filter(id=recipe['id']).exists())
+        self.assertFalse(models.Recipe.objects.using('default').exists())
+        self.assertGreater(recipe['id'], sharding.id_floor(shard))
+        self.assertEqual(models.Tag.objects.using(shard).get(id=tag['id']).recipe_count, 1)
+        res = self.client.get(reverse('recipe_app:recipe-list'))
+        self.assertEqual([item['id'] for item in res.data], [recipe['id']])
+
+    def test_migrations_follow_placement(self):
+        """Test sharded tables only migrate to shards and the map to default"""
+        router = db_routers.ShardRouter()
+        self.assertFalse(router.allow_migrate('shard_a', 'core', 'usershard'))
+        self.assertFalse(router.allow_migrate('other', 'core', 'recipe'))
+        self.assertIsNone(router.allow_migrate('shard_a', 'core', 'recipe_tags'))
+        self.assertIsNone(router.allow_migrate('default', 'core', 'recipe'))
+        self.assertIsNone(router.allow_migrate('shard_a', 'core', 'user'))
+
+    def test_move_user_between_shards(self):
+        """Test moving a user keeps ids and forces one full sync"""
+        tag = self.client.post(reverse('recipe_app:tag-list'), {'name': 'Vegan'}).data
+        recipe = self.create_recipe(tags=[tag['id']])
+        token = self.client.get(reverse('recipe_app:sync')).data['token']
+        source = sharding.shard_for_user(self.user.id).shard
+        target = 'shard_b' if source == 'shard_a' else 'shard_a'
+
+        self.assertTrue(sharding.move_user(self.user.id, target, wait=False))
+
+        self.assertFalse(models.Recipe.objects.using(source).exists())
+        self.assertEqual(sharding.shard_for_user(self.user.id), (target, 1, False))
+        res = self.client.get(reverse('recipe_app:recipe-detail', args=[recipe['id']]))
+        self.assertEqual([item['id'] for item in res.data['tags']], [tag['id']])
+        res = self.client.get(reverse('recipe_app:sync'), {'since': token})
+        self.assertTrue(res.data['reset'])
+        self.assertEqual([item['id'] for item in res.data['recipes']['updated']], [recipe['id']])
+        res = self.client.get(reverse('recipe_app:sync'), {'since': res.data['token']})
+        self.assertFalse(res.data['reset'])
+
+    def test_move_applies_changes_made_during_copy(self):
+        """Test writes that land on the source during a move reach the target"""
+        vegan = self.client.post(reverse('recipe_app:tag-list'), {'name': 'Vegan'}).data
+        kept = self.create_recipe(tags=[vegan['id']])
+        removed = self.create_recipe(title='Stew')
+        source = sharding.shard_for_user(self.user.id).shard
+        target = 'shard_b' if source == 'shard_a' else 'shard_a'
+
+        stale = sharding.Placement(source, 0, False)
+
+        def late_writes(seconds):
+            """Write like a process that has not seen the freeze yet"""
+            if not models.Recipe.objects.using(source).filter(id=removed['id']).exists():
+                return
+            with patch('core.db_routers.shard_for_user', return_value=stale):
+                models.Tag.objects.using(source).filter(id=vegan['id']).update(name='Plant')
+                sharding.record_changes(self.user.id, models.Tag, [vegan['id']], using=source)
+                models.Recipe.objects.using(source).get(id=removed['id']).delete()
+                spicy = models.Tag.objects.db_manager(source).create(user=self.user, name='Spicy')
+                models.Recipe.objects.using(source).get(id=kept['id']).tags.add(spicy)
+
+        with patch('core.sharding.time.sleep', side_effect=late_writes):
+            sharding.move_user(self.user.id, target)
+
+        recipes = models.Recipe.objects.using(target).filter(user=self.user)
+        self.assertEqual([recipe.id for recipe in recipes], [kept['id']])
+        self.assertEqual(
+            sorted(recipes[0].tags.values_list('name', flat=True)), ['Plant', 'Spicy']
+        )
+
+    def test_writes_refused_while_moving(self):
+        """Test API writes get a 503 while the user's move is being finished"""
+        sharding.shard_for_user(self.user.id)
+        sharding._set_placement(self.user.id, moving=True)
+
+        res = self.client.post(reverse('recipe_app:tag-list'), {'name': 'Vegan'})
+
+        self.assertEqual(res.status_code, 503)
+        self.assertIn('Retry-After', res)
+        res = self.client.get(reverse('recipe_app:tag-list'))
+        self.assertEqual(res.status_code, 200)
+
+    def test_placement_looked_up_once_per_request(self):
+        """Test the queries of one request share a single placement lookup"""
+        tag = self.client.post(reverse('recipe_app:tag-list'), {'name': 'Vegan'}).data
+        self.create_recipe(tags=[tag['id']])
+        self.create_recipe(tags=[tag['id']])
+        with patch('core.db_routers.shard_for_user', side_effect=sharding.shard_for_user) as lookup:
+            res = self.client.get(reverse('recipe_app:recipe-list'))
+        self.assertEqual(len(res.data), 2)
+        lookup.assert_called_once_with(self.user.id)
+
+    def test_relation_changes_locked_on_shard(self):
+        """Test incremental relation updates run in a transaction on the user's shard"""
+        tag = self.client.post(reverse('recipe_app:tag-list'), {'name': 'Vegan'}).data
+        recipe = self.create_recipe()
+        shard = sharding.shard_for_user(self.user.id).shard
+        with patch('recipe_app.serializers.transaction') as mock_transaction:
+            mock_transaction.atomic.side_effect = transaction.atomic
+            res = self.client.patch(
+                reverse('recipe_app:recipe-detail', args=[recipe['id']]),
+                {'tags': {'add': [tag['id']]}}, format='json',
+            )
+        self.assertEqual(res.status_code, 200)
+        mock_transaction.atomic.assert_called_once_with(using=shard)
+        tags = models.Recipe.objects.using(shard).get(id=recipe['id']).tags.values_list('id', flat=True)
+        self.assertEqual(list(tags), [tag['id']])
+
+    def test_admin_not_routed_by_staff_user(self):
+        """Test the admin works on 'default' rather than the staff user's shard"""
+        admin_user = get_user_model().objects.create_superuser('admin@davis.com', 'pass1234')
+        sharding.shard_for_user(admin_user.id)
+        models.Recipe.objects.using('default').create(
+            user=self.user, title='Kept on default', time_minutes=5, price=5
+        )
+        client = Client()
+        client.force_login(admin_user)
+        res = client.get(reverse('admin:core_recipe_changelist'))
+        self.assertContains(res, 'Kept on default')
+
+    def test_deleted_user_purged_from_shards(self):
+        """Test deleting an account removes its rows and user copy from the shards"""
+        self.client.post(reverse('recipe_app:tag-list'), {'name': 'Vegan'})
+        self.create_recipe()
+        shard = sharding.shard_for_user(self.user.id).shard
+        user_id = self.user.id
+
+        self.user.delete()
+
+        self.assertFalse(models.Recipe.objects.using(shard).exists())
+        self.assertFalse(models.Tag.objects.using(shard).exists())
+        self.assertFalse(models.Change.objects.using(shard).exists())
+        self.assertFalse(get_user_model().objects.using(shard).filter(pk=user_id).exists())
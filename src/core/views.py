@@ -1,3 +1,20 @@
-from django.shortcuts import render
+from django.db import DatabaseError, connection
+from django.http import JsonResponse
 
-# Create your views here.
+from core.db.pool import pool_stats
+
+
+def health(request):
+    """Tell the load balancer whether this process can serve requests
+
+    Also reports the state of this process's connection pools.
+    """
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    except DatabaseError:
+        return JsonResponse({'status': 'unavailable', 'pools': pool_stats()}, status=503)
+    return JsonResponse({'status': 'ok', 'pools': pool_stats()})
+
+
+health.query_timeout_ms = 1000
@@ -0,0 +1,97 @@
+import importlib
+import importlib.util
+import inspect
+import logging
+import time
+from collections import OrderedDict
+
+from django.apps import apps
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.urls import URLResolver, get_resolver
+from rest_framework import serializers
+
+logger = logging.getLogger('recipe.warmup')
+
+
+def preload_apps():
+    """Import the modules of every app that are otherwise loaded on first use"""
+    for app_config in apps.get_app_configs():
+        for name in settings.WARMUP_APP_MODULES:
+            module = f'{app_config.name}.{name}'
+            if importlib.util.find_spec(module) is not None:
+                importlib.import_module(module)
+
+
+def build_serializers():
+    """Build the field map of every serializer in WARMUP_SERIALIZER_MODULES"""
+    built = 0
+    for name in settings.WARMUP_SERIALIZER_MODULES:
+        module = importlib.import_module(name)
+        for serializer_class in vars(module).values():
+            if (
+                inspect.isclass(serializer_class)
+                and issubclass(serializer_class, serializers.BaseSerializer)
+                and serializer_class.__module__ == module.__name__
+            ):
+                serializer_class().fields
+                built += 1
+    return built
+
+
+def resolve_routes(resolver=None):
+    """Import every urlconf and populate every resolver's lookup tables"""
+    resolver = resolver or get_resolver()
+    count = 0
+    # Both are built on first access
+    resolver.reverse_dict
+    for pattern in resolver.url_patterns:
+        pattern.pattern.regex
+        if isinstance(pattern, URLResolver):
+            count += resolve_routes(pattern)
+        else:
+            count += 1
+    return count
+
+
+def open_connections():
+    """Connect to every database, returning the aliases connected to
+
+    Connections opened here are closed again, which for the pooled
+    backends fills the pool and hands the connection back to it rather
+    than keeping one checked out for the thread. A database that cannot
+    be reached is logged and skipped, so one down replica does not keep
+    the worker from starting.
+    """
+    opened = []
+    for alias in connections:
+        connection = connections[alias]
+        connected = connection.connection is not None
+        try:
+            connection.ensure_connection()
+        except DatabaseError:
+            logger.warning('warm-up could not connect to %s', alias, exc_info=True)
+        else:
+            opened.append(alias)
+            if not connected and not connection.in_atomic_block:
+                connection.close()
+    return opened
+
+
+def warm_up(connect=True):
+    """Do the one-off work of first requests ahead of them
+
+    Leave connect off where the process forks afterwards, such as in a
+    preloading master, and open the connections in each worker instead.
+    Returns how long each step took, in milliseconds.
+    """
+    steps = [('apps', preload_apps), ('serializers', build_serializers), ('routes', resolve_routes)]
+    if connect:
+        steps.append(('connections', open_connections))
+    timings = OrderedDict()
+    for name, step in steps:
+        start = time.perf_counter()
+        step()
+        timings[name] = (time.perf_counter() - start) * 1000
+    logger.info('warmed up in %s', ', '.join(f'{name} {ms:.1f} ms' for name, ms in timings.items()))
+    return timings
@@ -0,0 +1,230 @@
+import struct
+import zlib
+from collections import namedtuple
+
+# Sizes and offsets from here on need the ZIP64 extensions
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_COUNT_LIMIT = 0xFFFF
+CHUNK_SIZE = 64 * 1024
+
+# Every entry is dated 1980-01-01 00:00, the earliest DOS date, so that the
+# same members always make the same bytes
+DOS_TIME = 0
+DOS_DATE = (1 << 5) | 1
+# Sizes and CRC follow the data in a descriptor; names are UTF-8
+FLAGS = 0x0808
+STORED = 0
+UNIX = 3
+FILE_ATTRIBUTES = 0o100644 << 16
+
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+END_RECORD = struct.Struct('<4s4H2LH')
+ZIP64_END_RECORD = struct.Struct('<4sQ2H2L4Q')
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+
+Member = namedtuple('Member', 'name size open crc')
+Member.__doc__ = """A file of a ZipStream
+
+open(offset) iterates over the file's bytes from offset on; crc may be
+None, in which case it is worked out from the bytes.
+"""
+
+
+def skip_bytes(chunks, offset):
+    """Iterate over chunks of bytes leaving out the first offset bytes"""
+    for chunk in chunks:
+        if offset >= len(chunk):
+            offset -= len(chunk)
+            continue
+        yield chunk[offset:] if offset else chunk
+        offset = 0
+
+
+def file_chunks(path, offset=0):
+    """Iterate over a file's bytes from offset on"""
+    with open(path, 'rb') as stream:
+        stream.seek(offset)
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+class ZipStream:
+    """A ZIP archive of STORED members, produced on the fly
+
+    The layout only depends on the members' names and sizes, so the size
+    of the archive and where each part of it lies are known up front and
+    any byte range of it can be produced without the bytes before it.
+    CRCs, which only appear after each member's data and in the central
+    directory, are taken from the members, worked out while streaming
+    them, or read on demand. remember_crc(member, crc) is called with
+    every CRC worked out. A member whose bytes turn out not to match its
+    size or CRC raises ValueError rather than making a corrupt archive.
+    """
+
+    def __init__(self, members, remember_crc=None):
+        self.members = list(members)
+        self.remember_crc = remember_crc
+        self._crcs = {}
+        self._segments = []
+        self._names = [member.name.encode('utf-8') for member in self.members]
+        self._offsets = []
+        position = 0
+        for index, member in enumerate(self.members):
+            self._offsets.append(position)
+            header = self._local_header(index)
+            position = self._add(position, len(header), self._bytes(header))
+            position = self._add(position, member.size, self._data(index))
+            size = 24 if self._zip64(member) else 16
+            position = self._add(position, size, self._descriptor(index))
+        self._directory_offset = position
+        self._record_sizes = [len(self._central_header(index, crc=0)) for index in range(len(self.members))]
+        self._directory_size = sum(self._record_sizes)
+        tail_size = self._directory_size + len(self._end_records())
+        self.size = self._add(position, tail_size, self._tail)
+
+    def _add(self, start, size, produce):
+        self._segments.append((start, size, produce))
+        return start + size
+
+    @staticmethod
+    def _zip64(member):
+        return member.size >= ZIP64_LIMIT
+
+    def _local_header(self, index):
+        name = self._names[index]
+        if self._zip64(self.members[index]):
+            extra = struct.pack('<2H2Q', 1, 16, 0, 0)
+            version, size = 45, 0xFFFFFFFF
+        else:
+            extra, version, size = b'', 20, 0
+        return LOCAL_HEADER.pack(
+            b'PK\x03\x04', version, 0, FLAGS, STORED, DOS_TIME, DOS_DATE, 0, size, size,
+            len(name), len(extra),
+        ) + name + extra
+
+    def _central_header(self, index, crc):
+        member, name, offset = self.members[index], self._names[index], self._offsets[index]
+        fields = []
+        size = member.size
+        if self._zip64(member):
+            fields += [size, size]
+            size = 0xFFFFFFFF
+        if offset >= ZIP64_LIMIT:
+            fields.append(offset)
+            offset = 0xFFFFFFFF
+        extra = struct.pack(f'<2H{len(fields)}Q', 1, 8 * len(fields), *fields) if fields else b''
+        version = 45 if fields else 20
+        return CENTRAL_HEADER.pack(
+            b'PK\x01\x02', version, UNIX, version, 0, FLAGS, STORED, DOS_TIME, DOS_DATE,
+            crc, size, size, len(name), len(extra), 0, 0, 0, FILE_ATTRIBUTES, offset,
+        ) + name + extra
+
+    def _end_records(self):
+        count, size, offset = len(self.members), self._directory_size, self._directory_offset
+        records = b''
+        if count >= ZIP_COUNT_LIMIT or size >= ZIP64_LIMIT or offset >= ZIP64_LIMIT:
+            records += ZIP64_END_RECORD.pack(
+                b'PK\x06\x06', ZIP64_END_RECORD.size - 12, 45, 45, 0, 0, count, count, size, offset,
+            )
+            records += ZIP64_LOCATOR.pack(b'PK\x06\x07', 0, offset + size, 1)
+            count = 0xFFFF if count >= ZIP_COUNT_LIMIT else count
+            size = 0xFFFFFFFF if size >= ZIP64_LIMIT else size
+            offset = 0xFFFFFFFF if offset >= ZIP64_LIMIT else offset
+        return records + END_RECORD.pack(b'PK\x05\x06', 0, 0, count, count, size, offset, 0)
+
+    def _learn_crc(self, index, crc):
+        self._crcs[index] = crc
+        if self.remember_crc is not None:
+            self.remember_crc(self.members[index], crc)
+
+    def crc(self, index):
+        """Return a member's CRC, reading the member if it is not known yet"""
+        if index not in self._crcs:
+            member = self.members[index]
+            if member.crc is not None:
+                self._crcs[index] = member.crc
+            else:
+                size, crc = 0, 0
+                for chunk in member.open(0):
+                    size += len(chunk)
+                    crc = zlib.crc32(chunk, crc)
+                if size != member.size:
+                    raise ValueError(f'{member.name} changed while being archived')
+                self._learn_crc(index, crc)
+        return self._crcs[index]
+
+    @staticmethod
+    def _bytes(data):
+        def produce(start, stop):
+            yield data[start:stop]
+        return produce
+
+    def _data(self, index):
+        member = self.members[index]
+
+        def produce(start, stop):
+            # Read to the end of a member streamed up to its end, to tell
+            # whether it grew
+            to_end = stop == member.size
+            chunks = member.open(start)
+            position, crc = start, 0
+            try:
+                for chunk in chunks:
+                    if position + len(chunk) > stop:
+                        if to_end:
+                            raise ValueError(f'{member.name} grew while being archived')
+                        chunk = chunk[:stop - position]
+                    crc = zlib.crc32(chunk, crc)
+                    position += len(chunk)
+                    yield chunk
+                    if position >= stop and not to_end:
+                        break
+            finally:
+                getattr(chunks, 'close', lambda: None)()
+            if position != stop:
+                raise ValueError(f'{member.name} shrank while being archived')
+            if start == 0 and to_end:
+                known = self._crcs.get(index, member.crc)
+                if known is None:
+                    self._learn_crc(index, crc)
+                elif crc != known:
+                    raise ValueError(f'{member.name} changed while being archived')
+        return produce
+
+    def _descriptor(self, index):
+        def produce(start, stop):
+            member = self.members[index]
+            layout = '<4sL2Q' if self._zip64(member) else '<4s3L'
+            descriptor = struct.pack(layout, b'PK\x07\x08', self.crc(index), member.size, member.size)
+            yield descriptor[start:stop]
+        return produce
+
+    def _tail(self, start, stop):
+        position = 0
+        for index, size in enumerate(self._record_sizes):
+            if position + size > start:
+                record = self._central_header(index, self.crc(index))
+                yield record[max(start - position, 0):stop - position]
+            position += size
+            if position >= stop:
+                return
+        records = self._end_records()
+        yield records[max(start - position, 0):stop - position]
+
+    def iter_range(self, start=0, stop=None):
+        """Iterate over the bytes of the archive from start up to stop"""
+        stop = self.size if stop is None else stop
+        for segment_start, size, produce in self._segments:
+            segment_stop = segment_start + size
+            if segment_stop <= start or not size:
+                continue
+            if segment_start >= stop:
+                return
+            yield from produce(max(start, segment_start) - segment_start, min(stop, segment_stop) - segment_start)
+
+    def __iter__(self):
+        return self.iter_range()
@@ -0,0 +1,36 @@
+import os
+
+# Server-sent event streams stay open for up to EVENT_STREAM_MAX_SECONDS,
+# which only gevent workers can afford: a sync worker would be tied up by
+# each stream and killed by its timeout long before the stream ends. Each
+# gevent worker serves up to worker_connections requests at once, and
+# timeout only bounds how long it may go without checking in.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+# With WSGI_WARM_UP=1 the app is loaded and warmed up once in the master,
+# shared by the forked workers, which each open their own connections.
+preload_app = bool(os.environ.get('WSGI_WARM_UP'))
+
+if worker_class == 'gevent':
+    # Patched before anything, the preloaded app included, creates locks
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # psycopg2 waits on the socket without yielding to other greenlets
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    if preload_app:
+        from core.warmup import open_connections
+        open_connections()
+
+
+def worker_exit(server, worker):
+    from core.db.pool import close_pools
+    close_pools()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
+import importlib.util
 import os
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -45,11 +46,20 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so that shed requests cost as little as possible
+    'core.middleware.AdmissionMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    # Must wrap everything that reads or writes response bodies. A site or
+    # per-view cache middleware should go outside it (UpdateCacheMiddleware
+    # above, FetchFromCacheMiddleware below) to store compressed variants.
+    'core.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.middleware.DatabaseRoutingMiddleware',
+    'core.middleware.SlowQueryMiddleware',
+    'core.middleware.QueryTimeoutMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -75,18 +85,43 @@ TEMPLATES = [
 WSGI_APPLICATION = 'recipe.wsgi.application'
 
 
+# How many requests one worker process serves at once: gevent workers, the
+# default in gunicorn.conf.py, up to GUNICORN_WORKER_CONNECTIONS, any other
+# worker class one at a time. What is kept per process is sized from it.
+WORKER_CLASS = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+WORKER_CONCURRENCY = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000)) if WORKER_CLASS == 'gevent' else 1
+
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
 
 # MAKE SURE TO CHANGE THIS TO ENVIRONMENT VIRIABLES!!!
+# The core.db backends keep each process's connections in a pool: Django
+# returns them at the end of every request instead of closing them. POOL
+# sets, per database, how many to keep open (MIN_SIZE) and allow
+# (MAX_SIZE), how many seconds to wait for a free one (TIMEOUT), and when
+# to close those idle (MAX_IDLE) or old (MAX_LIFETIME, None for never).
+# Every worker process has pools of its own, so the database sees up to
+# MAX_SIZE connections per worker. A worker serving one request at a time
+# needs a single one; a gevent worker may run GUNICORN_WORKER_CONNECTIONS
+# requests at once, far more than the database can take connections, so
+# its requests share DATABASE_POOL_SIZE connections, waiting up to TIMEOUT
+# for one. Set it so that workers times DATABASE_POOL_SIZE fits the
+# server's max_connections.
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 10 if WORKER_CONCURRENCY > 1 else 1))
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'ENGINE': 'core.db.postgresql',
         'HOST': 'localhost',
         'NAME': 'recipedb',
         'USER': 'recipe',
-        'PASSWORD': 'pass1234'
-        
+        'PASSWORD': 'pass1234',
+        'POOL': {
+            'MIN_SIZE': 1,
+            'MAX_SIZE': DATABASE_POOL_SIZE,
+            'TIMEOUT': 5,
+            'MAX_IDLE': 300,
+            'MAX_LIFETIME': 3600,
+        },
     },
     'TEST': {
             'ENGINE': 'django.db.backends.sqlite3',
@@ -94,6 +129,254 @@ DATABASES = {
         },
 }
 
+# Read replicas of 'default', one per host in DATABASE_REPLICA_HOSTS
+# (comma separated). Safe requests on views with replica_reads = True read
+# from a healthy replica; a user who just wrote reads from the primary for
+# REPLICA_PIN_SECONDS so they always see their own writes.
+DATABASE_REPLICAS = []
+for index, host in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_HOSTS', '').split(','))):
+    alias = f'replica{index + 1}'
+    DATABASES[alias] = dict(DATABASES['default'], HOST=host.strip(), TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append(alias)
+
+# User shards, one database per name in DATABASE_SHARD_NAMES (comma
+# separated) on the 'default' server. A user's recipes, tags, ingredients
+# and their derived rows live on their shard; accounts, tokens and the
+# shard map stay on 'default'. Run manage.py migrate_shards after adding
+# a shard and move_user_shard to rebalance. Empty keeps all on 'default'.
+DATABASE_SHARDS = []
+for index, name in enumerate(filter(None, os.environ.get('DATABASE_SHARD_NAMES', '').split(','))):
+    alias = f'shard{index + 1}'
+    DATABASES[alias] = dict(DATABASES['default'], NAME=name.strip())
+    DATABASE_SHARDS.append(alias)
+
+DATABASE_ROUTERS = ['core.db_routers.ShardRouter', 'core.db_routers.ReplicaRouter']
+
+# How long a user's shard placement is cached, and so how long a move
+# waits for every process to see it
+SHARD_MAP_CACHE_SECONDS = 5
+# Size of the id range each shard creates rows in, keeping ids unique
+# across shards (ranges must fit a 32-bit id: at most 21 databases)
+SHARD_ID_BLOCK = 10 ** 8
+
+REPLICA_PIN_SECONDS = 5
+REPLICA_HEALTH_CHECK_SECONDS = 10
+
+# Response compression: brotli (when installed) or gzip for text, JSON and
+# MessagePack bodies of at least COMPRESSION_MIN_LENGTH bytes. Compressed
+# bodies are cached for COMPRESSION_CACHE_SECONDS by digest in the
+# 'compression' cache (0 disables).
+COMPRESSION_MIN_LENGTH = 1024
+COMPRESSION_MEDIA_TYPES = ('application/json', 'application/msgpack')
+COMPRESSION_GZIP_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 5
+COMPRESSION_CACHE_SECONDS = 60
+
+# orjson backs the JSON renderer and parser when installed; msgpack adds
+# application/msgpack for internal services
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'core.renderers.OrjsonRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'core.parsers.OrjsonParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+}
+if importlib.util.find_spec('msgpack'):
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'].insert(1, 'core.renderers.MessagePackRenderer')
+    REST_FRAMEWORK['DEFAULT_PARSER_CLASSES'].insert(1, 'core.parsers.MessagePackParser')
+
+# The cache must be shared by every worker process: per-user result
+# versions, the autocomplete index versions, replica read pins, shard
+# placements and Idempotency-Key locks all rely on every worker seeing the
+# same entries, and the export sizes and CRCs are worth working out only
+# once. Deployments point CACHE_LOCATION at their memcached servers (host:port,
+# comma separated). Without it the entries go to database tables made by
+# manage.py createcachetable, which is enough for development, but puts a
+# query on the primary, and a COUNT of the table on every write, behind
+# every cache operation.
+CACHE_LOCATION = [location.strip() for location in os.environ.get('CACHE_LOCATION', '').split(',') if location.strip()]
+if CACHE_LOCATION:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': CACHE_LOCATION,
+            'KEY_PREFIX': 'recipe',
+        },
+        # Idempotency-Key locks and stored responses
+        'idempotency': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': CACHE_LOCATION,
+            'KEY_PREFIX': 'recipe-idempotency',
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'cache_entries',
+            'OPTIONS': {'MAX_ENTRIES': 100000},
+        },
+        # In a table of their own, so that no other entries can push them
+        # out before IDEMPOTENCY_TTL
+        'idempotency': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'idempotency_keys',
+            'OPTIONS': {'MAX_ENTRIES': 100000},
+        },
+    }
+# Compressed response bodies, which each process can recompute at will
+CACHES['compression'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'compression',
+    'OPTIONS': {'MAX_ENTRIES': 1000},
+}
+
+# Seconds a per-user cached result (facets, stats...) is kept. Entries are
+# also invalidated as soon as the user changes a recipe, tag or ingredient.
+USER_CACHE_TIMEOUT = 60 * 15
+# Seconds a user's cache version is kept; it outlives everything cached
+# against it, and in-process copies (the autocomplete index) are rebuilt
+# at least this often
+USER_VERSION_TIMEOUT = 60 * 60
+
+# Number of histogram buckets and top tags/ingredients in recipe stats
+RECIPE_STATS_BUCKETS = 10
+RECIPE_STATS_TOP = 5
+
+# Similar recipes kept per recipe and how they are scored ('jaccard' or 'cosine')
+RECIPE_SIMILAR_K = 10
+RECIPE_SIMILARITY_METRIC = 'jaccard'
+
+# Queries slower than SLOW_QUERY_THRESHOLD_MS made by a view are logged,
+# with the view and action, to a rotating SLOW_QUERY_LOG_FILE; a share
+# SLOW_QUERY_EXPLAIN_RATE of them also gets its EXPLAIN plan. None turns
+# logging off. manage.py slow_queries summarises the log.
+SLOW_QUERY_THRESHOLD_MS = 200
+SLOW_QUERY_EXPLAIN_RATE = 0.1
+SLOW_QUERY_LOG_FILE = os.environ.get('SLOW_QUERY_LOG_FILE', os.path.join(BASE_DIR, 'slow_queries.log'))
+SLOW_QUERY_LOG_BACKUPS = 5
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'slow_queries': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': SLOW_QUERY_LOG_FILE,
+            'maxBytes': 10 * 1024 * 1024,
+            'backupCount': SLOW_QUERY_LOG_BACKUPS,
+            'delay': True,
+            'formatter': 'message',
+        },
+    },
+    'loggers': {
+        'recipe.slow_queries': {
+            'handlers': ['slow_queries'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
+# Worker warm-up (WSGI_WARM_UP=1): the modules imported from every app,
+# and the modules whose serializers get their fields built
+WARMUP_APP_MODULES = ('admin', 'serializers', 'views', 'urls')
+WARMUP_SERIALIZER_MODULES = ('recipe_app.serializers', 'user.serializers')
+
+# Time budget in milliseconds for the queries of one request, for views
+# without a query_timeout_ms of their own; None sets no limit
+QUERY_TIMEOUT_MS = 5000
+
+# Most ids one filter param (?tags=, ?ingredients=, ?ids=...) may list
+FILTER_MAX_IDS = 1000
+
+# Load shedding: each process answers 503 with Retry-After when a request
+# queued for over ADMISSION_MAX_QUEUE_MS (from the proxy's X-Request-Start
+# header), when the process is running over ADMISSION_MAX_IN_FLIGHT
+# requests, or when its running queries add up to over
+# ADMISSION_MAX_DB_SECONDS. The last two are counted per process, so they
+# are left off for workers serving one request at a time, which could
+# never trip them. The in-flight limit stays well short of the worker's
+# connections, so that a busy process answers 503 rather than leaving
+# requests in its backlog. None turns a check off. Health checks and
+# logins are always served.
+if WORKER_CONCURRENCY > 1:
+    ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', WORKER_CONCURRENCY // 4))
+    ADMISSION_MAX_DB_SECONDS = 30
+else:
+    ADMISSION_MAX_IN_FLIGHT = ADMISSION_MAX_DB_SECONDS = None
+ADMISSION_MAX_QUEUE_MS = 5000
+ADMISSION_RETRY_AFTER = 1
+ADMISSION_PRIORITY_PATHS = ('/health/', '/api/user/token/')
+
+# Idempotency-Key on create endpoints: responses are kept IDEMPOTENCY_TTL
+# seconds in the 'idempotency' cache. A duplicate of a request still
+# running polls for its response every IDEMPOTENCY_POLL_SECONDS, which
+# only costs a gevent worker a greenlet, and gets a 409, to be retried
+# after IDEMPOTENCY_RETRY_AFTER seconds, if none comes within
+# IDEMPOTENCY_LOCK_SECONDS
+IDEMPOTENCY_TTL = 60 * 60 * 24
+IDEMPOTENCY_LOCK_SECONDS = 60
+IDEMPOTENCY_POLL_SECONDS = 0.1
+IDEMPOTENCY_RETRY_AFTER = 1
+
+# Admin changelists count up to this many rows exactly and estimate
+# beyond it from PostgreSQL's statistics
+ADMIN_EXACT_COUNT_LIMIT = 10000
+
+# Keep each recipe's rendered JSON in RecipeDocument, rebuilt on every
+# change, and serve retrieve and list from it. After turning this on run
+# manage.py check_recipe_documents --repair to render existing recipes.
+RECIPE_DOCUMENTS = False
+
+# Tag/ingredient autocomplete: users with at most AUTOCOMPLETE_MAX_INDEX_SIZE
+# names get an in-process prefix index, kept for the most recent users only.
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_INDEX_SIZE = 5000
+AUTOCOMPLETE_CACHED_USERS = 1000
+
+# Most changes returned by one /api/recipe/sync/ call
+SYNC_PAGE_SIZE = 500
+# Days tombstones of deleted objects are kept, for manage.py
+# prune_tombstones. Clients that last synced before a pruned tombstone
+# are sent back to a full sync.
+SYNC_TOMBSTONE_DAYS = 90
+
+# Most copies one POST /recipes/{id}/clone/ may create
+RECIPE_CLONE_MAX = 100
+
+# Most recipe ids one shopping list may combine
+SHOPPING_LIST_MAX_RECIPES = 500
+
+# Recipe export archives: rows rendered per query, and how long the CRCs
+# worked out for an export and its images, and the snapshots an export's
+# NDJSON is streamed from, are kept. Snapshots live under
+# EXPORT_SNAPSHOT_ROOT, which like MEDIA_ROOT all workers share but which
+# is not served; one whose rows changed while it was rendered is rendered
+# again, up to EXPORT_SNAPSHOT_ATTEMPTS times
+EXPORT_BATCH_SIZE = 500
+EXPORT_CACHE_SECONDS = 60 * 60 * 24
+EXPORT_SNAPSHOT_ROOT = os.path.join(BASE_DIR, 'export_snapshots')
+EXPORT_SNAPSHOT_ATTEMPTS = 3
+
+# Most recipe details one GET /recipes/?ids= may return
+RECIPE_MULTI_GET_MAX = 500
+
+# Server-sent events: how often an idle stream polls the change log (which
+# also picks up writes made by other processes), the reconnect delay sent
+# to clients and how long a stream lives before the client reconnects.
+# Streams need the gevent workers configured in gunicorn.conf.py.
+EVENT_STREAM_POLL_SECONDS = 15
+EVENT_STREAM_RETRY_MS = 3000
+EVENT_STREAM_MAX_SECONDS = 300
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -16,3 +16,10 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'recipe.settings')
 
 application = get_wsgi_application()
 application = DjangoWhiteNoise(application)
+
+# WSGI_WARM_UP=1 does the one-off work of first requests at import time.
+# Connections are left to each worker (see gunicorn.conf.py), as this may
+# run in a master that forks afterwards.
+if os.environ.get('WSGI_WARM_UP'):
+    from core.warmup import warm_up
+    warm_up(connect=False)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class RecipeAppConfig(AppConfig):
     name = 'recipe_app'
+
+    def ready(self):
+        """Connect the recipe document signal handlers"""
+        from recipe_app import signals  # noqa: F401
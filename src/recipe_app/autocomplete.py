@@ -0,0 +1,82 @@
+import bisect
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from core.cache import get_user_version
+from core.models import normalize_name
+
+
+class PrefixIndex:
+    """Sorted normalized names of one user's tags or ingredients"""
+
+    def __init__(self, rows):
+        rows = sorted(rows, key=lambda row: row['search_name'])
+        self.keys = [row['search_name'] for row in rows]
+        self.rows = rows
+
+    def search(self, prefix, limit):
+        """Return the limit most used rows whose name starts with prefix"""
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + '\U0010ffff', lo=start)
+        matches = self.rows[start:end]
+        return heapq.nsmallest(
+            limit, matches, key=lambda row: (-row['recipe_count'], row['search_name'], row['id'])
+        )
+
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def _load_rows(queryset):
+    return list(queryset.values('id', 'name', 'recipe_count', 'search_name'))
+
+
+def _get_index(queryset, user_id):
+    """Return the user's in-process index, rebuilding it after any write
+
+    None is cached instead for users with more rows than
+    AUTOCOMPLETE_MAX_INDEX_SIZE, who are served from the database. An
+    index is also rebuilt once older than USER_VERSION_TIMEOUT.
+    """
+    key = (queryset.model._meta.label, user_id)
+    version = get_user_version(user_id)
+    now = time.monotonic()
+    with _lock:
+        cached = _indexes.get(key)
+        if cached is not None and cached[0] == version and now - cached[1] < settings.USER_VERSION_TIMEOUT:
+            _indexes.move_to_end(key)
+            return cached[2]
+    size = settings.AUTOCOMPLETE_MAX_INDEX_SIZE
+    rows = _load_rows(queryset.order_by()[:size + 1])
+    index = PrefixIndex(rows) if len(rows) <= size else None
+    with _lock:
+        _indexes[key] = (version, now, index)
+        _indexes.move_to_end(key)
+        while len(_indexes) > settings.AUTOCOMPLETE_CACHED_USERS:
+            _indexes.popitem(last=False)
+    return index
+
+
+def autocomplete(queryset, user_id, prefix, limit):
+    """Find the user's most used names starting with prefix
+
+    Small libraries are served from an in-process sorted index; large ones
+    fall back to a prefix range scan on the indexed search_name column.
+    """
+    prefix = normalize_name(prefix)
+    index = _get_index(queryset, user_id)
+    if index is None:
+        matches = _load_rows(queryset.filter(search_name__startswith=prefix).order_by(
+            '-recipe_count', 'search_name', 'id'
+        )[:limit])
+    else:
+        matches = index.search(prefix, limit)
+    return [
+        {'id': row['id'], 'name': row['name'], 'recipe_count': row['recipe_count']}
+        for row in matches
+    ]
@@ -0,0 +1,68 @@
+from django.db import router, transaction
+
+from core.models import Recipe, RecipeDocument
+from core.renderers import OrjsonRenderer
+from .serializers import RecipeSerializer, RecipeDocumentSerializer
+
+
+def render_document(recipe):
+    """Render the detail and list representations of a recipe"""
+    renderer = OrjsonRenderer()
+    return RecipeDocument(
+        recipe_id=recipe.pk,
+        detail=renderer.render(RecipeDocumentSerializer(recipe).data).decode(),
+        summary=renderer.render(RecipeSerializer(recipe).data).decode(),
+    )
+
+
+def _render_documents(ids, using):
+    recipes = Recipe.objects.using(using).filter(id__in=ids).prefetch_related(
+        'tags', 'ingredients'
+    )
+    return [render_document(recipe) for recipe in recipes]
+
+
+def rebuild_documents(recipe_ids, using=None, batch_size=500):
+    """Re-render the stored documents of the given recipes, a batch at a time"""
+    ids = sorted(set(recipe_ids))
+    using = using or router.db_for_write(RecipeDocument)
+    rebuilt = 0
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        documents = _render_documents(batch, using)
+        with transaction.atomic(using=using):
+            RecipeDocument.objects.using(using).filter(recipe_id__in=batch).delete()
+            RecipeDocument.objects.using(using).bulk_create(documents)
+        rebuilt += len(documents)
+    return rebuilt
+
+
+def check_documents(queryset, repair=False, batch_size=500):
+    """Compare the stored documents of the queryset's recipes with fresh ones
+
+    Returns counts of the recipes checked, missing a document and with a
+    stale one. With repair the missing and stale documents are rebuilt.
+    """
+    using = queryset.db
+    ids = list(queryset.order_by('id').values_list('id', flat=True))
+    result = {'checked': 0, 'missing': 0, 'stale': 0}
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        stored = {
+            document.recipe_id: document
+            for document in RecipeDocument.objects.using(using).filter(recipe_id__in=batch)
+        }
+        drifted = []
+        for fresh in _render_documents(batch, using):
+            document = stored.get(fresh.recipe_id)
+            if document is None:
+                result['missing'] += 1
+            elif (document.detail, document.summary) != (fresh.detail, fresh.summary):
+                result['stale'] += 1
+            else:
+                continue
+            drifted.append(fresh.recipe_id)
+        result['checked'] += len(batch)
+        if repair:
+            rebuild_documents(drifted, using)
+    return result
@@ -0,0 +1,233 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import zlib
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db.models import Prefetch
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework.exceptions import APIException
+
+from core.db_routers import for_user
+from core.models import Tag, Ingredient, Recipe
+from core.renderers import OrjsonRenderer
+from core.sharding import user_epoch
+from core.sync import latest_change
+from core.zipstream import Member, ZipStream, file_chunks
+from .serializers import TagSerializer, IngredientSerializer, RecipeSerializer
+
+FILENAME = 'recipes-export.zip'
+
+
+class ExportChanging(APIException):
+    status_code = 503
+    default_detail = 'The data kept changing while it was exported, try again.'
+    default_code = 'export_changing'
+    wait = 1
+
+
+def _images(user):
+    """Map the user's recipe images found in MEDIA_ROOT to (archive name, path, stat)"""
+    with for_user(user.id):
+        names = Recipe.objects.filter(user=user).exclude(image='').exclude(image=None).order_by(
+            'id'
+        ).values_list('image', flat=True)
+        names = list(OrderedDict.fromkeys(names))
+    images = OrderedDict()
+    for name in names:
+        path = default_storage.path(name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        images[name] = (f'images/{name}', path, stat)
+    return images
+
+
+def _version(user, images):
+    digest = hashlib.sha1(f'{user.id}:{user_epoch(user.id)}:{latest_change(user)}\n'.encode())
+    for name, (archive_name, path, stat) in images.items():
+        digest.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+
+def _lines(user, queryset, serializer_class, extra=None):
+    """Yield the queryset's rows as NDJSON, one batch of rows at a time"""
+    renderer = OrjsonRenderer()
+    last = 0
+    while True:
+        with for_user(user.id):
+            batch = list(queryset.filter(id__gt=last).order_by('id')[:settings.EXPORT_BATCH_SIZE])
+            lines = [
+                renderer.render(dict(serializer_class(row).data, **(extra(row) if extra else {})))
+                for row in batch
+            ]
+        if not batch:
+            return
+        last = batch[-1].id
+        yield b'\n'.join(lines) + b'\n'
+
+
+def _sections(user, images):
+    """Return the (name, lines) of the NDJSON members of the user's export"""
+    def image_of(recipe):
+        return {'image': images[recipe.image.name][0] if recipe.image.name in images else None}
+
+    return [
+        ('tags.ndjson', partial(_lines, user, Tag.objects.filter(user=user), TagSerializer)),
+        ('ingredients.ndjson', partial(
+            _lines, user, Ingredient.objects.filter(user=user), IngredientSerializer
+        )),
+        ('recipes.ndjson', partial(
+            _lines, user, Recipe.objects.filter(user=user).prefetch_related(
+                Prefetch('tags', queryset=Tag.objects.order_by('id')),
+                Prefetch('ingredients', queryset=Ingredient.objects.order_by('id')),
+            ),
+            RecipeSerializer, image_of,
+        )),
+    ]
+
+
+def _crc_key(path, stat):
+    return f'export-crc:{hashlib.sha1(path.encode()).hexdigest()}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def _write(directory, name, chunks):
+    """Write chunks to a temporary file next to name, returning its path and CRC"""
+    handle, path = tempfile.mkstemp(dir=directory, prefix=f'.{name}.')
+    crc = 0
+    with os.fdopen(handle, 'wb') as stream:
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            stream.write(chunk)
+    return path, crc
+
+
+def _prune(user_directory, kept):
+    """Remove the user's other snapshots once EXPORT_CACHE_SECONDS old"""
+    cutoff = time.time() - settings.EXPORT_CACHE_SECONDS
+    for entry in os.scandir(user_directory):
+        if entry.name != kept and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def _snapshot(user):
+    """Return the version, images and NDJSON snapshot files of the user's export
+
+    The NDJSON members are rendered once per version into files under
+    EXPORT_SNAPSHOT_ROOT, and every download of that version streams
+    those files, so its bytes cannot change under a download or between
+    a download and its resumption. A snapshot is only kept when the
+    version read after rendering it is still the one read before, so its
+    rows are the ones of that version; otherwise it is rendered again, up
+    to EXPORT_SNAPSHOT_ATTEMPTS times before giving up with a 503.
+    """
+    for attempt in range(settings.EXPORT_SNAPSHOT_ATTEMPTS):
+        images = _images(user)
+        version = _version(user, images)
+        user_directory = os.path.join(settings.EXPORT_SNAPSHOT_ROOT, str(user.id))
+        directory = os.path.join(user_directory, version)
+        sections = _sections(user, images)
+        files = [(name, os.path.join(directory, name)) for name, lines in sections]
+        if all(os.path.exists(path) for name, path in files):
+            return version, images, files
+        os.makedirs(directory, exist_ok=True)
+        written = [_write(directory, name, lines()) for name, lines in sections]
+        if _version(user, _images(user)) != version:
+            for path, crc in written:
+                os.remove(path)
+            continue
+        for (path, crc), (name, final) in zip(written, files):
+            os.replace(path, final)
+            cache.set(_crc_key(final, os.stat(final)), crc, settings.EXPORT_CACHE_SECONDS)
+        _prune(user_directory, version)
+        return version, images, files
+    raise ExportChanging()
+
+
+def build_export(user):
+    """Return the ZipStream of the user's data export and its strong ETag
+
+    The archive holds tags.ndjson, ingredients.ndjson and recipes.ndjson,
+    streamed from the snapshot of the export's version, then the recipe
+    images under images/. Its bytes only change with the user's change
+    log and image files, which the ETag is made from, so every row and
+    the ids it lists come in id order. The CRCs of the snapshot files and
+    images are kept for EXPORT_CACHE_SECONDS in the shared default cache,
+    so a download resumed on another worker does not read everything
+    again. An image replaced while it is streamed fails the download
+    rather than corrupting the archive.
+    """
+    version, images, files = _snapshot(user)
+    files = [(name, path, os.stat(path)) for name, path in files] + list(images.values())
+    members, crc_keys = [], {}
+    for archive_name, path, stat in files:
+        crc_keys[archive_name] = _crc_key(path, stat)
+        members.append(Member(
+            archive_name, stat.st_size, partial(file_chunks, path), cache.get(crc_keys[archive_name])
+        ))
+
+    def remember_crc(member, crc):
+        if member.name in crc_keys:
+            cache.set(crc_keys[member.name], crc, settings.EXPORT_CACHE_SECONDS)
+
+    return ZipStream(members, remember_crc), f'"{version}"'
+
+
+def parse_range(header, size):
+    """Return the (start, stop) of a single bytes Range header
+
+    None means the header is to be ignored, False that the range lies
+    outside the content.
+    """
+    unit, _, spec = header.partition('=')
+    first, dash, last = spec.strip().partition('-')
+    if unit.strip().lower() != 'bytes' or ',' in spec or not dash:
+        return None
+    try:
+        if first:
+            start = int(first)
+            stop = int(last) + 1 if last else size
+            if start < 0 or (last and stop <= start):
+                return None
+        else:
+            suffix = int(last)
+            if suffix < 0:
+                return None
+            start, stop = max(size - suffix, 0), size
+    except ValueError:
+        return None
+    if start >= size or stop == start:
+        return False
+    return start, min(stop, size)
+
+
+def export_response(request, archive, etag):
+    """Stream the archive, or the part of it asked for with Range"""
+    start, stop, status = 0, archive.size, 200
+    byte_range = request.META.get('HTTP_RANGE')
+    if byte_range and request.META.get('HTTP_IF_RANGE', etag) == etag:
+        parsed = parse_range(byte_range, archive.size)
+        if parsed is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{archive.size}'
+            return response
+        if parsed:
+            (start, stop), status = parsed, 206
+
+    content = [] if request.method == 'HEAD' else archive.iter_range(start, stop)
+    response = StreamingHttpResponse(content, status=status, content_type='application/zip')
+    response['Content-Length'] = str(stop - start)
+    if status == 206:
+        response['Content-Range'] = f'bytes {start}-{stop - 1}/{archive.size}'
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Content-Disposition'] = f'attachment; filename="{FILENAME}"'
+    response['Cache-Control'] = 'private'
+    return response
@@ -1,12 +1,63 @@
+from django.db import router, transaction
+from django.utils.translation import ugettext_lazy as _
 from rest_framework import serializers
+from rest_framework.relations import MANY_RELATION_KWARGS
 from core.models import Tag, Ingredient, Recipe
 
+
+class RelationChanges:
+    """Objects to add to and remove from one relation of a recipe"""
+
+    def __init__(self, add, remove):
+        self.add = add
+        self.remove = remove
+
+
+class ManyRelatedChangesField(serializers.ManyRelatedField):
+    """Accept either the full id list or {"add": [...], "remove": [...]}"""
+    operations = ('add', 'remove')
+
+    def to_internal_value(self, data):
+        if not isinstance(data, dict):
+            return super().to_internal_value(data)
+        unknown = set(data) - set(self.operations)
+        if unknown:
+            raise serializers.ValidationError(
+                _('Unknown operations: %s') % ', '.join(sorted(unknown))
+            )
+        objects = {
+            operation: super(ManyRelatedChangesField, self).to_internal_value(data.get(operation, []))
+            for operation in self.operations
+        }
+        if set(objects['add']) & set(objects['remove']):
+            raise serializers.ValidationError(_('Cannot add and remove the same id'))
+        return RelationChanges(objects['add'], objects['remove'])
+
+
+class UserPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """Primary key field limited to the requesting user's objects"""
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        request = self.context.get('request')
+        if request is not None:
+            queryset = queryset.filter(user=request.user)
+        return queryset
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return ManyRelatedChangesField(**list_kwargs)
+
 class TagSerializer(serializers.ModelSerializer):
     """Serializer for the tag object"""
     class Meta:
         model = Tag
-        fields = ('id', 'name')
-        read_only_fields = ('id', )
+        fields = ('id', 'name', 'recipe_count')
+        read_only_fields = ('id', 'recipe_count')
 
 
 class IngredientSerializer(serializers.ModelSerializer):
@@ -14,17 +65,17 @@ class IngredientSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Ingredient
-        fields = ('id', 'name')
-        read_only_fields = ('id',)
+        fields = ('id', 'name', 'recipe_count')
+        read_only_fields = ('id', 'recipe_count')
 
 
 class RecipeSerializer(serializers.ModelSerializer):
     """Serialize a recipe"""
-    ingredients = serializers.PrimaryKeyRelatedField(
+    ingredients = UserPrimaryKeyRelatedField(
         many=True,
         queryset=Ingredient.objects.all()
     )
-    tags = serializers.PrimaryKeyRelatedField(
+    tags = UserPrimaryKeyRelatedField(
         many=True,
         queryset=Tag.objects.all()
     )
@@ -33,6 +84,50 @@ class RecipeSerializer(serializers.ModelSerializer):
         fields = ('id', 'title', 'ingredients', 'tags', 'time_minutes', 'price', 'link')
         read_only_fields = ('id',)
 
+    def _pop_relation_changes(self, validated_data):
+        return {
+            name: validated_data.pop(name)
+            for name in ('ingredients', 'tags')
+            if isinstance(validated_data.get(name), RelationChanges)
+        }
+
+    def create(self, validated_data):
+        if self._pop_relation_changes(validated_data):
+            raise serializers.ValidationError(_('New recipes take plain id lists'))
+        return super().create(validated_data)
+
+    def update(self, instance, validated_data):
+        """Update the recipe, applying add/remove operations incrementally"""
+        changes = self._pop_relation_changes(validated_data)
+        # The transaction and the lock must be on the recipe's own shard
+        using = router.db_for_write(Recipe, instance=instance)
+        with transaction.atomic(using=using):
+            if changes:
+                # Serialize concurrent edits so two adds cannot race on the same row
+                Recipe.objects.using(using).select_for_update().get(pk=instance.pk)
+            instance = super().update(instance, validated_data)
+            for name, change in changes.items():
+                manager = getattr(instance, name)
+                if change.remove:
+                    manager.remove(*change.remove)
+                if change.add:
+                    manager.add(*change.add)
+        return instance
+
+
+class RecipeTagSerializer(serializers.ModelSerializer):
+    """Serialize a tag nested in a recipe, without the counter that changes with other recipes"""
+    class Meta:
+        model = Tag
+        fields = ('id', 'name')
+
+
+class RecipeIngredientSerializer(serializers.ModelSerializer):
+    """Serialize an ingredient nested in a recipe, without its counter"""
+    class Meta:
+        model = Ingredient
+        fields = ('id', 'name')
+
 
 class RecipeDetailSerializer(RecipeSerializer):
     """Serialize a recipe detail"""
@@ -40,6 +135,16 @@ class RecipeDetailSerializer(RecipeSerializer):
     tags = TagSerializer(many=True, read_only=True)
 
 
+class RecipeDocumentSerializer(RecipeSerializer):
+    """Serialize a recipe detail as stored in its RecipeDocument
+
+    The nested tags and ingredients leave out recipe_count, which changes
+    with every other recipe sharing them and would keep documents stale.
+    """
+    ingredients = RecipeIngredientSerializer(many=True, read_only=True)
+    tags = RecipeTagSerializer(many=True, read_only=True)
+
+
 class RecipeImageSerializer(serializers.ModelSerializer):
     """Serializer for uploading images to the recipe"""
     class Meta:
@@ -47,3 +152,15 @@ class RecipeImageSerializer(serializers.ModelSerializer):
         fields = ('id', 'image')
         read_only_fields = ('id', )
 
+
+
+class RecipeBulkUpdateSerializer(serializers.ModelSerializer):
+    """Validate the fields a bulk update may set on many recipes"""
+    class Meta:
+        model = Recipe
+        fields = ('time_minutes', 'price', 'link')
+
+    def validate(self, attrs):
+        if not attrs:
+            raise serializers.ValidationError(_('Set at least one field'))
+        return attrs
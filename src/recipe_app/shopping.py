@@ -0,0 +1,41 @@
+from collections import Counter, OrderedDict
+from decimal import Decimal
+
+from core.models import Recipe
+
+
+def shopping_list(user, recipe_ids):
+    """Merge the ingredients of the planned recipes into one list
+
+    recipe_ids may repeat a recipe planned more than once; repeats count
+    towards the totals and the per-ingredient count.
+    """
+    planned = Counter(recipe_ids)
+    recipes = Recipe.objects.filter(user=user, id__in=planned).values_list(
+        'id', 'price', 'time_minutes'
+    )
+    total_price = Decimal('0.00')
+    total_time = 0
+    found = set()
+    for recipe_id, price, time_minutes in recipes:
+        found.add(recipe_id)
+        total_price += price * planned[recipe_id]
+        total_time += time_minutes * planned[recipe_id]
+
+    rows = Recipe.ingredients.through.objects.filter(recipe_id__in=found).values_list(
+        'ingredient_id', 'ingredient__name', 'recipe_id'
+    ).order_by('ingredient__name', 'ingredient_id', 'recipe_id')
+    ingredients = OrderedDict()
+    for ingredient_id, name, recipe_id in rows:
+        item = ingredients.setdefault(
+            ingredient_id, {'id': ingredient_id, 'name': name, 'recipes': [], 'count': 0}
+        )
+        item['recipes'].append(recipe_id)
+        item['count'] += planned[recipe_id]
+
+    return {
+        'ingredients': list(ingredients.values()),
+        'total_price': str(total_price),
+        'total_time_minutes': total_time,
+        'missing': sorted(set(planned) - found),
+    }
@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from core.counters import relation_for_model
+from core.models import Tag, Ingredient, Recipe
+from core.sync import changes_recorded
+from .documents import rebuild_documents
+
+
+@receiver(changes_recorded, sender=Recipe)
+def recipes_changed(sender, user_id, ids, deleted, using, **kwargs):
+    """Re-render the documents of saved recipes and of recipes whose relations changed"""
+    if settings.RECIPE_DOCUMENTS and not deleted:
+        rebuild_documents(ids, using)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Ingredient)
+def related_saved(sender, instance, created, using, **kwargs):
+    """Re-render the documents of the recipes showing a renamed tag or ingredient
+
+    A popular tag may be shown by any number of recipes, so their documents
+    are rebuilt in batches once the rename is committed rather than within
+    it; check_recipe_documents --repair catches any left behind.
+    """
+    if settings.RECIPE_DOCUMENTS and not created:
+        model, through, column = relation_for_model(sender)
+        recipe_ids = through.objects.using(using).filter(
+            **{column: instance.pk}
+        ).values_list('recipe_id', flat=True)
+        transaction.on_commit(lambda: rebuild_documents(recipe_ids, using), using=using)
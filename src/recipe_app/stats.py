@@ -0,0 +1,90 @@
+import math
+from decimal import Decimal, ROUND_UP
+
+from django.conf import settings
+from django.db.models import Avg, Case, Count, IntegerField, Max, Min, Sum, Value, When
+
+from core.models import Tag, Ingredient, Recipe
+
+
+def _plain(value):
+    """Render decimals as strings, like the serializers do for price"""
+    return str(value) if isinstance(value, Decimal) else value
+
+
+def _bucket_edges(low, high, buckets, step):
+    """Split [low, high] into equal width buckets aligned to step"""
+    width = (high - low + step) / buckets
+    if isinstance(step, Decimal):
+        width = width.quantize(step, rounding=ROUND_UP)
+    else:
+        width = math.ceil(width)
+    width = max(width, step)
+    return [low + width * index for index in range(buckets + 1)]
+
+
+def histogram(queryset, field, low, high, step, buckets=None):
+    """Count rows per equal width bucket of field in a single grouped query"""
+    if low is None:
+        return []
+    buckets = buckets or settings.RECIPE_STATS_BUCKETS
+    edges = _bucket_edges(low, high, buckets, step)
+    bucket = Case(
+        *[When(**{f'{field}__lt': edge}, then=Value(index))
+          for index, edge in enumerate(edges[1:-1])],
+        default=Value(buckets - 1),
+        output_field=IntegerField(),
+    )
+    rows = queryset.order_by().annotate(bucket=bucket).values('bucket').annotate(
+        count=Count('id')
+    )
+    counts = {row['bucket']: row['count'] for row in rows}
+    return [
+        {
+            'min': _plain(edges[index]),
+            'max': _plain(edges[index + 1]),
+            'count': counts.get(index, 0),
+        }
+        for index in range(buckets)
+    ]
+
+
+def _top_used(model, user):
+    """Return the user's most used rows, read from the recipe counters"""
+    rows = model.objects.filter(user=user, recipe_count__gt=0).order_by(
+        '-recipe_count', 'name'
+    ).values('id', 'name', 'recipe_count')[:settings.RECIPE_STATS_TOP]
+    return [
+        {'id': row['id'], 'name': row['name'], 'count': row['recipe_count']}
+        for row in rows
+    ]
+
+
+def recipe_stats(user):
+    """Compute the dashboard statistics for the user's recipes"""
+    queryset = Recipe.objects.filter(user=user)
+    totals = queryset.aggregate(
+        count=Count('id'),
+        average_price=Avg('price'),
+        total_time_minutes=Sum('time_minutes'),
+        min_price=Min('price'),
+        max_price=Max('price'),
+        min_time=Min('time_minutes'),
+        max_time=Max('time_minutes'),
+    )
+    average_price = totals['average_price']
+    if average_price is not None:
+        average_price = str(Decimal(average_price).quantize(Decimal('0.01')))
+    return {
+        'count': totals['count'],
+        'average_price': average_price,
+        'total_time_minutes': totals['total_time_minutes'] or 0,
+        'price_histogram': histogram(
+            queryset, 'price', totals['min_price'], totals['max_price'], Decimal('0.01')
+        ),
+        'time_histogram': histogram(
+            queryset, 'time_minutes', totals['min_time'], totals['max_time'], 1
+        ),
+        'top_tags': _top_used(Tag, user),
+        'top_ingredients': _top_used(Ingredient, user),
+    }
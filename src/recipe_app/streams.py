@@ -0,0 +1,39 @@
+import json
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from core.events import bus
+from core.sync import changes_since, encode_token
+
+
+def format_event(change, epoch=0):
+    """Render a change log row as a server-sent event"""
+    data = json.dumps({'type': change.action, 'id': change.object_id})
+    return f'id: {encode_token(change.id, epoch)}\nevent: {change.kind}\ndata: {data}\n\n'
+
+
+def event_stream(user, last_id, epoch=0):
+    """Yield the user's changes after last_id as server-sent events
+
+    The stream ends after EVENT_STREAM_MAX_SECONDS so that clients
+    reconnect with Last-Event-ID, and no database connection is held
+    while it waits.
+    """
+    waiter = bus.subscribe(user.id)
+    deadline = time.monotonic() + settings.EVENT_STREAM_MAX_SECONDS
+    try:
+        yield f'retry: {settings.EVENT_STREAM_RETRY_MS}\n\n'
+        while time.monotonic() < deadline:
+            waiter.clear()
+            changes, last_id, more = changes_since(user, last_id, settings.SYNC_PAGE_SIZE)
+            close_old_connections()
+            for change in changes:
+                yield format_event(change, epoch)
+            if more:
+                continue
+            if not waiter.wait(settings.EVENT_STREAM_POLL_SECONDS):
+                yield ': keep-alive\n\n'
+    finally:
+        bus.unsubscribe(user.id, waiter)
@@ -1,17 +1,42 @@
+import base64
+import io
+import json
 import tempfile
 import os
+import time
+import zipfile
+from unittest import mock
+from io import StringIO
 from PIL import Image
-from django.test import TestCase
+from django.core.cache import cache, caches
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
-from core.models import Tag,Ingredient, Recipe
-from recipe_app.serializers import TagSerializer, IngredientSerializer, RecipeSerializer, RecipeDetailSerializer
+from core.models import Tag,Ingredient, Recipe, RecipeDocument, Change, NeighbourRefresh
+from recipe_app import export
+from recipe_app.streams import event_stream
+from recipe_app.serializers import (
+    TagSerializer, IngredientSerializer, RecipeSerializer, RecipeDetailSerializer, RecipeDocumentSerializer
+)
 
 TAGS_URL = reverse('recipe_app:tag-list')
 INGRIDENT_URL = reverse('recipe_app:ingredient-list')
 RECIPE_URL = reverse('recipe_app:recipe-list')
+TAG_AUTOCOMPLETE_URL = reverse('recipe_app:tag-autocomplete')
+INGREDIENT_AUTOCOMPLETE_URL = reverse('recipe_app:ingredient-autocomplete')
+FACETS_URL = reverse('recipe_app:recipe-facets')
+STATS_URL = reverse('recipe_app:recipe-stats')
+SYNC_URL = reverse('recipe_app:sync')
+EVENTS_URL = reverse('recipe_app:events')
+BULK_DELETE_URL = reverse('recipe_app:recipe-bulk-delete')
+BULK_UPDATE_URL = reverse('recipe_app:recipe-bulk-update')
+SHOPPING_LIST_URL = reverse('recipe_app:shopping-list')
 
 def image_upload_url(recipe_id):
     """Return url for recipe image upload"""
@@ -24,6 +49,16 @@ def detail_url(recipe_id):
     return reverse('recipe_app:recipe-detail', args=[recipe_id])
 
 
+def clone_url(recipe_id):
+    """Return the recipe clone url"""
+    return reverse('recipe_app:recipe-clone', args=[recipe_id])
+
+
+def similar_url(recipe_id):
+    """Return the similar recipes url"""
+    return reverse('recipe_app:recipe-similar', args=[recipe_id])
+
+
 
 def sample_tag(user, name='Main Course'):
     """Create and return  a sample tag"""
@@ -206,6 +241,7 @@ class PrivateRecipeAPITest(TestCase):
         res = self.client.get(url)
         serializer = RecipeDetailSerializer(recipe)
         self.assertEqual(res.data, serializer.data)
+        self.assertEqual(res.data['tags'][0]['recipe_count'], 1)
 
     def test_create_basic_recipe(self):
         """Test creating a recipe"""
@@ -341,6 +377,14 @@ class RecipeImageUploadTest(TestCase):
         self.assertIn(serializer2.data, res.data)
         self.assertNotIn(serializer3, res.data)
 
+    @override_settings(FILTER_MAX_IDS=3)
+    def test_filter_ids_are_bounded(self):
+        """Test filter params listing too many ids are refused"""
+        res = self.client.get(RECIPE_URL, {'tags': '1,2,3,4'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        res = self.client.get(RECIPE_URL, {'tags': '1,2,3'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
     def test_filter_recipes_by_ingredients(self):
         """Tests returning a recipe with specific ingredients"""
         recipe1 = sample_recipe(user=self.user, title='Posh beans on Toast')
@@ -374,6 +418,7 @@ class RecipeImageUploadTest(TestCase):
             user=self.user
         )
         recipe.tags.add(tag1)
+        tag1.refresh_from_db()
         res = self.client.get(TAGS_URL, {'assigned_only':1})
         serializer1 = TagSerializer(tag1)
         serializer2 = TagSerializer(tag2)
@@ -391,6 +436,7 @@ class RecipeImageUploadTest(TestCase):
             user=self.user
         )
         recipe.ingredients.add(ingredient1)
+        ingredient1.refresh_from_db()
         res = self.client.get(INGRIDENT_URL, {'assigned_only': 1 })
         serializer1 = IngredientSerializer(ingredient1)
         serializer2 = IngredientSerializer(ingredient2)
@@ -412,3 +458,1024 @@ class RecipeImageUploadTest(TestCase):
 
 
 
+
+
+class RecipeCountTest(TestCase):
+    """Test the recipe counters on tags and ingredients"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('count@davis.com', 'pass1234')
+        self.tag = sample_tag(user=self.user)
+        self.ingredient = sample_ingredient(user=self.user)
+
+    def test_counts_follow_add_and_remove(self):
+        """Test adding and removing relations updates the counters"""
+        recipe1 = sample_recipe(user=self.user)
+        recipe2 = sample_recipe(user=self.user)
+        recipe1.tags.add(self.tag)
+        recipe1.tags.add(self.tag)
+        self.tag.recipe_set.add(recipe2)
+        recipe1.ingredients.add(self.ingredient)
+        self.tag.refresh_from_db()
+        self.ingredient.refresh_from_db()
+        self.assertEqual(self.tag.recipe_count, 2)
+        self.assertEqual(self.ingredient.recipe_count, 1)
+
+        recipe2.tags.remove(self.tag)
+        recipe2.tags.remove(self.tag)
+        recipe1.ingredients.clear()
+        self.tag.refresh_from_db()
+        self.ingredient.refresh_from_db()
+        self.assertEqual(self.tag.recipe_count, 1)
+        self.assertEqual(self.ingredient.recipe_count, 0)
+
+    def test_counts_follow_recipe_delete(self):
+        """Test deleting a recipe releases its tags and ingredients"""
+        recipe = sample_recipe(user=self.user)
+        recipe.tags.add(self.tag)
+        recipe.ingredients.add(self.ingredient)
+        recipe.delete()
+        self.tag.refresh_from_db()
+        self.ingredient.refresh_from_db()
+        self.assertEqual(self.tag.recipe_count, 0)
+        self.assertEqual(self.ingredient.recipe_count, 0)
+
+    def test_counts_returned_by_api(self):
+        """Test the tag list returns the recipe count"""
+        client = APIClient()
+        client.force_authenticate(self.user)
+        sample_recipe(user=self.user).tags.add(self.tag)
+        res = client.get(TAGS_URL)
+        self.assertEqual(res.data[0]['recipe_count'], 1)
+
+
+class RecipeFacetsTest(TestCase):
+    """Test the recipe facets endpoint"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('facets@davis.com', 'pass1234')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_facets_follow_filters(self):
+        """Test facet counts only cover the filtered recipes"""
+        vegan = sample_tag(user=self.user, name='Vegan')
+        quick = sample_tag(user=self.user, name='Quick')
+        salt = sample_ingredient(user=self.user, name='Salt')
+        recipe1 = sample_recipe(user=self.user, title='Lentil soup')
+        recipe2 = sample_recipe(user=self.user, title='Lentil curry')
+        recipe3 = sample_recipe(user=self.user, title='Steak')
+        recipe1.tags.add(vegan, quick)
+        recipe2.tags.add(vegan)
+        recipe3.tags.add(quick)
+        recipe1.ingredients.add(salt)
+
+        res = self.client.get(FACETS_URL, {'search': 'lentil'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['count'], 2)
+        self.assertEqual(res.data['tags'], [
+            {'id': vegan.id, 'name': 'Vegan', 'count': 2},
+            {'id': quick.id, 'name': 'Quick', 'count': 1},
+        ])
+        self.assertEqual(res.data['ingredients'], [{'id': salt.id, 'name': 'Salt', 'count': 1}])
+
+    def test_facets_invalidated_on_change(self):
+        """Test cached facets are refreshed after the user edits a recipe"""
+        tag = sample_tag(user=self.user)
+        recipe = sample_recipe(user=self.user)
+        res = self.client.get(FACETS_URL)
+        self.assertEqual(res.data['tags'], [])
+
+        recipe.tags.add(tag)
+        res = self.client.get(FACETS_URL)
+        self.assertEqual(res.data['tags'], [{'id': tag.id, 'name': tag.name, 'count': 1}])
+
+    def test_facets_invalidated_when_version_is_lost(self):
+        """Test a lost cache version never brings back results cached against it"""
+        tag = sample_tag(user=self.user)
+        recipe = sample_recipe(user=self.user)
+        self.client.get(FACETS_URL)
+        recipe.tags.add(tag)
+        cache.delete(f'user-version:{self.user.id}')
+
+        with mock.patch('core.cache.time.time', return_value=time.time() + 1):
+            res = self.client.get(FACETS_URL)
+        self.assertEqual(res.data['tags'], [{'id': tag.id, 'name': tag.name, 'count': 1}])
+
+
+class RecipeRangeOrderingTest(TestCase):
+    """Test range filters, ordering and keyset pagination of recipes"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('ranges@davis.com', 'pass1234')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.cheap = sample_recipe(user=self.user, title='Toast', price=2.00, time_minutes=5)
+        self.mid = sample_recipe(user=self.user, title='Curry', price=8.00, time_minutes=25)
+        self.dear = sample_recipe(user=self.user, title='Roast', price=15.00, time_minutes=90)
+
+    def test_filter_by_price_and_time(self):
+        """Test recipes are filtered by price and time ranges"""
+        res = self.client.get(RECIPE_URL, {'max_time': 30, 'min_price': '3'})
+        self.assertEqual([recipe['id'] for recipe in res.data], [self.mid.id])
+
+    def test_invalid_range_rejected(self):
+        """Test a non numeric range returns a bad request"""
+        res = self.client.get(RECIPE_URL, {'max_price': 'cheap'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        for value in ('NaN', 'Infinity', '-inf'):
+            res = self.client.get(RECIPE_URL, {'min_price': value})
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_ordering(self):
+        """Test recipes are ordered by the requested field"""
+        res = self.client.get(RECIPE_URL, {'ordering': '-price'})
+        ids = [recipe['id'] for recipe in res.data]
+        self.assertEqual(ids, [self.dear.id, self.mid.id, self.cheap.id])
+        res = self.client.get(RECIPE_URL, {'ordering': 'user'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        res = self.client.get(detail_url(self.mid.id), {'ordering': 'user'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_keyset_pagination_with_ordering(self):
+        """Test following next links walks every recipe once in order"""
+        same_price = sample_recipe(user=self.user, title='Soup', price=8.00, time_minutes=20)
+        params = {'ordering': 'price', 'page_size': 2}
+        res = self.client.get(RECIPE_URL, params)
+        ids = [recipe['id'] for recipe in res.data['results']]
+        while res.data['next']:
+            res = self.client.get(res.data['next'])
+            ids += [recipe['id'] for recipe in res.data['results']]
+        self.assertEqual(ids, [self.cheap.id, self.mid.id, same_price.id, self.dear.id])
+
+    def test_tampered_cursor(self):
+        """Test cursors whose value does not fit the ordering are refused"""
+        for ordering, position in (
+            ('price', [None, 1]), ('price', ['abc', 1]), ('price', [[1], 1]),
+            ('time_minutes', ['soon', 1]), ('price', [{'a': 1}, 1]), ('price', ['1.00', None]),
+        ):
+            cursor = base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+            res = self.client.get(RECIPE_URL, {'ordering': ordering, 'page_size': 2, 'cursor': cursor})
+            self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND, position)
+            self.assertEqual(res.data['detail'], 'Invalid cursor')
+
+
+class RecipeStatsTest(TestCase):
+    """Test the recipe statistics endpoint"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('stats@davis.com', 'pass1234')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_stats_empty_library(self):
+        """Test stats for a user without recipes"""
+        res = self.client.get(STATS_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['count'], 0)
+        self.assertEqual(res.data['price_histogram'], [])
+
+    def test_stats_values(self):
+        """Test averages, totals, histograms and top tags"""
+        tag = sample_tag(user=self.user)
+        sample_recipe(user=self.user, price=2.00, time_minutes=10).tags.add(tag)
+        sample_recipe(user=self.user, price=4.00, time_minutes=20).tags.add(tag)
+        sample_recipe(user=self.user, price=12.00, time_minutes=100)
+        sample_recipe(user=get_user_model().objects.create_user('o@davis.com', 'pass'))
+
+        res = self.client.get(STATS_URL)
+        self.assertEqual(res.data['count'], 3)
+        self.assertEqual(res.data['average_price'], '6.00')
+        self.assertEqual(res.data['total_time_minutes'], 130)
+        time_histogram = res.data['time_histogram']
+        self.assertEqual(len(time_histogram), 10)
+        self.assertEqual(sum(bucket['count'] for bucket in time_histogram), 3)
+        self.assertEqual(time_histogram[0]['count'], 1)
+        self.assertEqual(time_histogram[-1]['count'], 1)
+        self.assertEqual(res.data['price_histogram'][0]['min'], '2.00')
+        self.assertEqual(res.data['top_tags'], [{'id': tag.id, 'name': tag.name, 'count': 2}])
+
+    def test_stats_invalidated_on_change(self):
+        """Test cached stats are refreshed when a recipe is added"""
+        self.client.get(STATS_URL)
+        sample_recipe(user=self.user)
+        res = self.client.get(STATS_URL)
+        self.assertEqual(res.data['count'], 1)
+
+
+class SimilarRecipesTest(TestCase):
+    """Test the similar recipes endpoint"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('similar@davis.com', 'pass1234')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.vegan = sample_tag(user=self.user, name='Vegan')
+        self.curry = sample_tag(user=self.user, name='Curry')
+        self.rice = sample_ingredient(user=self.user, name='Rice')
+
+    def similar(self, recipe):
+        call_command('refresh_recipe_neighbours', stdout=StringIO())
+        return self.client.get(similar_url(recipe.id))
+
+    def test_similar_ranked_by_jaccard(self):
+        """Test neighbours are ranked by shared tags and ingredients"""
+        recipe = sample_recipe(user=self.user, title='Chickpea curry')
+        close = sample_recipe(user=self.user, title='Lentil curry')
+        far = sample_recipe(user=self.user, title='Vegan cake')
+        unrelated = sample_recipe(user=self.user, title='Toast')
+        recipe.tags.add(self.vegan, self.curry)
+        recipe.ingredients.add(self.rice)
+        close.tags.add(self.vegan, self.curry)
+        far.tags.add(self.vegan)
+
+        res = self.similar(recipe)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['id'] for item in res.data], [close.id, far.id])
+        self.assertAlmostEqual(res.data[0]['score'], 2 / 3)
+        self.assertNotIn(unrelated.id, [item['id'] for item in res.data])
+
+    def test_similar_updated_incrementally(self):
+        """Test removing relations and deleting recipes updates neighbours"""
+        recipe = sample_recipe(user=self.user)
+        other = sample_recipe(user=self.user)
+        third = sample_recipe(user=self.user)
+        recipe.tags.add(self.vegan)
+        self.vegan.recipe_set.add(other, third)
+        self.assertEqual(len(self.similar(recipe).data), 2)
+
+        other.tags.remove(self.vegan)
+        third.delete()
+        self.assertEqual(self.similar(recipe).data, [])
+
+    def test_refresh_queued_with_the_change(self):
+        """Test relation changes queue a refresh the job runs outside the request"""
+        recipe = sample_recipe(user=self.user)
+        other = sample_recipe(user=self.user)
+        recipe.tags.add(self.vegan)
+        other.tags.add(self.vegan, self.curry)
+        queued = NeighbourRefresh.objects.filter(user=self.user)
+        self.assertEqual(set(queued.values_list('recipe_id', flat=True)), {recipe.id, other.id})
+        self.assertEqual(self.client.get(similar_url(recipe.id)).data, [])
+
+        self.assertEqual([item['id'] for item in self.similar(recipe).data], [other.id])
+        self.assertFalse(queued.exists())
+
+        with transaction.atomic():
+            other.tags.remove(self.curry)
+            transaction.set_rollback(True)
+        self.assertFalse(queued.exists())
+
+
+class AutocompleteTest(TestCase):
+    """Test tag and ingredient autocomplete"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('complete@davis.com', 'pass1234')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_prefix_is_case_and_accent_insensitive(self):
+        """Test names match regardless of case and accents, ranked by usage"""
+        creme = sample_ingredient(user=self.user, name='Crème fraîche')
+        cream = sample_ingredient(user=self.user, name='Cream')
+        sample_ingredient(user=self.user, name='Carrot')
+        sample_recipe(user=self.user).ingredients.add(cream)
+
+        res = self.client.get(INGREDIENT_AUTOCOMPLETE_URL, {'prefix': 'CRE'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['id'] for item in res.data], [cream.id, creme.id])
+        res = self.client.get(INGREDIENT_AUTOCOMPLETE_URL, {'prefix': 'crem'})
+        self.assertEqual([item['id'] for item in res.data], [creme.id])
+
+    def test_index_invalidated_on_write(self):
+        """Test new tags show up and other users' tags never do"""
+        other = get_user_model().objects.create_user('other@davis.com', 'pass1234')
+        sample_tag(user=other, name='Vegan')
+        self.assertEqual(self.client.get(TAG_AUTOCOMPLETE_URL, {'prefix': 've'}).data, [])
+
+        tag = sample_tag(user=self.user, name='Vegetarian')
+        res = self.client.get(TAG_AUTOCOMPLETE_URL, {'prefix': 've'})
+        self.assertEqual(res.data, [{'id': tag.id, 'name': 'Vegetarian', 'recipe_count': 0}])
+
+    @override_settings(AUTOCOMPLETE_MAX_INDEX_SIZE=1)
+    def test_large_library_uses_database(self):
+        """Test users above the index size are served by a prefix query"""
+        sample_tag(user=self.user, name='Lunch')
+        tag = sample_tag(user=self.user, name='Dinner')
+        res = self.client.get(TAG_AUTOCOMPLETE_URL, {'prefix': 'di', 'limit': 5})
+        self.assertEqual([item['id'] for item in res.data], [tag.id])
+
+
+class SyncTest(TestCase):
+    """Test the delta sync endpoint"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('sync@davis.com', 'pass1234')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_first_sync_returns_everything(self):
+        """Test syncing without a token returns the whole library"""
+        tag = sample_tag(user=self.user)
+        recipe = sample_recipe(user=self.user)
+        recipe.tags.add(tag)
+        sample_recipe(user=get_user_model().objects.create_user('o@davis.com', 'pass'))
+
+        res = self.client.get(SYNC_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['id'] for item in res.data['recipes']['updated']], [recipe.id])
+        self.assertEqual(res.data['recipes']['updated'][0]['tags'], [tag.id])
+        self.assertEqual([item['id'] for item in res.data['tags']['updated']], [tag.id])
+        self.assertFalse(res.data['more'])
+
+    def test_sync_returns_only_changes_and_tombstones(self):
+        """Test a token only returns rows changed or deleted after it"""
+        kept = sample_recipe(user=self.user, title='Kept')
+        edited = sample_recipe(user=self.user, title='Edited')
+        removed = sample_recipe(user=self.user, title='Removed')
+        token = self.client.get(SYNC_URL).data['token']
+
+        edited.title = 'Edited again'
+        edited.save()
+        removed_id = removed.id
+        removed.delete()
+        res = self.client.get(SYNC_URL, {'since': token})
+        self.assertEqual([item['title'] for item in res.data['recipes']['updated']], ['Edited again'])
+        self.assertEqual(res.data['recipes']['deleted'], [removed_id])
+        self.assertNotIn(kept.id, [item['id'] for item in res.data['recipes']['updated']])
+
+        res = self.client.get(SYNC_URL, {'since': res.data['token']})
+        self.assertEqual(res.data['recipes'], {'updated': [], 'deleted': []})
+
+    @override_settings(SYNC_PAGE_SIZE=1)
+    def test_sync_pages(self):
+        """Test large change sets are returned in several calls"""
+        sample_recipe(user=self.user)
+        sample_recipe(user=self.user)
+        res = self.client.get(SYNC_URL)
+        self.assertTrue(res.data['more'])
+        res = self.client.get(SYNC_URL, {'since': res.data['token']})
+        self.assertEqual(len(res.data['recipes']['updated']), 1)
+        self.assertFalse(res.data['more'])
+
+    def test_invalid_token(self):
+        """Test a malformed token is rejected"""
+        res = self.client.get(SYNC_URL, {'since': 'yesterday'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_created_survives_relation_changes(self):
+        """Test a recipe posted with tags is logged as created"""
+        tag = sample_tag(user=self.user)
+        token = self.client.get(SYNC_URL).data['token']
+        res = self.client.post(RECIPE_URL, {
+            'title': 'Soup', 'time_minutes': 10, 'price': '5.00', 'tags': [tag.id]
+        })
+
+        change = Change.objects.get(kind=Change.RECIPE, object_id=res.data['id'])
+        self.assertEqual(change.action, 'created')
+        res = self.client.get(SYNC_URL, {'since': token})
+        self.assertEqual(len(res.data['recipes']['updated']), 1)
+
+    def test_pruned_tombstones_reset_older_tokens(self):
+        """Test clients that missed a pruned tombstone go back to a full sync"""
+        kept = sample_recipe(user=self.user, title='Kept')
+        removed = sample_recipe(user=self.user, title='Removed')
+        old_token = self.client.get(SYNC_URL).data['token']
+        removed.delete()
+        new_token = self.client.get(SYNC_URL, {'since': old_token}).data['token']
+
+        call_command('prune_tombstones', days=0, stdout=StringIO())
+        self.assertFalse(Change.objects.filter(deleted=True).exists())
+        res = self.client.get(SYNC_URL, {'since': old_token})
+        self.assertTrue(res.data['reset'])
+        self.assertEqual([item['id'] for item in res.data['recipes']['updated']], [kept.id])
+        res = self.client.get(SYNC_URL, {'since': new_token})
+        self.assertFalse(res.data['reset'])
+
+
+@override_settings(EVENT_STREAM_POLL_SECONDS=0.01)
+class EventStreamTest(TransactionTestCase):
+    """Test the server-sent event stream"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('events@davis.com', 'pass1234')
+
+    def test_stream_pushes_changes(self):
+        """Test creates, updates and deletes are streamed in order"""
+        stream = event_stream(self.user, last_id=0)
+        self.assertTrue(next(stream).startswith('retry:'))
+        recipe = sample_recipe(user=self.user)
+        created = next(stream)
+        self.assertIn('event: recipe', created)
+        self.assertIn(f'"type": "created", "id": {recipe.id}', created)
+
+        recipe.title = 'Renamed'
+        recipe.save()
+        # Still a creation to any client that missed the first event
+        self.assertIn(f'"type": "created", "id": {recipe.id}', next(stream))
+        recipe.delete()
+        self.assertIn('"type": "deleted"', next(stream))
+        self.assertEqual(next(stream), ': keep-alive\n\n')
+        stream.close()
+
+    def test_stream_resumes_from_last_event_id(self):
+        """Test the endpoint replays changes after Last-Event-ID"""
+        first = sample_recipe(user=self.user)
+        second = sample_recipe(user=self.user)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        token = Change.objects.get(object_id=first.id, kind='recipe').id
+        res = client.get(EVENTS_URL, HTTP_ACCEPT='text/event-stream', HTTP_LAST_EVENT_ID=str(token))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], 'text/event-stream')
+        content = iter(res.streaming_content)
+        next(content)
+        self.assertIn(f'"id": {second.id}', next(content).decode())
+        res.close()
+
+
+class RecipeRelationPatchTest(TestCase):
+    """Test add/remove operations on recipe tags and ingredients"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('patch@davis.com', 'pass1234')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.recipe = sample_recipe(user=self.user)
+
+    def test_add_and_remove(self):
+        """Test only the listed ids are added and removed"""
+        kept = sample_ingredient(user=self.user, name='Salt')
+        removed = sample_ingredient(user=self.user, name='Sugar')
+        added = sample_ingredient(user=self.user, name='Pepper')
+        self.recipe.ingredients.add(kept, removed)
+        payload = {'ingredients': {'add': [added.id], 'remove': [removed.id]}}
+
+        res = self.client.patch(detail_url(self.recipe.id), payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(res.data['ingredients']), sorted([kept.id, added.id]))
+        added.refresh_from_db()
+        removed.refresh_from_db()
+        self.assertEqual(added.recipe_count, 1)
+        self.assertEqual(removed.recipe_count, 0)
+
+    def test_invalid_operations(self):
+        """Test unknown operations, overlaps and other users' ids are rejected"""
+        tag = sample_tag(user=self.user)
+        other = sample_tag(user=get_user_model().objects.create_user('o@davis.com', 'pass'))
+        url = detail_url(self.recipe.id)
+        for tags in (
+            {'replace': [tag.id]},
+            {'add': [tag.id], 'remove': [tag.id]},
+            {'add': [other.id]},
+        ):
+            res = self.client.patch(url, {'tags': tags}, format='json')
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.recipe.tags.count(), 0)
+
+    def test_operations_rejected_on_create(self):
+        """Test creating a recipe needs plain id lists"""
+        tag = sample_tag(user=self.user)
+        payload = {'title': 'Soup', 'time_minutes': 5, 'price': '2.00', 'tags': {'add': [tag.id]}}
+        res = self.client.post(RECIPE_URL, payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class RecipeBulkTest(TestCase):
+    """Test bulk delete and bulk update of recipes"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('bulk@davis.com', 'pass1234')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_bulk_delete_by_ids(self):
+        """Test deleting listed recipes keeps counters and the change log right"""
+        tag = sample_tag(user=self.user)
+        recipe1 = sample_recipe(user=self.user)
+        recipe2 = sample_recipe(user=self.user)
+        kept = sample_recipe(user=self.user)
+        other = sample_recipe(user=get_user_model().objects.create_user('o@davis.com', 'pass'))
+        tag.recipe_set.add(recipe1, recipe2, kept)
+
+        payload = {'ids': [recipe1.id, recipe2.id, other.id]}
+        res = self.client.post(BULK_DELETE_URL, payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data, {'deleted': 2})
+        self.assertEqual(list(Recipe.objects.filter(user=self.user)), [kept])
+        self.assertTrue(Recipe.objects.filter(id=other.id).exists())
+        tag.refresh_from_db()
+        self.assertEqual(tag.recipe_count, 1)
+        self.assertTrue(Change.objects.get(kind='recipe', object_id=recipe1.id).deleted)
+        call_command('refresh_recipe_neighbours', stdout=StringIO())
+        self.assertEqual(self.client.get(similar_url(kept.id)).data, [])
+
+    def test_bulk_delete_by_filter(self):
+        """Test deleting the recipes matching a filter"""
+        sample_recipe(user=self.user, price=20.00)
+        cheap = sample_recipe(user=self.user, price=2.00)
+        res = self.client.post(BULK_DELETE_URL, {'filter': {'min_price': '10'}}, format='json')
+        self.assertEqual(res.data, {'deleted': 1})
+        self.assertEqual(list(Recipe.objects.all()), [cheap])
+
+    def test_bulk_update(self):
+        """Test setting fields on the selected recipes only"""
+        recipe1 = sample_recipe(user=self.user, time_minutes=5)
+        recipe2 = sample_recipe(user=self.user, time_minutes=50)
+        payload = {'filter': {'max_time': 10}, 'set': {'price': '3.50', 'link': 'http://x.y'}}
+        res = self.client.post(BULK_UPDATE_URL, payload, format='json')
+        self.assertEqual(res.data, {'updated': 1})
+        recipe1.refresh_from_db()
+        recipe2.refresh_from_db()
+        self.assertEqual(str(recipe1.price), '3.50')
+        self.assertEqual(recipe2.link, '')
+
+    def test_bulk_requests_validated(self):
+        """Test missing selections, unknown filters and bad values fail"""
+        recipe = sample_recipe(user=self.user)
+        for url, payload in (
+            (BULK_DELETE_URL, {}),
+            (BULK_DELETE_URL, {'filter': {'user': 1}}),
+            (BULK_UPDATE_URL, {'ids': [recipe.id], 'set': {}}),
+            (BULK_UPDATE_URL, {'ids': [recipe.id], 'set': {'time_minutes': 'soon'}}),
+            (BULK_DELETE_URL, [recipe.id]),
+            (BULK_DELETE_URL, 'all'),
+            (BULK_UPDATE_URL, [recipe.id]),
+        ):
+            res = self.client.post(url, payload, format='json')
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue(Recipe.objects.filter(id=recipe.id).exists())
+
+    def test_whole_library_needs_all(self):
+        """Test a filter selecting everything is refused unless all is given"""
+        sample_recipe(user=self.user)
+        sample_recipe(user=self.user)
+        for selection in ({}, {'search': ''}, {'tags': [], 'search': '  '}):
+            res = self.client.post(BULK_DELETE_URL, {'filter': selection}, format='json')
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Recipe.objects.count(), 2)
+
+        res = self.client.post(BULK_DELETE_URL, {'filter': {}, 'all': True}, format='json')
+        self.assertEqual(res.data, {'deleted': 2})
+        sample_recipe(user=self.user)
+        res = self.client.post(BULK_DELETE_URL, {'all': True}, format='json')
+        self.assertEqual(res.data, {'deleted': 1})
+
+
+class RecipeCloneTest(TestCase):
+    """Test cloning recipes"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('clone@davis.com', 'pass1234')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.tag = sample_tag(user=self.user)
+        self.ingredient = sample_ingredient(user=self.user)
+        self.recipe = sample_recipe(user=self.user, title='Pancakes', link='http://pan.cakes')
+        self.recipe.tags.add(self.tag)
+        self.recipe.ingredients.add(self.ingredient)
+        self.recipe.image = 'uploads/recipe/shared.jpg'
+        self.recipe.save()
+
+    def test_clone_copies_relations_and_image(self):
+        """Test clones copy fields and relations and share the image"""
+        res = self.client.post(clone_url(self.recipe.id), {'count': 3}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(res.data), 3)
+        for item in res.data:
+            self.assertNotEqual(item['id'], self.recipe.id)
+            self.assertEqual(item['title'], 'Pancakes')
+            self.assertEqual(item['tags'], [self.tag.id])
+            self.assertEqual(item['ingredients'], [self.ingredient.id])
+            clone = Recipe.objects.get(id=item['id'])
+            self.assertEqual(clone.image.name, self.recipe.image.name)
+        self.tag.refresh_from_db()
+        self.assertEqual(self.tag.recipe_count, 4)
+        call_command('refresh_recipe_neighbours', stdout=StringIO())
+        neighbours = self.client.get(similar_url(self.recipe.id)).data
+        self.assertEqual(len(neighbours), 3)
+
+    def test_clone_count_validated(self):
+        """Test the clone count must be within limits"""
+        for count in (0, 1000, 'many'):
+            res = self.client.post(clone_url(self.recipe.id), {'count': count}, format='json')
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Recipe.objects.count(), 1)
+
+
+class ShoppingListTest(TestCase):
+    """Test the shopping list endpoint"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shop@davis.com', 'pass1234')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_shopping_list_merges_ingredients(self):
+        """Test ingredients are deduplicated and totals add up"""
+        eggs = sample_ingredient(user=self.user, name='Eggs')
+        flour = sample_ingredient(user=self.user, name='Flour')
+        pancakes = sample_recipe(user=self.user, price=3.00, time_minutes=20)
+        omelette = sample_recipe(user=self.user, price=2.50, time_minutes=10)
+        pancakes.ingredients.add(eggs, flour)
+        omelette.ingredients.add(eggs)
+        other = sample_recipe(user=get_user_model().objects.create_user('o@davis.com', 'pass'))
+
+        payload = {'recipes': [pancakes.id, omelette.id, omelette.id, other.id, 999]}
+        res = self.client.post(SHOPPING_LIST_URL, payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['ingredients'], [
+            {'id': eggs.id, 'name': 'Eggs', 'recipes': [pancakes.id, omelette.id], 'count': 3},
+            {'id': flour.id, 'name': 'Flour', 'recipes': [pancakes.id], 'count': 1},
+        ])
+        self.assertEqual(res.data['total_price'], '8.00')
+        self.assertEqual(res.data['total_time_minutes'], 40)
+        self.assertEqual(res.data['missing'], [other.id, 999])
+
+    def test_shopping_list_validation(self):
+        """Test the recipe list is required and must hold ids"""
+        for payload in ({}, {'recipes': []}, {'recipes': ['soup']}, [1, 2], 'soup'):
+            res = self.client.post(SHOPPING_LIST_URL, payload, format='json')
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class RecipeMultiGetTest(TestCase):
+    """Test fetching many recipe details at once"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('multi@davis.com', 'pass1234')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_multi_get_returns_details_and_missing(self):
+        """Test details come back in request order with missing ids reported"""
+        recipe1 = sample_recipe(user=self.user, title='First')
+        recipe2 = sample_recipe(user=self.user, title='Second')
+        recipe1.tags.add(sample_tag(user=self.user))
+        recipe2.ingredients.add(sample_ingredient(user=self.user))
+        other = sample_recipe(user=get_user_model().objects.create_user('o@davis.com', 'pass'))
+
+        ids = f'{recipe2.id},{recipe1.id},{other.id},{recipe2.id}'
+        # The first query looks up the user's replica pin in the cache
+        with self.assertNumQueries(4):
+            res = self.client.get(RECIPE_URL, {'ids': ids})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        expected = RecipeDetailSerializer([recipe2, recipe1], many=True).data
+        self.assertEqual(res.data['results'], expected)
+        self.assertEqual(res.data['missing'], [other.id])
+
+    @override_settings(RECIPE_MULTI_GET_MAX=2)
+    def test_multi_get_limit(self):
+        """Test too many ids are rejected"""
+        res = self.client.get(RECIPE_URL, {'ids': '1,2,3'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_multi_get_not_filtered(self):
+        """Test ids are never narrowed by ordering or silently by filters"""
+        recipe = sample_recipe(user=self.user, title='Soup')
+        res = self.client.get(RECIPE_URL, {'ids': recipe.id, 'ordering': 'bad'})
+        self.assertEqual([item['id'] for item in res.data['results']], [recipe.id])
+        res = self.client.get(RECIPE_URL, {'ids': recipe.id, 'search': 'stew'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(RECIPE_DOCUMENTS=True)
+class RecipeDocumentTest(TransactionTestCase):
+    """Test serving recipes from their stored documents
+
+    Renames re-render documents after commit, which TestCase never does.
+    """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('docs@davis.com', 'pass1234')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_recipe(self, **payload):
+        payload = dict({'title': 'Soup', 'time_minutes': 10, 'price': '5.00'}, **payload)
+        res = self.client.post(RECIPE_URL, payload)
+        return Recipe.objects.get(id=res.data['id'])
+
+    def test_document_kept_up_to_date(self):
+        """Test documents follow saves, relation changes and renames"""
+        tag = sample_tag(user=self.user)
+        recipe = self.create_recipe(tags=[tag.id])
+        expected = json.loads(json.dumps(RecipeDocumentSerializer(recipe).data))
+        self.assertEqual(json.loads(recipe.document.detail), expected)
+
+        ingredient = sample_ingredient(user=self.user)
+        self.client.patch(detail_url(recipe.id), {'ingredients': [ingredient.id]}, format='json')
+        tag.name = 'Dessert'
+        tag.save()
+
+        recipe.document.refresh_from_db()
+        detail = json.loads(recipe.document.detail)
+        self.assertEqual(detail['tags'], [{'id': tag.id, 'name': 'Dessert'}])
+        self.assertEqual(detail['ingredients'], [{'id': ingredient.id, 'name': ingredient.name}])
+        self.assertEqual(json.loads(recipe.document.summary)['ingredients'], [ingredient.id])
+
+    def test_reads_served_from_documents(self):
+        """Test retrieve, list and multi-get write out the stored documents"""
+        recipe = self.create_recipe(tags=[sample_tag(user=self.user).id])
+        RecipeDocument.objects.filter(recipe=recipe).update(
+            detail='{"stored":"detail"}', summary='{"stored":"summary"}'
+        )
+        plain = self.create_recipe(title='Stew')
+        RecipeDocument.objects.filter(recipe=plain).delete()
+
+        # The replica pin lookup in the cache, then the document
+        with self.assertNumQueries(2):
+            res = self.client.get(detail_url(recipe.id))
+        self.assertEqual(res.json(), {'stored': 'detail'})
+        res = self.client.get(RECIPE_URL)
+        self.assertEqual(res.json(), [
+            json.loads(json.dumps(RecipeSerializer(plain).data)), {'stored': 'summary'}
+        ])
+        res = self.client.get(RECIPE_URL, {'ids': f'{recipe.id},{plain.id}'})
+        self.assertEqual(res.json()['results'][0], {'stored': 'detail'})
+        self.assertEqual(res.json()['results'][1]['title'], 'Stew')
+        res = self.client.get(detail_url(plain.id))
+        self.assertEqual(res.json()['title'], 'Stew')
+
+    def test_recipes_missing_documents_prefetched(self):
+        """Test recipes without a document are serialized without a query each"""
+        tag = sample_tag(user=self.user)
+        for title in ('Soup', 'Stew', 'Salad'):
+            self.create_recipe(title=title, tags=[tag.id])
+        RecipeDocument.objects.all().delete()
+
+        # Pin lookup, recipes with their documents, then tags and ingredients
+        with self.assertNumQueries(4):
+            res = self.client.get(RECIPE_URL)
+        self.assertEqual([item['tags'] for item in res.json()], [[tag.id]] * 3)
+
+    def test_check_command_repairs_drift(self):
+        """Test the consistency check finds and rebuilds drifted documents"""
+        stale = self.create_recipe()
+        missing = self.create_recipe(title='Stew')
+        self.create_recipe(title='Salad')
+        Recipe.objects.filter(id=stale.id).update(title='Renamed behind our back')
+        RecipeDocument.objects.filter(recipe=missing).delete()
+
+        out = StringIO()
+        call_command('check_recipe_documents', stdout=out)
+        self.assertIn('3 recipes checked: 1 missing and 1 stale documents found', out.getvalue())
+        call_command('check_recipe_documents', '--repair', stdout=StringIO())
+
+        out = StringIO()
+        call_command('check_recipe_documents', stdout=out)
+        self.assertIn('0 missing and 0 stale', out.getvalue())
+        stale.document.refresh_from_db()
+        self.assertEqual(json.loads(stale.document.detail)['title'], 'Renamed behind our back')
+
+
+class IdempotencyKeyTest(TestCase):
+    """Test retried POSTs with an Idempotency-Key are only run once"""
+
+    def setUp(self):
+        caches['idempotency'].clear()
+        self.user = get_user_model().objects.create_user('test@davis.com', 'pass1234')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_retry_replays_the_first_response(self):
+        """Test a retry with the same key gets the stored response"""
+        first = self.client.post(TAGS_URL, {'name': 'Vegan'}, HTTP_IDEMPOTENCY_KEY='abc')
+        second = self.client.post(TAGS_URL, {'name': 'Vegan'}, HTTP_IDEMPOTENCY_KEY='abc')
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertFalse(first.has_header('Idempotent-Replayed'))
+        self.assertEqual(Tag.objects.filter(user=self.user).count(), 1)
+
+    def test_keys_are_per_user_and_optional(self):
+        """Test other users and requests without a key are not affected"""
+        other = get_user_model().objects.create_user('other@davis.com', 'pass1234')
+        self.client.post(TAGS_URL, {'name': 'Vegan'}, HTTP_IDEMPOTENCY_KEY='abc')
+        self.client.post(TAGS_URL, {'name': 'Vegan'})
+        client = APIClient()
+        client.force_authenticate(other)
+        res = client.post(TAGS_URL, {'name': 'Vegan'}, HTTP_IDEMPOTENCY_KEY='abc')
+
+        self.assertFalse(res.has_header('Idempotent-Replayed'))
+        self.assertEqual(Tag.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(Tag.objects.filter(user=other).count(), 1)
+
+    def test_key_reused_for_another_request(self):
+        """Test reusing a key with a different body is refused"""
+        self.client.post(TAGS_URL, {'name': 'Vegan'}, HTTP_IDEMPOTENCY_KEY='abc')
+        res = self.client.post(TAGS_URL, {'name': 'Dessert'}, HTTP_IDEMPOTENCY_KEY='abc')
+
+        self.assertEqual(res.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertFalse(Tag.objects.filter(name='Dessert').exists())
+
+    @override_settings(IDEMPOTENCY_LOCK_SECONDS=0)
+    def test_retry_while_first_request_runs(self):
+        """Test a retry gets a 409 once it waited too long for the first request"""
+        self.client.post(TAGS_URL, {'name': 'Vegan'}, HTTP_IDEMPOTENCY_KEY='abc')
+        caches['idempotency'].clear()
+        with mock.patch.object(caches['idempotency'], 'add', return_value=False):
+            res = self.client.post(TAGS_URL, {'name': 'Vegan'}, HTTP_IDEMPOTENCY_KEY='abc')
+
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(res['Retry-After'], '1')
+        self.assertEqual(Tag.objects.count(), 1)
+
+    def test_retry_waits_for_first_response(self):
+        """Test a retry waiting on the first request replays its response"""
+        payload = {'title': 'Stew', 'time_minutes': 10, 'price': '5.00'}
+        first = self.client.post(RECIPE_URL, payload, HTTP_IDEMPOTENCY_KEY='abc')
+        idempotency = caches['idempotency']
+        get = idempotency.get
+        polls = iter([lambda key: None, lambda key: None])
+        lock = mock.patch.object(idempotency, 'add', return_value=False)
+        poll = mock.patch.object(idempotency, 'get', side_effect=lambda key: next(polls, get)(key))
+        with lock, poll, mock.patch('core.idempotency.time.sleep') as sleep:
+            res = self.client.post(RECIPE_URL, payload, HTTP_IDEMPOTENCY_KEY='abc')
+
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.json(), first.json())
+        self.assertEqual(res['Idempotent-Replayed'], 'true')
+        self.assertEqual(Recipe.objects.count(), 1)
+
+    def test_retry_runs_once_first_request_failed(self):
+        """Test a waiting retry runs the request when the first one stored nothing"""
+        idempotency = caches['idempotency']
+        add = idempotency.add
+        attempts = iter([lambda *args: False])
+        lock = mock.patch.object(idempotency, 'add', side_effect=lambda *args: next(attempts, add)(*args))
+        with lock, mock.patch('core.idempotency.time.sleep') as sleep:
+            res = self.client.post(TAGS_URL, {'name': 'Vegan'}, HTTP_IDEMPOTENCY_KEY='abc')
+
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Tag.objects.count(), 1)
+
+    def test_retry_after_first_response_stored(self):
+        """Test a retry racing the first request's lock release replays its response"""
+        payload = {'title': 'Stew', 'time_minutes': 10, 'price': '5.00'}
+        first = self.client.post(RECIPE_URL, payload, HTTP_IDEMPOTENCY_KEY='abc')
+        with mock.patch.object(caches['idempotency'], 'add', return_value=False):
+            res = self.client.post(RECIPE_URL, payload, HTTP_IDEMPOTENCY_KEY='abc')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.json(), first.json())
+        self.assertEqual(res['Idempotent-Replayed'], 'true')
+        self.assertEqual(Recipe.objects.count(), 1)
+
+
+class RecipeExportTest(TestCase):
+    """Test the streamed ZIP export of a user's data"""
+
+    def setUp(self):
+        cache.clear()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media = override_settings(
+            MEDIA_ROOT=media_root.name, EXPORT_SNAPSHOT_ROOT=os.path.join(media_root.name, 'exports')
+        )
+        media.enable()
+        self.addCleanup(media.disable)
+        self.user = get_user_model().objects.create_user('test@davis.com', 'pass1234')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.tag = sample_tag(self.user, 'Vegan')
+        self.ingredient = sample_ingredient(self.user, 'Salt')
+        self.recipe = sample_recipe(self.user, title='Stew')
+        self.recipe.tags.add(self.tag)
+        self.recipe.ingredients.add(self.ingredient)
+        self.image = bytes(range(256)) * 40
+        self.recipe.image.save('stew.jpg', ContentFile(self.image))
+        sample_recipe(self.user, title='Salad')
+        sample_recipe(get_user_model().objects.create_user('other@davis.com', 'pass1234'))
+        self.url = reverse('recipe_app:recipe-export')
+
+    def download(self, **headers):
+        res = self.client.get(self.url, **headers)
+        return res, b''.join(res.streaming_content) if res.streaming else res.content
+
+    def test_export_archive(self):
+        """Test the archive holds the user's rows as NDJSON and their images"""
+        res, body = self.download()
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], 'application/zip')
+        self.assertEqual(int(res['Content-Length']), len(body))
+        self.assertFalse(res.has_header('Content-Encoding'))
+
+        archive = zipfile.ZipFile(io.BytesIO(body))
+        self.assertIsNone(archive.testzip())
+        image_name = f'images/{self.recipe.image.name}'
+        self.assertEqual(
+            archive.namelist(), ['tags.ndjson', 'ingredients.ndjson', 'recipes.ndjson', image_name]
+        )
+        self.assertTrue(all(info.compress_type == zipfile.ZIP_STORED for info in archive.infolist()))
+        recipes = [json.loads(line) for line in archive.read('recipes.ndjson').splitlines()]
+        self.assertEqual([recipe['title'] for recipe in recipes], ['Stew', 'Salad'])
+        self.assertEqual(recipes[0]['tags'], [self.tag.id])
+        self.assertEqual(recipes[0]['image'], image_name)
+        self.assertIsNone(recipes[1]['image'])
+        tags = [json.loads(line) for line in archive.read('tags.ndjson').splitlines()]
+        self.assertEqual([tag['name'] for tag in tags], ['Vegan'])
+        self.assertEqual(archive.read(image_name), self.image)
+
+        again, same = self.download()
+        self.assertEqual(same, body)
+        self.assertEqual(again['ETag'], res['ETag'])
+
+    def test_resume_with_range(self):
+        """Test a download can be resumed from any byte with If-Range"""
+        res, body = self.download()
+        etag = res['ETag']
+        cache.clear()
+
+        for offset in (1, 100, len(body) // 2, len(body) - 22):
+            res, part = self.download(HTTP_RANGE=f'bytes={offset}-', HTTP_IF_RANGE=etag)
+            self.assertEqual(res.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(res['Content-Range'], f'bytes {offset}-{len(body) - 1}/{len(body)}')
+            self.assertEqual(part, body[offset:])
+        res, part = self.download(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(part, body[10:20])
+        res, part = self.download(HTTP_RANGE='bytes=-50')
+        self.assertEqual(part, body[-50:])
+
+        res = self.client.get(self.url, HTTP_RANGE=f'bytes={len(body)}-')
+        self.assertEqual(res.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(res['Content-Range'], f'bytes */{len(body)}')
+
+    def test_related_ids_in_id_order(self):
+        """Test the ids a recipe lists are ordered, so its bytes never change"""
+        tags = [sample_tag(self.user, name) for name in ('Dessert', 'Quick')]
+        self.recipe.tags.add(*reversed(tags))
+        with CaptureQueriesContext(connection) as queries:
+            res, body = self.download()
+
+        archive = zipfile.ZipFile(io.BytesIO(body))
+        recipe = json.loads(archive.read('recipes.ndjson').splitlines()[0])
+        self.assertEqual(recipe['tags'], sorted([self.tag.id] + [tag.id for tag in tags]))
+        prefetches = [
+            query['sql'] for query in queries.captured_queries
+            if 'recipe_tags' in query['sql'] or 'recipe_ingredients' in query['sql']
+        ]
+        self.assertTrue(prefetches)
+        self.assertTrue(all('ORDER BY' in sql for sql in prefetches))
+
+    def test_changes_while_streaming(self):
+        """Test a download streams the archive of its ETag while the rows change"""
+        res, body = self.download()
+        cache.clear()
+        res = self.client.get(self.url)
+        chunks = iter(res.streaming_content)
+        first = next(chunks)
+        Recipe.objects.filter(id=self.recipe.id).update(title='Soup')
+        sample_tag(self.user, 'Dessert')
+        self.assertEqual(first + b''.join(chunks), body)
+
+        etag = res['ETag']
+        res, new_body = self.download()
+        self.assertNotEqual(res['ETag'], etag)
+        archive = zipfile.ZipFile(io.BytesIO(new_body))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(json.loads(archive.read('recipes.ndjson').splitlines()[0])['title'], 'Soup')
+
+    def test_snapshot_of_one_version(self):
+        """Test rows changed while the snapshot is rendered make it render again"""
+        write = export._write
+        changes = iter([lambda: sample_tag(self.user, 'Dessert')])
+
+        def write_and_change(*args):
+            next(changes, lambda: None)()
+            return write(*args)
+
+        with mock.patch('recipe_app.export._write', side_effect=write_and_change) as written:
+            res, body = self.download()
+        self.assertEqual(written.call_count, 6)
+        archive = zipfile.ZipFile(io.BytesIO(body))
+        self.assertEqual(archive.read('tags.ndjson').count(b'\n'), 2)
+        self.assertEqual(self.download()[0]['ETag'], res['ETag'])
+
+        sample_tag(self.user, 'Quick')
+        names = iter(range(10))
+        with override_settings(EXPORT_SNAPSHOT_ATTEMPTS=1), mock.patch(
+            'recipe_app.export._write',
+            side_effect=lambda *args: (sample_tag(self.user, f'Tag {next(names)}'), write(*args))[1],
+        ):
+            res = self.client.get(self.url)
+        self.assertEqual(res.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(res['Retry-After'], '1')
+
+    def test_changes_make_a_new_archive(self):
+        """Test a stale If-Range gets the whole new archive"""
+        res, body = self.download()
+        sample_tag(self.user, 'Dessert')
+        res, new_body = self.download(HTTP_RANGE='bytes=100-', HTTP_IF_RANGE=res['ETag'])
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(new_body, body)
+        archive = zipfile.ZipFile(io.BytesIO(new_body))
+        self.assertEqual(archive.read('tags.ndjson').count(b'\n'), 2)
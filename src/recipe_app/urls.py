@@ -12,6 +12,9 @@ router.register('recipes', views.RecipeViewSet)
 app_name = 'recipe_app'
 
 urlpatterns = [
+    path('sync/', views.SyncView.as_view(), name='sync'),
+    path('events/', views.EventStreamView.as_view(), name='events'),
+    path('shopping-list/', views.ShoppingListView.as_view(), name='shopping-list'),
     path('', include(router.urls))
 ]
 
@@ -1,28 +1,84 @@
 from rest_framework import viewsets, mixins, status
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
-from core.models import Tag, Ingredient, Recipe
-from .serializers import TagSerializer, IngredientSerializer, RecipeSerializer, RecipeDetailSerializer, RecipeImageSerializer
+from collections import OrderedDict
+from decimal import Decimal
+from django.conf import settings
+from django.db.models import Count, F, prefetch_related_objects
+from django.http import StreamingHttpResponse
+from core.bulk import clone_recipe, delete_recipes, update_recipes
+from core.cache import cached_for_user
+from core.idempotency import idempotent
+from core.limits import query_timeout
+from core.models import Tag, Ingredient, Recipe, RecipeNeighbour, Change
+from core.renderers import RAW_JSON_SUPPORTED, EventStreamRenderer, RawJSON, ZipRenderer
+from core.sharding import user_epoch
+from core.sync import changes_since, decode_token, encode_token, latest_change, pruned_through
+from .autocomplete import autocomplete
+from .export import build_export, export_response
+from .pagination import KeysetPagination
+from .shopping import shopping_list
+from .stats import recipe_stats
+from .streams import event_stream
+from .serializers import TagSerializer, IngredientSerializer, RecipeSerializer, RecipeDetailSerializer, RecipeDocumentSerializer, RecipeImageSerializer, RecipeBulkUpdateSerializer
+
+
+def _blank(value):
+    """Tell whether a filter value selects nothing, like '' or []"""
+    if isinstance(value, list):
+        return all(_blank(item) for item in value)
+    return value is None or not str(value).strip()
+
+
+def _facet_counts(through, field, recipe_ids):
+    """Group the relation rows of the given recipes by related object"""
+    rows = through.objects.filter(recipe_id__in=recipe_ids).values(
+        f'{field}_id', f'{field}__name'
+    ).annotate(count=Count('recipe_id')).order_by('-count', f'{field}__name')
+    return [
+        {'id': row[f'{field}_id'], 'name': row[f'{field}__name'], 'count': row['count']}
+        for row in rows
+    ]
 
 
 class BaserecipeViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.CreateModelMixin):
     """Base viewsets for user owned recipe"""
     authentication_classes = (TokenAuthentication,)
     permission_classes = (IsAuthenticated,)
+    replica_reads = True
 
     def get_queryset(self):
         """Returns objects for the current authenticated user only"""
         assigned_only = bool(self.request.query_params.get('assigned_only'))
         queryset = self.queryset
         if assigned_only:
-            queryset = queryset.filter(recipe__isnull=False)
+            queryset = queryset.filter(recipe_count__gt=0)
         return queryset.filter(user=self.request.user).order_by('-name')
 
+    @action(methods=['GET'], detail=False)
+    def autocomplete(self, request):
+        """Return the most used names starting with the prefix param"""
+        try:
+            limit = int(request.query_params.get('limit', settings.AUTOCOMPLETE_LIMIT))
+        except ValueError:
+            raise ValidationError({'limit': 'A valid integer is required'})
+        limit = max(1, min(limit, settings.AUTOCOMPLETE_LIMIT))
+        queryset = self.queryset.filter(user=request.user)
+        prefix = request.query_params.get('prefix', '')
+        data = autocomplete(queryset, request.user.id, prefix, limit)
+        return Response(data, status=status.HTTP_200_OK)
+
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
 
     def perform_create(self, serializer):
-        """Create a new tag"""+
+        """Create a new tag"""
         serializer.save(user=self.request.user)
 
 
@@ -46,39 +102,287 @@ class RecipeViewSet(viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     authentication_classes = (TokenAuthentication, )
     permission_classes = (IsAuthenticated, )
+    replica_reads = True
+    pagination_class = KeysetPagination
+    ordering_fields = ('price', 'time_minutes', 'title', 'id')
+    filter_params = (
+        'tags', 'ingredients', 'search', 'min_price', 'max_price', 'min_time', 'max_time'
+    )
+    default_ordering = '-id'
 
     def _params_to_ints(self, qs):
         """Convert a list of string ids to a list of integers"""
-        return [int(str_id) for str_id in qs.split(',')]
+        if qs.count(',') >= settings.FILTER_MAX_IDS:
+            raise ValidationError({'detail': f'At most {settings.FILTER_MAX_IDS} ids'})
+        try:
+            return [int(str_id) for str_id in qs.split(',')]
+        except ValueError:
+            raise ValidationError({'detail': 'Expected a comma separated list of ids'})
 
+    def _param_to_number(self, params, name, convert):
+        """Convert a numeric query param, returning None when it is absent"""
+        value = params.get(name)
+        if value in (None, ''):
+            return None
+        try:
+            number = convert(value)
+        except (ValueError, ArithmeticError):
+            number = None
+        # Decimal takes NaN and Infinity, which no range can be compared with
+        if number is None or not Decimal(number).is_finite():
+            raise ValidationError({name: 'A valid number is required'})
+        return number
 
+    def _bulk_queryset(self, request):
+        """Select the user's recipes by an ids list and/or a filter mapping
 
-    def get_queryset(self):
-        """Retrieve the recipe for the authenticated user"""
-        tags = self.request.query_params.get('tags')
-        ingredients = self.request.query_params.get('ingredients')
-        queryset = self.queryset
+        A filter without a single value would select the whole library,
+        which has to be asked for with "all": true.
+        """
+        if not isinstance(request.data, dict):
+            raise ValidationError({'detail': 'Expected a JSON object'})
+        ids = request.data.get('ids')
+        filters = request.data.get('filter')
+        everything = request.data.get('all') is True
+        if ids is None and filters is None and not everything:
+            raise ValidationError({'detail': 'Provide ids, filter or all'})
+        if ids is None and not everything and isinstance(filters, dict) and all(
+            _blank(value) for value in filters.values()
+        ):
+            raise ValidationError({'filter': 'Give a filter value, or "all": true to select every recipe'})
+        queryset = self.queryset.filter(user=request.user)
+        if ids is not None:
+            if not isinstance(ids, list):
+                raise ValidationError({'ids': 'Expected a list of ids'})
+            queryset = queryset.filter(id__in=self._params_to_ints(','.join(map(str, ids))))
+        if filters is not None:
+            if not isinstance(filters, dict) or set(filters) - set(self.filter_params):
+                raise ValidationError({'filter': f'Use only {", ".join(self.filter_params)}'})
+            params = {
+                key: ','.join(map(str, value)) if isinstance(value, list) else str(value)
+                for key, value in filters.items()
+            }
+            queryset = self._filter_queryset(queryset, params)
+        return queryset
+
+    def get_ordering(self):
+        """Return the requested ordering with id as a stable tie breaker"""
+        ordering = self.request.query_params.get('ordering') or self.default_ordering
+        if ordering.lstrip('-') not in self.ordering_fields:
+            raise ValidationError({'ordering': f'Choose one of {", ".join(self.ordering_fields)}'})
+        if ordering.lstrip('-') == 'id':
+            return (ordering, )
+        return (ordering, '-id' if ordering.startswith('-') else 'id')
+
+    def _filter_queryset(self, queryset, params):
+        """Apply the recipe filters found in params to the queryset"""
+        tags = params.get('tags')
+        ingredients = params.get('ingredients')
+        search = params.get('search')
         if tags:
             tags_id = self._params_to_ints(tags)
             queryset = queryset.filter(tags__id__in=tags_id)
         if ingredients:
             ingredients_id = self._params_to_ints(ingredients)
             queryset = queryset.filter(ingredients__id__in=ingredients_id)
-        return self.queryset.filter(user=self.request.user)
+        if tags or ingredients:
+            queryset = queryset.distinct()
+        if search:
+            queryset = queryset.filter(title__icontains=search)
+        ranges = (
+            ('min_price', 'price__gte', Decimal),
+            ('max_price', 'price__lte', Decimal),
+            ('min_time', 'time_minutes__gte', int),
+            ('max_time', 'time_minutes__lte', int),
+        )
+        for name, lookup, convert in ranges:
+            value = self._param_to_number(params, name, convert)
+            if value is not None:
+                queryset = queryset.filter(**{lookup: value})
+        return queryset
+
+    def get_queryset(self):
+        """Retrieve the recipe for the authenticated user"""
+        queryset = self.queryset.filter(user=self.request.user)
+        queryset = self._filter_queryset(queryset, self.request.query_params)
+        if self.action in ('list', 'retrieve'):
+            queryset = queryset.prefetch_related('tags', 'ingredients')
+        # ?ordering= only means something to lists, so it cannot fail other actions
+        if self.action == 'list':
+            return queryset.order_by(*self.get_ordering())
+        return queryset.order_by(self.default_ordering)
+
+    def _use_documents(self):
+        return settings.RECIPE_DOCUMENTS and RAW_JSON_SUPPORTED
+
+    def _with_documents(self, queryset, field):
+        """Select each recipe's stored document instead of prefetching relations"""
+        return queryset.prefetch_related(None).annotate(document_json=F(f'document__{field}'))
+
+    def _serialize(self, recipes, serializer_class):
+        """Write out stored documents, serializing only recipes missing one"""
+        if not self._use_documents():
+            return serializer_class(recipes, many=True, context=self.get_serializer_context()).data
+        context = self.get_serializer_context()
+        prefetch_related_objects(
+            [recipe for recipe in recipes if recipe.document_json is None], 'tags', 'ingredients'
+        )
+        return [
+            RawJSON(recipe.document_json) if recipe.document_json is not None
+            else serializer_class(recipe, context=context).data
+            for recipe in recipes
+        ]
+
+    def _detail_serializer_class(self):
+        """Return the detail serializer, matching the stored documents when they are on"""
+        return RecipeDocumentSerializer if self._use_documents() else RecipeDetailSerializer
+
+    def list(self, request, *args, **kwargs):
+        """List recipes, or return the details of the recipes in ?ids="""
+        ids = request.query_params.get('ids')
+        if ids is None:
+            if not self._use_documents():
+                return super().list(request, *args, **kwargs)
+            queryset = self._with_documents(self.get_queryset(), 'summary')
+            page = self.paginate_queryset(queryset)
+            if page is not None:
+                return self.get_paginated_response(self._serialize(page, RecipeSerializer))
+            return Response(self._serialize(queryset, RecipeSerializer))
+        ids = list(OrderedDict.fromkeys(self._params_to_ints(ids)))
+        if len(ids) > settings.RECIPE_MULTI_GET_MAX:
+            raise ValidationError({'ids': f'At most {settings.RECIPE_MULTI_GET_MAX} ids'})
+        # A filtered out id would be reported missing, though it exists
+        filters = [name for name in self.filter_params if name in request.query_params]
+        if filters:
+            raise ValidationError({'ids': f'Cannot be combined with {", ".join(filters)}'})
+        queryset = self.queryset.filter(user=request.user, id__in=ids).prefetch_related(
+            'tags', 'ingredients'
+        )
+        if self._use_documents():
+            queryset = self._with_documents(queryset, 'detail')
+        recipes = {recipe.id: recipe for recipe in queryset}
+        data = self._serialize(
+            [recipes[recipe_id] for recipe_id in ids if recipe_id in recipes],
+            self._detail_serializer_class(),
+        )
+        return Response({
+            'results': data,
+            'missing': [recipe_id for recipe_id in ids if recipe_id not in recipes],
+        }, status=status.HTTP_200_OK)
+
+    def retrieve(self, request, *args, **kwargs):
+        """Return the recipe's stored document when there is one"""
+        if self._use_documents() and str(kwargs.get('pk')).isdigit():
+            document = self.get_queryset().filter(pk=kwargs['pk']).values_list(
+                'document__detail', flat=True
+            ).first()
+            if document is not None:
+                return Response(RawJSON(document))
+        return super().retrieve(request, *args, **kwargs)
 
     def get_serializer_class(self):
         """Return the appropriate serializer class"""
         if self.action == 'retrieve':
-            return RecipeDetailSerializer
+            return self._detail_serializer_class()
         elif self.action == 'upload_image':
             return RecipeImageSerializer
         return self.serializer_class
 
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
+
     def perform_create(self, serializer):
         """Create a new recipe"""
         serializer.save(user=self.request.user)
 
+    @action(methods=['GET'], detail=False)
+    def facets(self, request):
+        """Count the filtered recipes carrying each tag and ingredient"""
+        def compute():
+            queryset = self.get_queryset()
+            recipe_ids = queryset.order_by().values('id')
+            return {
+                'count': queryset.count(),
+                'tags': _facet_counts(Recipe.tags.through, 'tag', recipe_ids),
+                'ingredients': _facet_counts(
+                    Recipe.ingredients.through, 'ingredient', recipe_ids
+                ),
+            }
+
+        data = cached_for_user(request.user.id, 'recipe-facets', compute, request.query_params)
+        return Response(data, status=status.HTTP_200_OK)
+
+    @action(methods=['GET'], detail=False)
+    def stats(self, request):
+        """Summarise the user's recipes for dashboards"""
+        data = cached_for_user(request.user.id, 'recipe-stats', lambda: recipe_stats(request.user))
+        return Response(data, status=status.HTTP_200_OK)
+
+    @action(methods=['GET'], detail=True)
+    def similar(self, request, pk=None):
+        """List the user's recipes most similar to this one"""
+        recipe = self.get_object()
+        neighbours = RecipeNeighbour.objects.filter(recipe=recipe).select_related(
+            'neighbour'
+        ).prefetch_related('neighbour__tags', 'neighbour__ingredients').order_by(
+            '-score', 'neighbour_id'
+        )
+        data = []
+        for neighbour in neighbours:
+            item = RecipeSerializer(neighbour.neighbour, context=self.get_serializer_context()).data
+            item['score'] = neighbour.score
+            data.append(item)
+        return Response(data, status=status.HTTP_200_OK)
+
+    @action(methods=['POST'], detail=False, url_path='bulk-delete')
+    def bulk_delete(self, request):
+        """Delete many recipes selected by ids or a filter"""
+        deleted = delete_recipes(request.user.id, self._bulk_queryset(request))
+        return Response({'deleted': deleted}, status=status.HTTP_200_OK)
+
+    @action(methods=['POST'], detail=False, url_path='bulk-update')
+    def bulk_update(self, request):
+        """Set price, time_minutes or link on many recipes at once"""
+        queryset = self._bulk_queryset(request)
+        serializer = RecipeBulkUpdateSerializer(data=request.data.get('set') or {}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        updated = update_recipes(request.user.id, queryset, serializer.validated_data)
+        return Response({'updated': updated}, status=status.HTTP_200_OK)
+
+    @action(methods=['POST'], detail=True)
+    @idempotent
+    def clone(self, request, pk=None):
+        """Duplicate a recipe with its tags, ingredients and image"""
+        recipe = self.get_object()
+        try:
+            count = int(request.data.get('count', 1))
+        except (TypeError, ValueError):
+            count = 0
+        if not 1 <= count <= settings.RECIPE_CLONE_MAX:
+            raise ValidationError({'count': f'Choose between 1 and {settings.RECIPE_CLONE_MAX}'})
+        copy_ids = clone_recipe(recipe, count)
+        copies = Recipe.objects.filter(id__in=copy_ids).order_by('id').prefetch_related(
+            'tags', 'ingredients'
+        )
+        serializer = self.get_serializer(copies, many=True)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(
+        methods=['GET'], detail=False,
+        renderer_classes=tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (ZipRenderer, ),
+    )
+    @query_timeout(60000)
+    def export(self, request):
+        """Download the user's recipes, tags, ingredients and images as a ZIP
+
+        Interrupted downloads can be resumed with Range and If-Range.
+        """
+        archive, etag = build_export(request.user)
+        return export_response(request, archive, etag)
+
     @action(methods=['POST'], detail=True, url_path='upload-image')
+    @idempotent
     def upload_image(self, request, pk=None):
         """Upload an image to a recipe"""
         recipe = self.get_object()
@@ -92,3 +396,88 @@ class RecipeViewSet(viewsets.ModelViewSet):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+
+
+class SyncView(APIView):
+    """Return the user's recipes, tags and ingredients changed since a token"""
+    authentication_classes = (TokenAuthentication, )
+    permission_classes = (IsAuthenticated, )
+    query_timeout_ms = 15000
+    sections = (
+        (Change.RECIPE, 'recipes', Recipe, RecipeSerializer),
+        (Change.TAG, 'tags', Tag, TagSerializer),
+        (Change.INGREDIENT, 'ingredients', Ingredient, IngredientSerializer),
+    )
+
+    def get(self, request):
+        epoch = user_epoch(request.user.id)
+        try:
+            since, reset = decode_token(
+                request.query_params.get('since') or 0, epoch, pruned_through(request.user)
+            )
+        except ValueError:
+            raise ValidationError({'since': 'Invalid sync token'})
+        changes, token, more = changes_since(request.user, since, settings.SYNC_PAGE_SIZE)
+
+        data = {'token': encode_token(token, epoch), 'more': more, 'reset': reset}
+        for kind, name, model, serializer_class in self.sections:
+            updated = [change.object_id for change in changes
+                       if change.kind == kind and not change.deleted]
+            deleted = [change.object_id for change in changes
+                       if change.kind == kind and change.deleted]
+            queryset = model.objects.filter(user=request.user, id__in=updated).order_by('id')
+            if model is Recipe:
+                queryset = queryset.prefetch_related('tags', 'ingredients')
+            data[name] = {
+                'updated': serializer_class(queryset, many=True).data,
+                'deleted': deleted,
+            }
+        return Response(data, status=status.HTTP_200_OK)
+
+
+class EventStreamView(APIView):
+    """Push the user's recipe, tag and ingredient changes as server-sent events"""
+    authentication_classes = (TokenAuthentication, )
+    permission_classes = (IsAuthenticated, )
+    renderer_classes = (EventStreamRenderer, ) + tuple(api_settings.DEFAULT_RENDERER_CLASSES)
+
+    def get(self, request):
+        epoch = user_epoch(request.user.id)
+        last_id = request.META.get('HTTP_LAST_EVENT_ID') or request.query_params.get('since')
+        try:
+            if last_id:
+                last_id, reset = decode_token(last_id, epoch, pruned_through(request.user))
+            else:
+                last_id, reset = 0, True
+        except ValueError:
+            raise ValidationError({'since': 'Invalid event id'})
+        if reset:
+            last_id = latest_change(request.user)
+        response = StreamingHttpResponse(
+            event_stream(request.user, last_id, epoch), content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class ShoppingListView(APIView):
+    """Merge the ingredients of many recipes into one shopping list"""
+    authentication_classes = (TokenAuthentication, )
+    permission_classes = (IsAuthenticated, )
+
+    def post(self, request):
+        if not isinstance(request.data, dict):
+            raise ValidationError({'detail': 'Expected a JSON object'})
+        recipe_ids = request.data.get('recipes')
+        if not isinstance(recipe_ids, list) or not recipe_ids:
+            raise ValidationError({'recipes': 'Expected a list of recipe ids'})
+        if len(recipe_ids) > settings.SHOPPING_LIST_MAX_RECIPES:
+            raise ValidationError(
+                {'recipes': f'At most {settings.SHOPPING_LIST_MAX_RECIPES} recipes'}
+            )
+        try:
+            recipe_ids = [int(recipe_id) for recipe_id in recipe_ids]
+        except (TypeError, ValueError):
+            raise ValidationError({'recipes': 'Expected a list of recipe ids'})
+        return Response(shopping_list(request.user, recipe_ids), status=status.HTTP_200_OK)
@@ -44,6 +44,17 @@ class PublicUserAPITests(TestCase):
         res = self.client.post(CREATE_USER_URL, payload)
         self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_signups_sharing_an_idempotency_key(self):
+        """Test anonymous signups are not told apart by Idempotency-Key"""
+        first = {'email': 'test@davis.com', 'password': 'pass1234', 'name': 'Test'}
+        second = {'email': 'other@davis.com', 'password': 'pass1234', 'name': 'Other'}
+        self.client.post(CREATE_USER_URL, first, HTTP_IDEMPOTENCY_KEY='abc')
+        res = self.client.post(CREATE_USER_URL, second, HTTP_IDEMPOTENCY_KEY='abc')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data['email'], second['email'])
+        self.assertEqual(get_user_model().objects.count(), 2)
+
     def test_password_too_short(self):
         """Testing a short password"""
         payload = {
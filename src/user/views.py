@@ -20,6 +20,7 @@ class ManageUserView(generics.RetrieveUpdateAPIView):
     serializer_class = UserSerializer
     authentication_classes = (authentication.TokenAuthentication,)
     permission_classes = (permissions.IsAuthenticated, )
+    replica_reads = True
 
     def get_object(self):
         """Retrieve and return authenticated user"""